@@ -0,0 +1,415 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from types import SimpleNamespace
+
+from fakes import FakeBigQueryClient, FakeDocumentAIClient, FakeOperationsClient, FakePublisherClient, FakeStorageClient
+from harness import load_function, load_sibling, scratch_dir
+from scenarios import event_context, gcs_event, setup_ingest
+from synthetic import synthetic_pdf
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Correctness checks #########
+# Assertions against the same in-process fakes the benchmarks use, for behaviour a throughput number cannot show
+# (claims, retries, call patterns). Each check runs in its own process and fails by raising:
+#   python benchmarks/checks.py                   every check
+#   python benchmarks/checks.py operations_claim_ttl
+# The exit status is 1 when any check fails.
+
+CHECKS = {}
+
+
+def check(function):
+    CHECKS[function.__name__] = function
+    return function
+
+
+###------ Operation tracker ------###
+
+class TrackerFixture:
+    # An OperationTracker over a fake bucket and operations client, on a clock the check moves by hand
+    def __init__(self, claim_ttl=600, **kwargs):
+        self.storage = FakeStorageClient()
+        self.operations = FakeOperationsClient()
+        self.now = 1000.0
+        self.done, self.failed = [], []
+        self.on_done = lambda record, operation: self.done.append(record['key'])
+        self.resubmit = self._resubmit
+        self.bucket = self.storage.bucket('state')
+        self.tracker = load_sibling('ingest', 'operations').OperationTracker(
+            self.bucket, 'docai_operations/', lambda name: self.operations.get_operation(name),
+            self.operations.cancel_operation, lambda record: self.resubmit(record),
+            lambda record, operation: self.on_done(record, operation),
+            lambda record, reason: self.failed.append(record['key']), claim_ttl=claim_ttl, clock=lambda: self.now,
+            **kwargs)
+
+    def _resubmit(self, record):
+        return {'operation': self.operations.start()}
+
+    def track(self, key='batch'):
+        name = self.operations.start()
+        self.tracker.track(key, name, sources=[f'gs://archive/{key}.pdf'])
+        return name
+
+    def record(self, key='batch'):
+        blob = self.bucket.get_blob(f'docai_operations/{key}.json')
+        return json.loads(blob.download_as_bytes()) if blob is not None else None
+
+
+@check
+def operations_concurrent_check():
+    # Two check() callers that both read the record before either claims it: exactly one publishes the outputs
+    fixture = TrackerFixture()
+    fixture.operations.finish(fixture.track())
+    both_read = threading.Barrier(2, timeout=10)
+    get_operation = fixture.tracker.get_operation
+
+    def get_operation_after_both_read(name):
+        both_read.wait()
+        return get_operation(name)
+    fixture.tracker.get_operation = get_operation_after_both_read
+
+    states = []
+    threads = [threading.Thread(target=lambda: states.append(fixture.tracker.check('batch'))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(states) == ['claimed', 'completed'], states
+    assert fixture.done == ['batch'], fixture.done
+    assert fixture.record() is None
+
+
+@check
+def operations_claim_precondition():
+    # A record rewritten by another worker after it was read is not claimed (PreconditionFailed on the claim)
+    fixture = TrackerFixture()
+    fixture.operations.finish(fixture.track())
+    get_operation = fixture.tracker.get_operation
+
+    def get_operation_while_another_worker_claims(name):
+        record = dict(fixture.record(), state='claimed', claimed_at=fixture.now, worker='other')
+        fixture.bucket.blob('docai_operations/batch.json').upload_from_string(json.dumps(record))
+        return get_operation(name)
+    fixture.tracker.get_operation = get_operation_while_another_worker_claims
+
+    assert fixture.tracker.check('batch') == 'claimed'
+    assert fixture.done == []
+    assert fixture.record()['worker'] == 'other'
+
+
+@check
+def operations_claim_ttl():
+    # A claim whose on_done failed (crashed worker, failed publish) stays put until claim_ttl, then is completed again
+    fixture = TrackerFixture(claim_ttl=600)
+    fixture.operations.finish(fixture.track())
+
+    def on_done_fails(record, operation):
+        fixture.done.append(record['key'])
+        raise RuntimeError('publish failed')
+    fixture.on_done = on_done_fails
+    try:
+        fixture.tracker.check('batch')
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("check() swallowed the on_done failure")
+    assert fixture.record()['state'] == 'claimed'
+
+    fixture.on_done = lambda record, operation: fixture.done.append(record['key'])
+    fixture.now += 599
+    assert fixture.tracker.check('batch') == 'claimed'
+    assert fixture.done == ['batch']
+    fixture.now += 2
+    assert fixture.tracker.check('batch') == 'completed'
+    assert fixture.done == ['batch', 'batch']
+    assert fixture.record() is None
+
+
+@check
+def operations_partial_publish():
+    # A document the processor failed is reported and settled, a failed publish is retried after claim_ttl for its own
+    # document only, and the record completes once every document is settled
+    storage = FakeStorageClient()
+    ingest = setup_ingest(storage, FakeDocumentAIClient(storage), FakePublisherClient(max_latency=0.0))
+    fixture = TrackerFixture(claim_ttl=600)
+    fixture.on_done = ingest.publish_completed_batch
+    sources = [f'gs://archive/{name}.pdf' for name in ('a', 'b', 'c')]
+    name = fixture.operations.start()
+    fixture.tracker.track('batch', name, sources=sources, destination_uri=f'gs://{ingest.gcs_output_bucket}/batch/')
+    statuses = [SimpleNamespace(input_gcs_source=source, status=SimpleNamespace(code=3 if source.endswith('c.pdf') else 0,
+                                                                                  message='unsupported file'),
+                                output_gcs_destination=f'gs://{ingest.gcs_output_bucket}/batch/{i}')
+                for i, source in enumerate(sources)]
+    fixture.operations.finish(name)
+    fixture.operations.get_operation(name).metadata = SimpleNamespace(individual_process_statuses=statuses)
+
+    published, attempts = [], []
+    def publish_messages(project_id, topic, messages):
+        attempts.append([attributes['source'] for _, attributes in messages])
+        results = [RuntimeError('deadline exceeded') if len(attempts) == 1 and attributes['source'].endswith('b.pdf')
+                   else str(len(published)) for _, attributes in messages]
+        published.extend(attributes['source'] for (_, attributes), result in zip(messages, results) if isinstance(result, str))
+        return results
+    ingest.publish_messages = publish_messages
+
+    try:
+        fixture.tracker.check('batch')
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("check() completed a batch with an unpublished document")
+    assert fixture.record()['state'] == 'claimed'
+    assert sorted(fixture.record()['settled']) == [sources[0], sources[2]], fixture.record()
+    fixture.now += 601
+    assert fixture.tracker.check('batch') == 'completed'
+    assert attempts == [[sources[0], sources[1]], [sources[1]]], attempts
+    assert published == [sources[0], sources[1]], published
+    assert fixture.record() is None and fixture.tracker.metrics()['queue_depth'] == 0
+
+
+@check
+def operations_resubmit_failure():
+    # A failed operation whose resubmit raises keeps its record (attempt and operation unchanged) and is resubmitted
+    # by the first check after claim_ttl
+    fixture = TrackerFixture(claim_ttl=600, max_retries=1)
+    first = fixture.track()
+    fixture.operations.finish(first, error='internal error')
+
+    def resubmit_fails(record):
+        raise RuntimeError('quota exceeded')
+    fixture.resubmit = resubmit_fails
+    try:
+        fixture.tracker.check('batch')
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("check() swallowed the resubmit failure")
+    record = fixture.record()
+    assert (record['state'], record['attempts'], record['operation']) == ('claimed', 1, first), record
+
+    fixture.resubmit = fixture._resubmit
+    assert fixture.tracker.check('batch') == 'claimed'
+    fixture.now += 601
+    assert fixture.tracker.check('batch') == 'retried'
+    record = fixture.record()
+    assert (record['state'], record['attempts']) == ('running', 2), record
+    assert record['operation'] != first and 'claimed_at' not in record
+
+    fixture.operations.finish(record['operation'], error='internal error')
+    assert fixture.tracker.check('batch') == 'failed'
+    assert fixture.failed == ['batch'] and fixture.done == []
+
+
+@check
+def ingest_operation_key():
+    # An upload in a subdirectory is tracked under a key that output_notification reads back from its output objects
+    storage = FakeStorageClient()
+    ingest = setup_ingest(storage, FakeDocumentAIClient(storage), FakePublisherClient(max_latency=0.0))
+    ingest.LRO_MODE = 'async'
+    checked = {}
+    tracker = load_sibling('ingest', 'operations').OperationTracker(
+        storage.bucket(ingest.operations_state_bucket), ingest.operations_state_prefix,
+        lambda name: SimpleNamespace(done=False, error=None, metadata=None), None, None, None, None)
+    check_key = tracker.check
+    tracker.check = lambda key: checked.setdefault(key, check_key(key))
+    ingest._clients['operation_tracker'] = tracker
+
+    ingest.process_documents([('scans/2021/05/invoice.v2.pdf', 'scans/2021/05/invoice.v2.pdf', None, 'c1')])
+    assert tracker.stats['tracked'] == 1
+    outputs = storage.bucket(ingest.gcs_output_bucket).list_blobs()
+    assert outputs
+    for blob in outputs:
+        ingest.output_notification({'bucket': ingest.gcs_output_bucket, 'name': blob.name}, None)
+    assert len(checked) == 1, checked
+    key, state = checked.popitem()
+    assert key.startswith('docai_ingest_temp_output_scans_2021_05_invoice_v2_'), key
+    assert state == 'running', f"output_notification did not find the record for {key}: {state}"
+
+
+###------ Ingest ------###
+
+def ingest_storage_calls(objects, events=20):
+    # Storage calls per upload event, by method, against an input bucket already holding `objects` objects
+    storage = FakeStorageClient()
+    ingest = setup_ingest(storage, FakeDocumentAIClient(storage), FakePublisherClient(max_latency=0.0))
+    bucket = storage.bucket(ingest.gcs_input_bucket)
+    for i in range(objects):
+        bucket.put(f'backlog/{i:07d}.pdf', b'%PDF-1.4')
+    for i in range(events):
+        data = os.urandom(2000)
+        bucket.put(f'invoice-{i:05d}.pdf', data)
+        ingest.ingest_document(gcs_event(ingest.gcs_input_bucket, f'invoice-{i:05d}.pdf', data), event_context(i))
+    return {method: count / events for method, count in storage.calls.items()}
+
+
+@check
+def ingest_lookup_calls():
+    # An upload event is handled from the event payload alone: no listing, and the same storage calls whether the
+    # input bucket is empty or holds 100k objects
+    empty = ingest_storage_calls(0)
+    full = ingest_storage_calls(100000)
+    assert 'list_blobs' not in full, f"list_blobs called {full['list_blobs']:.1f} times per event"
+    assert full == empty, f"storage calls per event grow with the bucket: {empty} (empty) vs {full} (100k objects)"
+
+
+@check
+def online_fallback_cleanup():
+    # A split document whose online call fails on one shard falls back to batch and leaves no online output behind
+    storage = FakeStorageClient()
+    docai = FakeDocumentAIClient(storage)
+    publisher = FakePublisherClient(max_latency=0.0)
+    ingest = setup_ingest(storage, docai, publisher)
+    ingest.ROUTING_ENABLED = True
+    ingest.ONLINE_CONCURRENCY = 1
+    process_document = docai.process_document
+    calls = []
+
+    def failing_process_document(request=None):
+        calls.append(request)
+        if len(calls) == 3:
+            raise RuntimeError('quota exceeded')
+        return process_document(request)
+
+    docai.process_document = failing_process_document
+    data = synthetic_pdf(5 * ingest.ONLINE_MAX_PAGES)
+    storage.bucket(ingest.gcs_input_bucket).put('invoice.pdf', data)
+    ingest.ingest_document(gcs_event(ingest.gcs_input_bucket, 'invoice.pdf', data), event_context(0))
+    assert len(calls) >= 3 and docai.calls['batch_process_documents'] == 1, (len(calls), docai.calls)
+    left = [blob.name for blob in storage.bucket(ingest.gcs_output_bucket).list_blobs(prefix='docai_ingest_online_output_')]
+    assert left == [], f"online shards left after the batch fallback: {left}"
+    assert ingest.ROUTE_MAX_BYTES <= ingest.FUNCTION_MEMORY_BYTES // 4
+
+
+###------ Small-file script ------###
+
+@check
+def online_no_cache():
+    # --no-cache processes every file without building or reading the result cache; without it the cache is used
+    online = load_function('online')
+    storage = FakeStorageClient()
+    bq = FakeBigQueryClient(storage)
+    docai = FakeDocumentAIClient()
+    online.storage = SimpleNamespace(Client=lambda: storage)
+    online.bigquery = SimpleNamespace(Client=lambda: bq)
+    online.documentai = SimpleNamespace(DocumentProcessorServiceClient=lambda **kwargs: docai)
+    online.result_cache_enabled = True
+    built = []
+    get_result_cache = online.get_result_cache
+    online.get_result_cache = lambda: built.append(get_result_cache()) or built[-1]
+    online.result_cache_dir = str(scratch_dir() / 'checks_cache')
+    path = scratch_dir() / 'checks_invoice.pdf'
+    path.write_bytes(synthetic_pdf(1))
+
+    assert online.main([str(path), '--no-cache']) == 0
+    assert built == [] and docai.calls['process_document'] == 1, (built, docai.calls)
+    assert online.main([str(path)]) == 0
+    assert len(built) == 1, built
+
+
+###------ Transform ------###
+
+def entity(type_, value, confidence=0.9, properties=()):
+    return {'type': type_, 'value': value, 'confidence': confidence, 'properties': list(properties)}
+
+
+PARITY_DOCUMENTS = [
+    ('duplicates', [entity('invoice_id', 'INV-1'), entity('supplier_name', 'A', 0.5), entity('supplier_name', 'B', 0.9),
+                    entity('receiver_name', 'X', properties=[entity('supplier_name', 'C', 0.9)]),
+                    entity('invoice_date', '2021-03-04'), entity('total_amount', '$1,200.50'),
+                    entity('line_item', 'Widget 2 $5.00 $10.00'), entity('line_item', 'no numbers here')]),
+    ('formats', [entity('invoice_id', 'INV-2'), entity('invoice_date', 'March 5, 2021'), entity('due_date', '05/06/2021'),
+                 entity('total_amount', '1.2.3'), entity('net_amount', ' '),
+                 entity('line_item', '', properties=[entity('line_item/description', 'Bolt'), entity('line_item/amount', '$3')])]),
+    ('empty', []),
+]
+
+
+@check
+def transform_engine_parity():
+    # transform.py and records.py give the same rows and rejects under every duplicate policy
+    transform = load_sibling('process', 'transform')
+    records = load_sibling('process', 'records')
+    df = transform.entities_to_frame(PARITY_DOCUMENTS)
+    for policy in transform.DUPLICATE_POLICIES:
+        invoices, invoice_rejects = transform.transform_invoices(df, policy)
+        items, item_rejects = transform.extract_line_items(df, invoices['invoice_id'])
+        for document_id, entities in PARITY_DOCUMENTS:
+            invoice, expected_invoice_rejects, expected_items, expected_item_rejects = records.transform_document(entities, policy)
+            row = None
+            if document_id in invoices.index:
+                row = {col: None if value is None or value != value else value
+                       for col, value in invoices.loc[document_id].items()}
+                for col in transform.date_cols:
+                    row[col] = row[col] and row[col].date()
+            assert row == invoice, (policy, document_id, row, invoice)
+            rejects = invoice_rejects[invoice_rejects['document_id'] == document_id][['field', 'value']].to_dict('records')
+            assert rejects == expected_invoice_rejects, (policy, document_id, rejects, expected_invoice_rejects)
+            document_items = items.loc[[document_id]].to_dict('records') if document_id in items.index else []
+            document_items = [{col: None if value != value else value for col, value in item.items()} for item in document_items]
+            assert document_items == expected_items, (policy, document_id, document_items, expected_items)
+            assert len(item_rejects[item_rejects['document_id'] == document_id]) == len(expected_item_rejects)
+    assert records.invoice_record(PARITY_DOCUMENTS[0][1], 'join')[0]['supplier_name'] == 'A B C'
+
+
+@check
+def line_item_whitespace():
+    # Line item text is split in time linear in its length: a row with a 200k character whitespace run, which a
+    # backtracking pattern needs minutes for, parses (and is rejected) well within a second by both engines
+    transform = load_sibling('process', 'transform')
+    records = load_sibling('process', 'records')
+    text = 'Widget' + ' ' * 200000 + 'x'
+    entities = [entity('invoice_id', 'INV-1'), entity('line_item', text), entity('line_item', 'Bolt' + ' ' * 200000 + '2 $3 $6')]
+    start = time.perf_counter()
+    items, rejects = records.line_item_records(entities, 'INV-1')
+    df = transform.entities_to_frame([('doc', entities)])
+    frame_items, frame_rejects = transform.extract_line_items(df, {'doc': 'INV-1'})
+    elapsed = time.perf_counter() - start
+    assert elapsed < 1.0, f"splitting two long line items took {elapsed:.1f}s"
+    assert [item['item_total'] for item in items] == [6.0] and len(rejects) == 1, (items, rejects)
+    assert frame_items['item_total'].tolist() == [6.0] and len(frame_rejects) == 1
+
+
+###------ Runner ------###
+
+def run_check(name, verbose=False):
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            CHECKS[name]()
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Correctness checks for the Document AI invoice pipelines")
+    parser.add_argument('checks', nargs='*', help=f"Checks to run (default: all): {', '.join(CHECKS)}")
+    parser.add_argument('--verbose', action='store_true', help="Keep the pipeline's own progress output")
+    args = parser.parse_args(argv)
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error(f"unknown check(s): {', '.join(sorted(unknown))}")
+
+    failures = 0
+    for name in args.checks or CHECKS:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            error = pool.submit(run_check, name, args.verbose).result()
+        print(f"{'FAIL' if error else 'ok  '}  {name}", flush=True)
+        if error:
+            failures += 1
+            print(error, flush=True)
+    print(f"{len(args.checks or CHECKS) - failures} passed, {failures} failed")
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main(sys.argv[1:]) else 0)
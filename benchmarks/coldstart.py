@@ -0,0 +1,112 @@
+import argparse
+import contextlib
+import importlib.abc
+import io
+import json
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Cold start probe #########
+# Run in a fresh interpreter (the cold_start scenario starts one per sample). It measures, in order:
+#   import             `import main` of the function, as the runtime does when an instance starts
+#   client_libraries   importing the client libraries the entry point's client factories would load on first use
+#                      (the factories themselves are bypassed, since the clients are fakes)
+#   first_call         the first invocation against the fakes (set up beforehand, untimed): ingest_document for
+#                      ingest, process_blob on a one-shard document for process, including lazy imports on the way
+# and prints them, with the heavy modules loaded at each point, as one JSON object. --without blocks imports of the
+# named packages, to measure a deployment that does not install them. --root points at another checkout, e.g. the
+# tree before a change, while the fakes still come from this directory.
+#
+#   python benchmarks/coldstart.py process --engine records --without pandas
+
+BENCH_DIR = Path(__file__).resolve().parent
+FUNCTION_DIRS = {'ingest': 'managed_pipeline/ingest_document', 'process': 'managed_pipeline/process_document'}
+CLIENT_LIBRARIES = {
+    'ingest': ['google.cloud.storage', 'google.cloud.documentai_v1beta3', 'google.cloud.pubsub_v1'],
+    'process': ['google.cloud.storage', 'google.cloud.bigquery'],
+}
+HEAVY_MODULES = ['pandas', 'numpy', 'pyarrow', 'google.cloud.storage', 'google.cloud.bigquery', 'google.cloud.pubsub_v1',
+                 'google.cloud.documentai_v1beta3', 'pypdf', 'opentelemetry']
+
+
+class BlockImports(importlib.abc.MetaPathFinder):
+    def __init__(self, names):
+        self.names = set(names)
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname.partition('.')[0] in self.names:
+            raise ModuleNotFoundError(f"No module named {fullname!r} (blocked by --without)", name=fullname)
+        return None
+
+
+def loaded():
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+def first_ingest_call(main):
+    from fakes import FakeDocumentAIClient, FakePublisherClient, FakeStorageClient
+    storage = FakeStorageClient()
+    main._clients.update(storage=storage, documentai=FakeDocumentAIClient(storage), pubsub_publisher=FakePublisherClient(max_latency=0.0))
+    main.RESULT_CACHE_ENABLED = False
+    main.ROUTING_ENABLED = False
+    main.COALESCE_WINDOW = 0.0
+    data = b'%PDF-1.4 cold start probe'
+    storage.bucket(main.gcs_input_bucket).put('invoice.pdf', data)
+    event = {'bucket': main.gcs_input_bucket, 'name': 'invoice.pdf', 'metageneration': '1', 'size': str(len(data)),
+             'timeCreated': '', 'updated': ''}
+    context = SimpleNamespace(event_id='0', event_type='google.storage.object.finalize', timestamp='', resource={'name': ''})
+    return lambda: main.ingest_document(event, context)
+
+
+def first_process_call(main, engine):
+    from fakes import FakeBigQueryClient, FakeStorageClient
+    from synthetic import synthetic_shards
+    storage = FakeStorageClient()
+    main._clients.update(storage=storage, bigquery=FakeBigQueryClient(storage))
+    main.RESULT_CACHE_ENABLED = False
+    main.TRANSFORM_ENGINE = engine
+    storage.bucket(main.gcs_output_bucket).put('cold_start/0/doc-0.json', synthetic_shards(0, line_items=10)[0])
+    return lambda: main.process_blob('cold_start/0/')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold start cost of one function, in this interpreter")
+    parser.add_argument('function', choices=sorted(FUNCTION_DIRS))
+    parser.add_argument('--engine', default='records', help="process_document TRANSFORM_ENGINE")
+    parser.add_argument('--without', action='append', default=[], help="Package to treat as not installed")
+    parser.add_argument('--root', default=str(BENCH_DIR.parent), help="Repository checkout to load the function from")
+    args = parser.parse_args(argv)
+
+    if args.without:
+        sys.meta_path.insert(0, BlockImports(args.without))
+    sys.path.insert(0, str(Path(args.root) / FUNCTION_DIRS[args.function]))
+    result = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        import main as function
+        result['import_ms'] = (time.perf_counter() - start) * 1000
+        result['loaded_after_import'] = loaded()
+
+        start = time.perf_counter()
+        for name in CLIENT_LIBRARIES[args.function]:
+            __import__(name)
+        result['client_libraries_ms'] = (time.perf_counter() - start) * 1000
+
+        sys.path.append(str(BENCH_DIR))
+        if args.function == 'ingest':
+            call = first_ingest_call(function)
+        else:
+            call = first_process_call(function, args.engine)
+        start = time.perf_counter()
+        call()
+        result['first_call_ms'] = (time.perf_counter() - start) * 1000
+        result['loaded_after_first_call'] = loaded()
+    result['cold_start_ms'] = result['import_ms'] + result['client_libraries_ms'] + result['first_call_ms']
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
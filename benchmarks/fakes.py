@@ -0,0 +1,490 @@
+import io
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from google.api_core.exceptions import NotFound, PreconditionFailed, ServiceUnavailable
+
+from synthetic import synthetic_entities, synthetic_shards
+
+#---------------------------------------------------------------------------------------------------------------------
+######### In-process fakes for GCS, BigQuery, Pub/Sub and Document AI #########
+# Each fake implements only the client surface the pipeline code calls. Latency and errors are injected per call
+# through a Latency object; `calls` counts API calls by method so scenarios can report round trips.
+
+
+class Latency:
+    def __init__(self, mean=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.mean = mean
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            delay = max(0.0, self.mean + self._random.uniform(-self.jitter, self.jitter))
+            fail = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise ServiceUnavailable('injected error')
+
+
+class CallCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def count(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+
+def parse_gs_uri(uri):
+    bucket, _, name = uri[len('gs://'):].partition('/')
+    return bucket, name
+
+
+###------ Cloud Storage ------###
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        entry = bucket._objects.get(name)
+        self.generation = entry['generation'] if entry else None
+        self.size = len(entry['data']) if entry else None
+
+    def _entry(self):
+        entry = self.bucket._objects.get(self.name)
+        if entry is None:
+            raise NotFound(f'gs://{self.bucket.name}/{self.name}')
+        return entry
+
+    def download_as_bytes(self):
+        self.bucket.client._call('download')
+        return self._entry()['data']
+
+    download_as_string = download_as_bytes
+
+    def open(self, mode='rb', chunk_size=None):
+        return io.BytesIO(self.download_as_bytes())
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self.bucket.client._call('upload')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self.bucket._lock:
+            entry = self.bucket._objects.get(self.name)
+            if if_generation_match is not None and if_generation_match != (entry['generation'] if entry else 0):
+                raise PreconditionFailed(f'gs://{self.bucket.name}/{self.name}')
+            self.generation = next(self.bucket.client._generations)
+            self.size = len(data)
+            self.bucket._objects[self.name] = {'data': data, 'generation': self.generation, 'content_type': content_type}
+
+    def upload_from_file(self, file_obj, content_type=None, rewind=False):
+        if rewind:
+            file_obj.seek(0)
+        self.upload_from_string(file_obj.read(), content_type=content_type)
+
+    def delete(self):
+        self.bucket.client._call('delete')
+        with self.bucket._lock:
+            if self.bucket._objects.pop(self.name, None) is None:
+                raise NotFound(f'gs://{self.bucket.name}/{self.name}')
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def blob(self, name, **kwargs):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        self.client._call('get_blob')
+        return FakeBlob(self, name) if name in self._objects else None
+
+    def list_blobs(self, prefix=''):
+        self.client._call('list_blobs')
+        with self._lock:
+            names = sorted(name for name in self._objects if name.startswith(prefix))
+        return [FakeBlob(self, name) for name in names]
+
+    def copy_blob(self, blob, destination_bucket, new_name=None):
+        self.client._call('copy_blob')
+        entry = blob._entry()
+        copied = destination_bucket.blob(new_name or blob.name)
+        with destination_bucket._lock:
+            copied.generation = next(self.client._generations)
+            copied.size = len(entry['data'])
+            destination_bucket._objects[copied.name] = dict(entry, generation=copied.generation)
+        return copied
+
+    def put(self, name, data):
+        # Seeds an object without counting it as an API call
+        with self._lock:
+            self._objects[name] = {'data': data, 'generation': next(self.client._generations), 'content_type': None}
+
+
+class FakeStorageClient(CallCounter):
+    def __init__(self, latency=None):
+        super().__init__()
+        self.latency = latency or Latency()
+        self._buckets = {}
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _call(self, method):
+        self.count(method)
+        self.latency.wait()
+
+    def bucket(self, name):
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(self, name)
+            return self._buckets[name]
+
+    def get_bucket(self, name):
+        self._call('get_bucket')
+        return self.bucket(name)
+
+    def list_blobs(self, bucket_name, prefix=''):
+        return self.bucket(bucket_name).list_blobs(prefix=prefix)
+
+
+###------ BigQuery ------###
+
+class FakeLoadJob:
+    def __init__(self, latency):
+        self._done_at = time.monotonic() + max(0.0, latency.mean)
+        self._error = None
+        try:
+            latency.wait() if latency.error_rate else None
+        except ServiceUnavailable as e:
+            self._error = e
+
+    def result(self, timeout=None):
+        remaining = self._done_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        if self._error:
+            raise self._error
+        return self
+
+
+class FakeBigQueryClient(CallCounter):
+    def __init__(self, storage, latency=None):
+        super().__init__()
+        self.storage = storage
+        self.latency = latency or Latency()
+        self.rows = {}                                                  # table_id -> rows loaded
+        self._lock = threading.Lock()
+
+    def load_table_from_uri(self, uri, table_id, job_config=None):
+        self.count('load_table_from_uri')
+        bucket, name = parse_gs_uri(uri)
+        data = self.storage.bucket(bucket)._objects[name]['data']
+        if name.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            rows = pq.read_metadata(io.BytesIO(data)).num_rows
+        else:
+            rows = max(0, data.count(b'\n') - 1)
+        job = FakeLoadJob(self.latency)
+        if job._error is None:                                          # only rows of jobs that succeed count as loaded
+            with self._lock:
+                self.rows[table_id] = self.rows.get(table_id, 0) + rows
+        return job
+
+    def get_table(self, table_id):
+        self.count('get_table')
+        self.latency.wait()
+        return SimpleNamespace(num_rows=self.rows.get(table_id, 0))
+
+
+###------ Pub/Sub ------###
+
+class FakePublisherClient(CallCounter):
+    # Messages are grouped into batches (max_messages or max_latency) and each batch costs one simulated RPC, like
+    # the real client. Delivered messages are kept in `messages` and passed to `on_message` if given.
+    def __init__(self, latency=None, max_messages=100, max_latency=0.05, on_message=None):
+        super().__init__()
+        self.latency = latency or Latency()
+        self.max_messages = max_messages
+        self.max_latency = max_latency
+        self.on_message = on_message
+        self.messages = []
+        self._batch = []
+        self._batch_started = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Condition()
+        threading.Thread(target=self._run, name='fake-publisher', daemon=True).start()
+
+    def topic_path(self, project, topic):
+        return f'projects/{project}/topics/{topic}'
+
+    def publish(self, topic, data, ordering_key='', **attributes):
+        future = Future()
+        with self._lock:
+            if not self._batch:
+                self._batch_started = time.monotonic()
+            self._batch.append((topic, data, attributes, future))
+            self._lock.notify()
+        return future
+
+    def resume_publish(self, topic, ordering_key):
+        pass
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._batch or (len(self._batch) < self.max_messages
+                                          and time.monotonic() - self._batch_started < self.max_latency):
+                    self._lock.wait(self.max_latency if self._batch else None)
+                batch, self._batch = self._batch[:self.max_messages], self._batch[self.max_messages:]
+                self._batch_started = time.monotonic()
+            self.count('publish_rpc')
+            try:
+                self.latency.wait()
+            except ServiceUnavailable as e:
+                for *_, future in batch:
+                    future.set_exception(e)
+                continue
+            for topic, data, attributes, future in batch:
+                message_id = str(next(self._ids))
+                self.messages.append((data, attributes))
+                future.set_result(message_id)
+                if self.on_message:
+                    self.on_message(data, attributes)
+
+
+class FakeMessage:
+    def __init__(self, subscriber, subscription, data, attributes, message_id, delivery_attempt):
+        self._subscriber = subscriber
+        self._subscription = subscription
+        self.data = data
+        self.attributes = attributes
+        self.message_id = message_id
+        self.delivery_attempt = delivery_attempt
+        self.size = len(data)
+        self._settled = False
+
+    def ack(self):
+        self._subscriber._settle(self, acked=True)
+
+    def nack(self):
+        self._subscriber._settle(self, acked=False)
+
+    def modify_ack_deadline(self, seconds):
+        self._subscriber.count('modify_ack_deadline')
+
+
+class FakeStreamingPullFuture(Future):
+    def __init__(self):
+        super().__init__()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+        return True
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+class FakeSubscriberClient(CallCounter):
+    # Streaming pull over in-memory subscriptions. Messages are leased while FlowControl allows (outstanding messages
+    # and bytes, counted until ack or nack) and handed to the scheduler, like the real client. A nacked message goes
+    # back to the end of its subscription with delivery_attempt + 1. cancel() on the returned future stops leasing,
+    # shuts the scheduler down (waiting for running callbacks when await_callbacks_on_shutdown) and nacks whatever
+    # was leased but never started; result() returns once that is done. `stats` counts deliveries, acks, nacks and the
+    # most messages ever outstanding at once.
+    def __init__(self):
+        super().__init__()
+        self._subscriptions = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Condition()
+        self._outstanding = {}                                          # subscription -> [messages, bytes]
+        self.stats = {'delivered': 0, 'acked': 0, 'nacked': 0, 'redelivered': 0, 'max_outstanding': 0}
+        self.closed = False
+
+    def subscription_path(self, project, subscription):
+        return f'projects/{project}/subscriptions/{subscription}'
+
+    def put(self, subscription, data, **attributes):
+        # Test helper: a message published to the subscription's topic
+        with self._lock:
+            self._subscriptions.setdefault(subscription, []).append((data, attributes, str(next(self._ids)), 1))
+            self._lock.notify_all()
+
+    def backlog(self, subscription):
+        with self._lock:
+            return len(self._subscriptions.get(subscription, ()))
+
+    def subscribe(self, subscription, callback, flow_control=(), scheduler=None, await_callbacks_on_shutdown=False):
+        self.count('subscribe')
+        if scheduler is None:
+            from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+            scheduler = ThreadScheduler()
+        max_messages = getattr(flow_control, 'max_messages', 1000)
+        max_bytes = getattr(flow_control, 'max_bytes', 100 * 1024 * 1024)
+        future = FakeStreamingPullFuture()
+        threading.Thread(target=self._pull, name='fake-streaming-pull', daemon=True,
+                         args=(subscription, callback, max_messages, max_bytes, scheduler, await_callbacks_on_shutdown, future)).start()
+        return future
+
+    def _pull(self, subscription, callback, max_messages, max_bytes, scheduler, await_callbacks, future):
+        outstanding = self._outstanding.setdefault(subscription, [0, 0])
+        while not future.cancelled():
+            with self._lock:
+                pending = self._subscriptions.setdefault(subscription, [])
+                if not pending or outstanding[0] >= max_messages or (outstanding[0] and outstanding[1] + len(pending[0][0]) > max_bytes):
+                    self._lock.wait(0.05)
+                    continue
+                data, attributes, message_id, attempt = pending.pop(0)
+                outstanding[0] += 1
+                outstanding[1] += len(data)
+                self.stats['delivered'] += 1
+                self.stats['redelivered'] += attempt > 1
+                self.stats['max_outstanding'] = max(self.stats['max_outstanding'], outstanding[0])
+            scheduler.schedule(callback, FakeMessage(self, subscription, data, attributes, message_id, attempt))
+        for message in scheduler.shutdown(await_msg_callbacks=await_callbacks) or ():
+            message.nack()
+        future.set_result(True)
+
+    def _settle(self, message, acked):
+        with self._lock:
+            if message._settled:
+                return
+            message._settled = True
+            outstanding = self._outstanding[message._subscription]
+            outstanding[0] -= 1
+            outstanding[1] -= message.size
+            if acked:
+                self.stats['acked'] += 1
+            else:
+                self.stats['nacked'] += 1
+                self._subscriptions[message._subscription].append(
+                    (message.data, message.attributes, message.message_id, message.delivery_attempt + 1))
+            self._lock.notify_all()
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+###------ Document AI ------###
+
+_PAGE_OBJECT = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+
+
+def count_pages(content):
+    return max(1, len(_PAGE_OBJECT.findall(content))) if content.startswith(b'%PDF') else 1
+
+
+class FakeOperation:
+    def __init__(self, name, done_at, metadata):
+        self.operation = SimpleNamespace(name=name)
+        self._done_at = done_at
+        self.metadata = metadata
+
+    def done(self):
+        return time.monotonic() >= self._done_at
+
+    def result(self, timeout=None):
+        remaining = self._done_at - time.monotonic()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f'{self.operation.name} did not finish within {timeout}s')
+        if remaining > 0:
+            time.sleep(remaining)
+        return self
+
+
+class FakeDocumentAIClient(CallCounter):
+    # Online calls return a Document with synthetic entities after `online_latency`; batch calls write synthetic
+    # Document JSON shards for every input into the fake GCS output location and complete after `batch_latency`.
+    # Both also charge `page_latency` per page of the input (PDF page objects; other content counts as one page).
+    def __init__(self, storage=None, online_latency=None, batch_latency=None, line_items=10, pages=1, shards=1, page_latency=0.0):
+        super().__init__()
+        self.storage = storage
+        self.online_latency = online_latency or Latency()
+        self.batch_latency = batch_latency or Latency()
+        self.line_items = line_items
+        self.pages = pages
+        self.shards = shards
+        self.page_latency = page_latency
+        self._ids = itertools.count(1)
+        self._output = None                                             # generated once, so submit time is not generator time
+
+    def process_document(self, request=None):
+        self.count('process_document')
+        index = next(self._ids)
+        raw = (request or {}).get('raw_document') or (request or {}).get('document') or {}
+        self.online_latency.wait()
+        if self.page_latency:
+            time.sleep(self.page_latency * count_pages(raw.get('content', b'')))
+        from google.cloud import documentai_v1beta3 as documentai           # only when the online path is exercised
+        document = documentai.types.Document.from_json(json.dumps({'entities': synthetic_entities(index, line_items=self.line_items)}))
+        return SimpleNamespace(document=document)
+
+    def batch_process_documents(self, request):
+        self.count('batch_process_documents')
+        op_id = next(self._ids)
+        out_bucket, out_prefix = parse_gs_uri(request.output_config.gcs_destination)
+        statuses = []
+        if self._output is None:
+            self._output = synthetic_shards(0, shards=self.shards, line_items=self.line_items, pages=self.pages)
+        pages = 0
+        for i, input_config in enumerate(request.input_configs):
+            if self.page_latency:
+                in_bucket, in_name = parse_gs_uri(input_config.gcs_source)
+                entry = self.storage.bucket(in_bucket)._objects.get(in_name)
+                pages = max(pages, count_pages(entry['data'] if entry else b''))
+            directory = f'{out_prefix}{op_id}/{i}'
+            for k, shard in enumerate(self._output):
+                self.storage.bucket(out_bucket).put(f'{directory}/doc-{k}.json', shard)
+            statuses.append(SimpleNamespace(input_gcs_source=input_config.gcs_source, status=SimpleNamespace(code=0, message=''),
+                                            output_gcs_destination=f'gs://{out_bucket}/{directory}'))
+        metadata = SimpleNamespace(individual_process_statuses=statuses)
+        done_at = time.monotonic() + self.batch_latency.mean + self.page_latency * pages
+        return FakeOperation(f'projects/p/locations/us/operations/{op_id}', done_at, metadata)
+
+
+class FakeOperationsClient(CallCounter):
+    # Long-running operations polled by name, as OperationTracker sees them through get_operation / cancel_operation.
+    # Operations stay running until finish(name) completes them, with an error message when `error` is given.
+    def __init__(self):
+        super().__init__()
+        self._ids = itertools.count(1)
+        self._operations = {}
+
+    def start(self):
+        name = f'projects/p/locations/us/operations/{next(self._ids)}'
+        self._operations[name] = SimpleNamespace(done=False, error=None, metadata=None)
+        return name
+
+    def finish(self, name, error=None):
+        self._operations[name] = SimpleNamespace(done=True, error=SimpleNamespace(message=error) if error else None, metadata=None)
+
+    def get_operation(self, name):
+        self.count('get_operation')
+        return self._operations[name]
+
+    def cancel_operation(self, name):
+        self.count('cancel_operation')
+        self.finish(name, 'cancelled')
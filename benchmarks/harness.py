@@ -0,0 +1,155 @@
+import contextlib
+import importlib.util
+import io
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Benchmark harness #########
+# Loads the pipeline modules from their deploy directories, times pipeline stages by wrapping module-level functions,
+# and runs every scenario case in a fresh process so peak RSS belongs to that case alone.
+
+ROOT = Path(__file__).resolve().parent.parent
+FUNCTION_DIRS = {
+    'ingest': ROOT / 'managed_pipeline' / 'ingest_document',
+    'process': ROOT / 'managed_pipeline' / 'process_document',
+    'online': ROOT / 'small_file_onlineprocessing',
+}
+ENTRY_FILES = {'ingest': 'main.py', 'process': 'main.py', 'online': 'invoice_to_bq_smallfile.py'}
+
+_loaded = {}
+_siblings = {}
+
+
+def load_function(name):
+    # Each deploy directory imports its sibling modules by bare name (transform, staging, result_cache, ...), and
+    # several directories ship their own copy. Siblings cached from another directory are dropped before loading,
+    # so every entry module binds to the copies it is deployed with.
+    if name in _loaded:
+        return _loaded[name]
+    directory = FUNCTION_DIRS[name]
+    for path in directory.glob('*.py'):
+        sys.modules.pop(path.stem, None)
+    sys.path.insert(0, str(directory))
+    try:
+        spec = importlib.util.spec_from_file_location(f'bench_{name}', directory / ENTRY_FILES[name])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # Siblings the pipeline imports inside functions (lazily) are loaded now, while their directory is on sys.path
+        siblings = {path.stem: importlib.import_module(path.stem) for path in directory.glob('*.py') if path.name != ENTRY_FILES[name]}
+    finally:
+        sys.path.remove(str(directory))
+    _loaded[name] = module
+    _siblings[name] = siblings
+    return module
+
+
+def load_sibling(name, module_name):
+    # A module deployed next to a function's entry file, e.g. load_sibling('process', 'transform')
+    load_function(name)
+    return _siblings[name][module_name]
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+class StageTimer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def wrap(self, target, attr, stage=None):
+        # Replaces target.attr (target is a module, an object or a module's globals dict) with a timed wrapper
+        namespace = target if isinstance(target, dict) else None
+        original = namespace[attr] if namespace is not None else getattr(target, attr)
+        stage = stage or attr
+
+        def timed(*args, **kwargs):
+            with self.span(stage):
+                return original(*args, **kwargs)
+
+        if namespace is not None:
+            namespace[attr] = timed
+        else:
+            setattr(target, attr, timed)
+        return original
+
+    def summary(self):
+        return {stage: {'count': len(samples), 'p50_ms': percentile(samples, 50) * 1000,
+                        'p99_ms': percentile(samples, 99) * 1000, 'total_s': sum(samples)}
+                for stage, samples in self.samples.items()}
+
+
+def peak_rss_mb():
+    # VmHWM belongs to this process's address space; ru_maxrss would carry over the parent's peak across fork/exec
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024          # KiB on Linux
+
+
+def run_case(scenario_name, params, verbose=False):
+    from scenarios import SCENARIOS
+    function = SCENARIOS[scenario_name][0]
+    _loaded.clear()                                                     # every case patches a fresh copy of the modules
+    _siblings.clear()
+    timer = StageTimer()
+    baseline = peak_rss_mb()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    with output:
+        metrics = function(timer, **params)
+    elapsed = time.perf_counter() - start
+    return {'scenario': scenario_name, 'params': params, 'elapsed_s': elapsed, 'metrics': metrics,
+            'stages': timer.summary(), 'peak_rss_mb': peak_rss_mb(), 'baseline_rss_mb': baseline}
+
+
+def run_isolated(scenario_name, params, verbose=False):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(run_case, scenario_name, params, verbose).result()
+
+
+def format_result(result):
+    params = ' '.join(f'{key}={value}' for key, value in result['params'].items())
+    lines = [f"{result['scenario']} [{params}]  {result['elapsed_s']:.2f}s  "
+             f"peak RSS {result['peak_rss_mb']:.0f} MB (+{result['peak_rss_mb'] - result['baseline_rss_mb']:.0f} MB)"]
+    for key, value in result['metrics'].items():
+        lines.append(f"    {key:<28} {value:.3f}" if isinstance(value, float) else f"    {key:<28} {value}")
+    if result['stages']:
+        lines.append(f"    {'stage':<28} {'count':>8} {'p50 ms':>10} {'p99 ms':>10} {'total s':>10}")
+        for stage, stats in sorted(result['stages'].items(), key=lambda item: -item[1]['total_s']):
+            lines.append(f"    {stage:<28} {stats['count']:>8} {stats['p50_ms']:>10.2f} {stats['p99_ms']:>10.2f} {stats['total_s']:>10.2f}")
+    return '\n'.join(lines)
+
+
+def scratch_dir():
+    path = Path(os.environ.get('BENCH_SCRATCH', '/tmp/docai_bench'))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
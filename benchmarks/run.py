@@ -0,0 +1,47 @@
+import argparse
+import json
+import sys
+
+from harness import format_result, run_case, run_isolated
+from scenarios import SCENARIOS
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Offline benchmark runner #########
+# Runs pipeline scenarios against in-process fakes, no GCP project or credentials needed:
+#   python benchmarks/run.py                      every scenario, default cases
+#   python benchmarks/run.py managed parse        selected scenarios
+#   python benchmarks/run.py --quick --json out.json
+# Every case runs in its own process so its peak RSS is not inherited from earlier cases.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Document AI invoice pipelines")
+    parser.add_argument('scenarios', nargs='*', help=f"Scenarios to run (default: all): {', '.join(sorted(SCENARIOS))}")
+    parser.add_argument('--quick', action='store_true', help="Smaller cases, for a fast before/after check")
+    parser.add_argument('--json', help="Also write every result to this file")
+    parser.add_argument('--in-process', action='store_true', help="Run cases in this process (peak RSS is then cumulative)")
+    parser.add_argument('--verbose', action='store_true', help="Keep the pipeline's own progress output")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    results = []
+    for name in args.scenarios or sorted(SCENARIOS):
+        function, full, quick, prepare = SCENARIOS[name]
+        for params in (quick if args.quick else full):
+            if prepare:
+                prepare(**params)
+            run = run_case if args.in_process else run_isolated
+            result = run(name, params, args.verbose)
+            results.append(result)
+            print(format_result(result), flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
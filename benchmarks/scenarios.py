@@ -0,0 +1,501 @@
+import base64
+import gc
+import hashlib
+import io
+import json
+import os
+import queue
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+import pandas as pd
+
+from fakes import (FakeBigQueryClient, FakeDocumentAIClient, FakePublisherClient, FakeStorageClient, FakeSubscriberClient,
+                   Latency)
+from harness import load_function, load_sibling, scratch_dir
+from synthetic import synthetic_entities, synthetic_pdf, synthetic_shards
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Scenarios #########
+# Each scenario is a function (timer, **params) -> metrics dict, registered with the cases it runs by default and in
+# --quick mode. `prepare(**params)` runs in the parent process before the case is spawned, for inputs whose
+# generation would otherwise dominate the case's peak RSS.
+
+SCENARIOS = {}
+
+
+def scenario(full, quick=None, prepare=None):
+    def register(function):
+        SCENARIOS[function.__name__] = (function, full, quick if quick is not None else full, prepare)
+        return function
+    return register
+
+
+###------ Shared setup ------###
+
+def gcs_event(bucket, name, data):
+    return {'bucket': bucket, 'name': name, 'metageneration': '1', 'size': str(len(data)),
+            'timeCreated': '2021-05-01T00:00:00.000Z', 'updated': '2021-05-01T00:00:00.000Z',
+            'md5Hash': base64.b64encode(hashlib.md5(data).digest()).decode('ascii')}
+
+
+def event_context(i):
+    return SimpleNamespace(event_id=str(i), event_type='google.storage.object.finalize', timestamp='', resource={'name': ''})
+
+
+def setup_ingest(storage, docai, publisher, window=0.0, max_batch=50):
+    ingest = load_function('ingest')
+    ingest._clients.update(storage=storage, documentai=docai, pubsub_publisher=publisher)
+    ingest.RESULT_CACHE_ENABLED = False
+    ingest.ROUTING_ENABLED = False                                      # scenarios that measure routing turn it on
+    ingest.COALESCE_WINDOW = window
+    ingest.COALESCE_MAX_BATCH = max_batch
+    return ingest
+
+
+def setup_process(storage, bq):
+    process = load_function('process')
+    process._clients.update(storage=storage, bigquery=bq)
+    process.RESULT_CACHE_ENABLED = False
+    return process
+
+
+def docparse_globals(process):
+    # process_document imports from docparse by name; its module globals are reachable through any of its functions
+    return process.prefetch_entities.__globals__
+
+
+def capture_spans(timer, module):
+    # Feeds the pipeline's own telemetry spans (see telemetry.py) into the stage timer
+    def export(record):
+        if 'stage' in record:
+            timer.record(record['stage'], record['duration_ms'] / 1000)
+    module.telemetry.configure(export)
+
+
+def entity_records(process, entities):
+    return [docparse_globals(process)['_record_from_json'](entity) for entity in entities]
+
+
+###------ Pipelines ------###
+
+@scenario(full=[{'docs': 64, 'concurrency': c} for c in (1, 4, 16)] + [{'docs': 64, 'concurrency': 16, 'error_rate': 0.05}],
+          quick=[{'docs': 16, 'concurrency': c} for c in (1, 8)])
+def online(timer, docs, concurrency, latency=0.2, qps=100, error_rate=0.0):
+    # Small-file online path: process_document per file on a thread pool against a stub processor, then one
+    # transform and one load per table
+    online = load_function('online')
+    storage = FakeStorageClient()
+    bq = FakeBigQueryClient(storage)
+    online.storage = SimpleNamespace(Client=lambda: storage)
+    online.bigquery = SimpleNamespace(Client=lambda: bq)
+    online.result_cache_enabled = False
+    docai = FakeDocumentAIClient(online_latency=Latency(latency, latency / 4, error_rate), line_items=10)
+
+    directory = scratch_dir() / 'online'
+    directory.mkdir(exist_ok=True)
+    paths = []
+    for i in range(docs):
+        path = directory / f'invoice-{i:05d}.pdf'
+        path.write_bytes(os.urandom(20000))
+        paths.append(str(path))
+
+    for name in ('process_file', 'entities_to_frame', 'transform_invoices', 'extract_line_items', 'upload_pd_to_gcs', 'load_file_to_bq'):
+        timer.wrap(online, name)
+    start = time.perf_counter()
+    documents, failed = online.process_invoices(paths, concurrency, qps, client=docai, cache=None)
+    elapsed = time.perf_counter() - start
+    return {'docs_per_s': len(documents) / elapsed, 'failed': len(failed), 'processor_calls': docai.calls.get('process_document', 0),
+            'rows_loaded': sum(bq.rows.values())}
+
+
+@scenario(full=[{'shards': 16, 'workers': w} for w in (1, 4, 8)],
+          quick=[{'shards': 8, 'workers': w} for w in (1, 4)])
+def batch(timer, shards, workers, read_latency=0.05, pages_per_shard=5, line_items=400):
+    # One large batch output (many shards under one prefix) through process_blob with injected GCS read latency
+    storage = FakeStorageClient(Latency(read_latency, read_latency / 4))
+    bq = FakeBigQueryClient(storage)
+    process = setup_process(storage, bq)
+    process.SHARD_WORKERS = workers
+    for k, shard in enumerate(synthetic_shards(1, shards, line_items, shards * pages_per_shard)):
+        storage.bucket(process.gcs_output_bucket).put(f'bench_output/0/doc-{k}.json', shard)
+
+    capture_spans(timer, process)
+    start = time.perf_counter()
+    process.process_blob('bench_output/0/')
+    elapsed = time.perf_counter() - start
+    return {'shards_per_s': shards / elapsed, 'rows_loaded': sum(bq.rows.values()),
+            'load_jobs': bq.calls.get('load_table_from_uri', 0), 'storage_calls': sum(storage.calls.values())}
+
+
+@scenario(full=[{'docs': 100, 'concurrency': 1, 'window': 0.0}, {'docs': 100, 'concurrency': 50, 'window': 0.5},
+                {'docs': 500, 'concurrency': 500, 'window': 1.0}],
+          quick=[{'docs': 20, 'concurrency': 1, 'window': 0.0}, {'docs': 50, 'concurrency': 50, 'window': 0.5}])
+def managed(timer, docs, concurrency, window, batch_latency=0.5, bq_latency=0.2, storage_latency=0.005, process_workers=4):
+    # End to end: upload events -> ingest_document (coalescer, batch request) -> Pub/Sub -> process_blob -> BigQuery.
+    # `concurrency` events are in flight at once, as on an instance with that request concurrency.
+    storage = FakeStorageClient(Latency(storage_latency, storage_latency / 2))
+    bq = FakeBigQueryClient(storage, Latency(bq_latency))
+    docai = FakeDocumentAIClient(storage, batch_latency=Latency(batch_latency), line_items=20, pages=2)
+    delivered = queue.Queue()
+    publisher = FakePublisherClient(Latency(0.01), on_message=lambda data, attributes: delivered.put((data, attributes)))
+    ingest = setup_ingest(storage, docai, publisher, window)
+    process = setup_process(storage, bq)
+
+    capture_spans(timer, ingest)
+    capture_spans(timer, process)
+
+    submitted = {}
+    finished = threading.Semaphore(0)
+    errors = []
+
+    def consume():
+        while True:
+            data, attributes = delivered.get()
+            try:
+                process.process_blob(data.decode('utf-8'), attributes.get('cache_key'))
+                name = re.search(r'invoice-\d+', attributes['source']).group(0)
+                timer.record('end_to_end', time.perf_counter() - submitted[name])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                finished.release()
+
+    for _ in range(process_workers):
+        threading.Thread(target=consume, daemon=True).start()
+
+    events = []
+    for i in range(docs):
+        data = os.urandom(20000)
+        storage.bucket(ingest.gcs_input_bucket).put(f'invoice-{i:05d}.pdf', data)
+        events.append(gcs_event(ingest.gcs_input_bucket, f'invoice-{i:05d}.pdf', data))
+
+    def upload(i):
+        submitted[f'invoice-{i:05d}'] = time.perf_counter()
+        ingest.ingest_document(events[i], event_context(i))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(upload, range(docs)))
+    for _ in range(docs):
+        if not finished.acquire(timeout=120):
+            break
+    elapsed = time.perf_counter() - start
+    coalescer = ingest.get_ingest_coalescer().stats
+    return {'docs_per_s': docs / elapsed, 'batch_requests': docai.calls.get('batch_process_documents', 0),
+            'mean_coalesce_wait_s': coalescer['total_latency'] / max(1, coalescer['documents']),
+            'publish_rpcs': publisher.calls.get('publish_rpc', 0), 'load_jobs': bq.calls.get('load_table_from_uri', 0),
+            'rows_loaded': sum(bq.rows.values()), 'storage_calls_per_doc': sum(storage.calls.values()) / docs,
+            'process_errors': len(errors)}
+
+
+@scenario(full=[{'docs': 200, 'concurrency': c} for c in (1, 8, 32)] + [{'docs': 200, 'concurrency': 8, 'failure_rate': 0.1},
+                                                                       {'docs': 200, 'concurrency': 8, 'max_messages': 8, 'load_error_rate': 0.3}],
+          quick=[{'docs': 40, 'concurrency': c} for c in (1, 8)] + [{'docs': 40, 'concurrency': 8, 'failure_rate': 0.1},
+                                                                    {'docs': 40, 'concurrency': 8, 'max_messages': 8, 'load_error_rate': 0.3}])
+def worker(timer, docs, concurrency, max_messages=None, failure_rate=0.0, load_error_rate=0.0, bq_latency=0.2, storage_latency=0.005):
+    # Pull worker (run_worker) draining `docs` queued messages, one document output each, through process_blob and
+    # BigQuery. failure_rate fails that share of deliveries before any rows are added; load_error_rate fails that share
+    # of load jobs, i.e. inside the shared flush. Failed messages are nacked and redelivered. The worker is stopped once
+    # every message is acked; none may be left leased, and duplicate_rows counts rows loaded more than once. Leased
+    # messages wait for a shared flush, so max_messages (WORKER_MAX_MESSAGES) also caps the documents per flush.
+    storage = FakeStorageClient(Latency(storage_latency, storage_latency / 2))
+    bq = FakeBigQueryClient(storage, Latency(bq_latency, error_rate=load_error_rate))
+    subscriber = FakeSubscriberClient()
+    process = setup_process(storage, bq)
+    process._clients['pubsub_subscriber'] = subscriber
+    process.WORKER_CONCURRENCY = concurrency
+    process.WORKER_MAX_MESSAGES = max_messages or process.WORKER_MAX_MESSAGES
+    capture_spans(timer, process)
+
+    path = subscriber.subscription_path(process.project_id, process.subscription_id)
+    shard = synthetic_shards(0, line_items=10)[0]
+    for i in range(docs):
+        storage.bucket(process.gcs_output_bucket).put(f'worker/{i}/0/doc-0.json', shard)
+        subscriber.put(path, f'worker/{i}/0/'.encode('utf-8'), source=f'gs://bench/invoice-{i:05d}.pdf')
+
+    rng = random.Random(0)
+    process_blob = process.process_blob
+    def flaky_process_blob(blob_name, cache_key=None, **kwargs):
+        if rng.random() < failure_rate:
+            raise RuntimeError('injected handler failure')
+        return process_blob(blob_name, cache_key, **kwargs)
+    process.process_blob = flaky_process_blob
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=process.run_worker, name='run-worker')
+    thread.start()
+    deadline = start + 300
+    while subscriber.stats['acked'] < docs and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    with timer.span('shutdown'):
+        process.get_pull_worker().stop()
+        thread.join(60)
+    worker_stats = process.get_pull_worker().stats
+    rows_loaded = sum(bq.rows.values())
+    return {'docs_per_s': docs / elapsed, 'acked': subscriber.stats['acked'], 'nacked': subscriber.stats['nacked'],
+            'redelivered': subscriber.stats['redelivered'], 'max_outstanding': subscriber.stats['max_outstanding'],
+            'max_running': worker_stats['max_running'], 'left_leased': sum(n for n, _ in subscriber._outstanding.values()),
+            'load_jobs': bq.calls.get('load_table_from_uri', 0), 'rows_loaded': rows_loaded,
+            'duplicate_rows': rows_loaded - docs * 11, 'subscriber_closed': subscriber.closed}
+
+
+@scenario(full=[{'pages': p, 'mode': m} for p in (1, 10, 500) for m in ('routed', 'batch')],
+          quick=[{'pages': p, 'mode': m} for p in (1, 10, 100) for m in ('routed', 'batch')])
+def routing(timer, pages, mode, online_latency=0.3, batch_latency=3.0, page_latency=0.01, split_max_pages=1000):
+    # Upload to loaded rows for one document of `pages` pages: size-aware routing (online, or page-range shards
+    # processed online in parallel) vs. always batch. Each processor request costs its fixed latency plus
+    # page_latency per page; split_max_pages is raised so the 500-page case is split rather than batched.
+    storage = FakeStorageClient()
+    bq = FakeBigQueryClient(storage)
+    docai = FakeDocumentAIClient(storage, online_latency=Latency(online_latency), batch_latency=Latency(batch_latency),
+                                 page_latency=page_latency, line_items=10)
+    delivered = []
+    publisher = FakePublisherClient(max_latency=0.0, on_message=lambda data, attributes: delivered.append((data, attributes)))
+    ingest = setup_ingest(storage, docai, publisher)
+    ingest.ROUTING_ENABLED = mode == 'routed'
+    ingest.SPLIT_MAX_PAGES = split_max_pages
+    process = setup_process(storage, bq)
+    capture_spans(timer, ingest)
+    capture_spans(timer, process)
+
+    data = synthetic_pdf(pages)
+    storage.bucket(ingest.gcs_input_bucket).put('invoice.pdf', data)
+    start = time.perf_counter()
+    ingest.ingest_document(gcs_event(ingest.gcs_input_bucket, 'invoice.pdf', data), event_context(0))
+    for message, attributes in delivered:
+        process.process_blob(message.decode('utf-8'), attributes.get('cache_key'))
+    elapsed = time.perf_counter() - start
+    timer.record('end_to_end', elapsed)
+    return {'latency_s': elapsed, 'online_requests': docai.calls.get('process_document', 0),
+            'batch_requests': docai.calls.get('batch_process_documents', 0), 'input_bytes': len(data),
+            'invoice_rows': bq.rows.get(f'{process.project_id}.{process.bq_dataset}.{process.invoice_table}', 0)}
+
+
+@scenario(full=[{'function': 'ingest'}] + [{'function': 'process', 'engine': e} for e in ('pandas', 'records')]
+          + [{'function': 'process', 'engine': 'records', 'without': 'pandas'}])
+def cold_start(timer, function, engine='records', without=None, runs=5):
+    # Module import, client library imports and first invocation in fresh interpreters (benchmarks/coldstart.py):
+    # what a new function instance pays before its first result. without='pandas' measures a deployment that does
+    # not install pandas, which google-cloud-bigquery otherwise imports whenever it is present.
+    command = [sys.executable, str(Path(__file__).with_name('coldstart.py')), function, '--engine', engine]
+    if without:
+        command += ['--without', without]
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+        for stage in ('import', 'client_libraries', 'first_call', 'cold_start'):
+            timer.record(stage, samples[-1][f'{stage}_ms'] / 1000)
+    return {'cold_start_ms': statistics.median(sample['cold_start_ms'] for sample in samples),
+            'import_ms': statistics.median(sample['import_ms'] for sample in samples),
+            'loaded_after_import': ', '.join(samples[-1]['loaded_after_import']) or '-',
+            'loaded_after_first_call': ', '.join(samples[-1]['loaded_after_first_call'])}
+
+
+###------ Stages ------###
+
+@scenario(full=[{'objects': n} for n in (1000, 100000)], quick=[{'objects': n} for n in (1000, 10000)])
+def ingest_lookup(timer, objects, events=200):
+    # Per-event ingest cost against an input bucket already holding `objects` objects
+    storage = FakeStorageClient()
+    docai = FakeDocumentAIClient(storage)
+    ingest = setup_ingest(storage, docai, FakePublisherClient(max_latency=0.0))
+    bucket = storage.bucket(ingest.gcs_input_bucket)
+    for i in range(objects):
+        bucket.put(f'backlog/{i:07d}.pdf', b'%PDF-1.4')
+
+    capture_spans(timer, ingest)
+    for i in range(events):
+        data = os.urandom(2000)
+        bucket.put(f'invoice-{i:05d}.pdf', data)
+        ingest.ingest_document(gcs_event(ingest.gcs_input_bucket, f'invoice-{i:05d}.pdf', data), event_context(i))
+    return {'storage_calls_per_event': sum(storage.calls.values()) / events, 'list_calls': storage.calls.get('list_blobs', 0)}
+
+
+def shard_path(pages, line_items):
+    return scratch_dir() / f'shard_p{pages}_l{line_items}.json'
+
+
+def prepare_shard(pages, mode, line_items=50):
+    path = shard_path(pages, line_items)
+    if not path.exists():
+        path.write_bytes(synthetic_shards(1, 1, line_items, pages)[0])
+
+
+@scenario(full=[{'pages': p, 'mode': m} for p in (10, 100, 500) for m in ('stream', 'proto')],
+          quick=[{'pages': p, 'mode': m} for p in (10, 100) for m in ('stream', 'proto')], prepare=prepare_shard)
+def parse(timer, pages, mode, line_items=50):
+    # Streaming entity extraction vs. the full Document proto for one shard of `pages` pages
+    docparse = docparse_globals(load_function('process'))
+    shard = shard_path(pages, line_items).read_bytes()
+    gc.collect()
+    with timer.span(f'parse_{mode}'):
+        if mode == 'stream':
+            entities = list(docparse['iter_entities_from_stream'](io.BytesIO(shard)))
+        else:
+            entities = list(docparse['iter_entities_from_bytes'](shard))
+    return {'shard_mb': len(shard) / 2 ** 20, 'entities': len(entities)}
+
+
+@scenario(full=[{'docs': n, 'engine': e} for n in (1, 100, 10000) for e in ('pandas', 'records')],
+          quick=[{'docs': n, 'engine': e} for n in (1, 100, 1000) for e in ('pandas', 'records')])
+def transform(timer, docs, engine, line_items=10):
+    # pandas transforms every document in one frame; records (process_document's default) one document at a time
+    process = load_function('process')
+    documents = [(f'doc-{i}', entity_records(process, synthetic_entities(i, line_items))) for i in range(docs)]
+    if engine == 'records':
+        records = load_sibling('process', 'records')
+        invoices, items, rejects = [], [], []
+        with timer.span('transform_document'):
+            for _, entities in documents:
+                invoice, invoice_rejects, document_items, document_rejects = records.transform_document(entities)
+                invoices.append(invoice)
+                rejects.extend(invoice_rejects)
+                items.extend(document_items)
+                rejects.extend(document_rejects)
+    else:
+        transform = load_sibling('process', 'transform')
+        with timer.span('entities_to_frame'):
+            df = transform.entities_to_frame(documents)
+        with timer.span('transform_invoices'):
+            invoices, invoice_rejects = transform.transform_invoices(df)
+        with timer.span('extract_line_items'):
+            items, rejects = transform.extract_line_items(df, invoices['invoice_id'])
+        rejects = [*invoice_rejects.to_dict('records'), *rejects.to_dict('records')]
+    total = sum(sum(samples) for samples in timer.samples.values())
+    return {'docs_per_s': docs / total, 'invoice_rows': len(invoices), 'line_item_rows': len(items), 'rejects': len(rejects)}
+
+
+@scenario(full=[{'items': 1000000, 'properties': False}, {'items': 200000, 'properties': True}],
+          quick=[{'items': 100000, 'properties': False}, {'items': 20000, 'properties': True}])
+def line_items(timer, items, properties, items_per_doc=100):
+    # Line item extraction at volume: text rows go through split_line_item, property rows through the pivot
+    process = load_function('process')
+    transform = load_sibling('process', 'transform')
+    documents = [(f'doc-{i}', entity_records(process, synthetic_entities(i, items_per_doc, with_properties=properties)))
+                 for i in range(items // items_per_doc)]
+    df = transform.entities_to_frame(documents)
+    del documents
+    invoice_ids = transform.transform_invoices(df)[0]['invoice_id']
+    with timer.span('extract_line_items'):
+        parsed, rejects = transform.extract_line_items(df, invoice_ids)
+    return {'items_per_s': items / sum(timer.samples['extract_line_items']), 'rows': len(parsed), 'rejects': len(rejects)}
+
+
+@scenario(full=[{'rows': 1000000, 'fmt': f} for f in ('parquet', 'csv')],
+          quick=[{'rows': 100000, 'fmt': f} for f in ('parquet', 'csv')])
+def staging(timer, rows, fmt):
+    # Staged file size and serialize/upload/load time for inventory rows. The fake load job only reads the row count,
+    # so BigQuery-side parse cost shows up as file size, not time.
+    process = load_function('process')
+    rng = random.Random(0)
+    frame = pd.DataFrame({
+        'invoice_id': [f'INV-{i // 10:08d}' for i in range(rows)],
+        'item_description': [rng.choice(['Widget', 'Gadget, large', 'Service fee', 'Cable 2m']) for _ in range(rows)],
+        'item_quantity': [float(rng.randint(1, 50)) for _ in range(rows)],
+        'item_unit_price': [rng.randint(100, 50000) / 100 for _ in range(rows)],
+        'item_total': [rng.randint(100, 500000) / 100 for _ in range(rows)],
+    })
+    storage = FakeStorageClient()
+    bq = FakeBigQueryClient(storage)
+    name = f'inventory{process.file_extension(fmt)}'
+    with timer.span('serialize'):
+        buffer, content_type = process.serialize_frame(frame, process.inventory_schema, fmt)
+    size = buffer.getbuffer().nbytes
+    with timer.span('upload'):
+        storage.bucket('staging').blob(name).upload_from_file(buffer, content_type=content_type)
+    with timer.span('load'):
+        bq.load_table_from_uri(f'gs://staging/{name}', 'bench.inventory', job_config=process.load_job_config(process.inventory_schema, fmt)).result()
+    return {'file_mb': size / 2 ** 20, 'bytes_per_row': size / rows, 'rows_loaded': bq.rows['bench.inventory']}
+
+
+@scenario(full=[{'docs': 200, 'concurrency': c} for c in (1, 4, 16)], quick=[{'docs': 50, 'concurrency': c} for c in (1, 16)])
+def sink(timer, docs, concurrency, bq_latency=0.2):
+    # process_blob on `concurrency` threads, as on an instance serving that many requests at once. Documents in flight
+    # together share a flush; one at a time, every document gets its own staged file and load job per table.
+    storage = FakeStorageClient()
+    bq = FakeBigQueryClient(storage, Latency(bq_latency))
+    process = setup_process(storage, bq)
+    capture_spans(timer, process)
+    timer.wrap(process.get_bq_sink(), 'flush', 'sink_flush')
+    shard = synthetic_shards(0, line_items=10)[0]
+    for i in range(docs):
+        storage.bucket(process.gcs_output_bucket).put(f'sink/{i}/0/doc-0.json', shard)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda i: process.process_blob(f'sink/{i}/0/'), range(docs)))
+    elapsed = time.perf_counter() - start
+    load_jobs = bq.calls.get('load_table_from_uri', 0)
+    return {'docs_per_s': docs / elapsed, 'load_jobs': load_jobs, 'load_jobs_per_doc': load_jobs / docs,
+            'staged_files': storage.calls.get('upload', 0), 'rows_loaded': sum(bq.rows.values())}
+
+
+@scenario(full=[{'messages': 500, 'mode': m} for m in ('serial', 'batched')],
+          quick=[{'messages': 100, 'mode': m} for m in ('serial', 'batched')])
+def publish(timer, messages, mode, rpc_latency=0.02):
+    # serial publishes and waits for one message at a time; batched queues them all and gathers the futures once
+    ingest = load_function('ingest')
+    publisher = FakePublisherClient(Latency(rpc_latency), ingest.PUBLISH_MAX_MESSAGES, ingest.PUBLISH_MAX_LATENCY)
+    ingest._clients['pubsub_publisher'] = publisher
+    payload = [(f'docai_ingest_temp_output_{i}/0/', {'source': f'gs://bench/invoice-{i:05d}.pdf'}) for i in range(messages)]
+    start = time.perf_counter()
+    if mode == 'serial':
+        results = []
+        for message in payload:
+            with timer.span('publish_one'):
+                results.extend(ingest.publish_messages(ingest.project_id, ingest.pubsub_topic, [message]))
+    else:
+        with timer.span('publish_all'):
+            results = ingest.publish_messages(ingest.project_id, ingest.pubsub_topic, payload)
+    elapsed = time.perf_counter() - start
+    return {'messages_per_s': messages / elapsed, 'publish_rpcs': publisher.calls.get('publish_rpc', 0),
+            'failed': sum(isinstance(result, Exception) for result in results)}
+
+
+@scenario(full=[{'operations': n} for n in (100, 1000)], quick=[{'operations': 100}])
+def lro(timer, operations, failure_rate=0.1, duration=600, poll_interval=60):
+    # Operation tracker draining `operations` tracked batches on a simulated clock; each operation finishes after up to
+    # `duration` simulated seconds and fails (and is resubmitted) with probability failure_rate
+    storage = FakeStorageClient()
+    clock = [0.0]
+    rng = random.Random(0)
+    ops = {}
+    completed, failed = [], []
+
+    def start_operation():
+        name = f'operations/{len(ops)}'
+        ops[name] = (clock[0] + rng.uniform(0.2, 1.0) * duration, rng.random() < failure_rate)
+        return name
+
+    def get_operation(name):
+        done_at, fails = ops[name]
+        done = clock[0] >= done_at
+        return SimpleNamespace(done=done, error=SimpleNamespace(message='injected failure') if done and fails else None, metadata=None)
+
+    tracker = load_sibling('ingest', 'operations').OperationTracker(
+        storage.bucket('bench_state'), 'docai_operations/', get_operation, lambda name: None,
+        lambda record: {'operation': start_operation()}, lambda record, operation: completed.append(record['key']),
+        lambda record, reason: failed.append(record['key']), timeout=2 * duration, clock=lambda: clock[0])
+    for i in range(operations):
+        tracker.track(f'batch-{i}', start_operation(), sources=[f'gs://bench/invoice-{i:05d}.pdf'])
+
+    depths = []
+    while clock[0] < 20 * duration:
+        clock[0] += poll_interval
+        with timer.span('poll'):
+            tracker.poll()
+        depths.append(tracker.metrics()['queue_depth'])
+        if not depths[-1]:
+            break
+    return {'completed': len(completed), 'failed': len(failed), 'retried': tracker.stats['retried'], 'polls': len(depths),
+            'simulated_drain_s': clock[0], 'storage_calls_per_operation': sum(storage.calls.values()) / operations}
@@ -0,0 +1,120 @@
+import io
+import json
+import random
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Synthetic Document AI invoice output #########
+# Builds Document JSON shaped like the invoice parser's batch output (camelCase fields, text, pages with tokens and
+# layout, entities with line item properties). The number of line items, pages, tokens per page and output shards are
+# all parameters, so parse and transform cost can be measured without calling the processor. Output is deterministic
+# for a given document index and seed.
+
+TOKENS_PER_PAGE = 400                                                   # Roughly a dense invoice page
+
+header_fields = {
+    'invoice_id': lambda rng, index: f'INV-{index:08d}',
+    'invoice_date': lambda rng, index: f'2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+    'due_date': lambda rng, index: f'2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+    'purchase_order': lambda rng, index: f'PO-{rng.randint(1000, 99999)}',
+    'supplier_name': lambda rng, index: rng.choice(['Acme Supplies', 'Globex Corp', 'Initech LLC', 'Umbrella Ltd']),
+    'receiver_tax_id': lambda rng, index: f'{rng.randint(10, 99)}-{rng.randint(1000000, 9999999)}',
+    'receiver_name': lambda rng, index: rng.choice(['Stark Industries, Inc.', 'Wayne Enterprises', 'Hooli, LLC']),
+    'receiver_address': lambda rng, index: f'{rng.randint(1, 9999)} Main St\nSpringfield, CA {rng.randint(90000, 96199)}',
+    'total_amount': lambda rng, index: f'${rng.randint(100, 99999):,}.{rng.randint(0, 99):02d}',
+    'total_tax_amount': lambda rng, index: f'${rng.randint(1, 999)}.{rng.randint(0, 99):02d}',
+    'net_amount': lambda rng, index: f'${rng.randint(100, 99999):,}.{rng.randint(0, 99):02d}',
+    'freight_amount': lambda rng, index: f'${rng.randint(0, 99)}.{rng.randint(0, 99):02d}',
+}
+
+
+def _entity(type_, mention_text, confidence, properties=None):
+    entity = {'type': type_, 'mentionText': mention_text, 'confidence': confidence}
+    if properties:
+        entity['properties'] = properties
+    return entity
+
+
+def synthetic_line_item(rng, with_properties=True):
+    description = rng.choice(['Widget', 'Gadget, large', 'Service fee', 'Cable 2m', 'Support plan (annual)'])
+    quantity = rng.randint(1, 50)
+    unit_price = rng.randint(1, 500) + rng.randint(0, 99) / 100
+    amount = f'{quantity * unit_price:,.2f}'
+    text = f'{description} {quantity} ${unit_price:.2f} ${amount}'
+    properties = None
+    if with_properties:
+        properties = [
+            _entity('line_item/description', description, round(rng.uniform(0.8, 1.0), 4)),
+            _entity('line_item/quantity', str(quantity), round(rng.uniform(0.8, 1.0), 4)),
+            _entity('line_item/unit_price', f'{unit_price:.2f}', round(rng.uniform(0.8, 1.0), 4)),
+            _entity('line_item/amount', amount, round(rng.uniform(0.8, 1.0), 4)),
+        ]
+    return _entity('line_item', text, round(rng.uniform(0.7, 1.0), 4), properties)
+
+
+def synthetic_entities(index, line_items=10, with_properties=True, seed=0):
+    rng = random.Random(f'{seed}-{index}')
+    entities = [_entity(type_, make(rng, index), round(rng.uniform(0.5, 1.0), 4)) for type_, make in header_fields.items()]
+    entities.extend(synthetic_line_item(rng, with_properties) for _ in range(line_items))
+    return entities
+
+
+def synthetic_page(rng, page_number, text_offset, tokens=TOKENS_PER_PAGE):
+    page_tokens = []
+    for t in range(tokens):
+        x, y = (t % 20) / 20, (t // 20) / (tokens // 20 + 1)
+        page_tokens.append({
+            'layout': {
+                'textAnchor': {'textSegments': [{'startIndex': str(text_offset + t * 8), 'endIndex': str(text_offset + t * 8 + 7)}]},
+                'confidence': round(rng.uniform(0.9, 1.0), 4),
+                'boundingPoly': {'normalizedVertices': [{'x': x, 'y': y}, {'x': x + 0.04, 'y': y},
+                                                        {'x': x + 0.04, 'y': y + 0.01}, {'x': x, 'y': y + 0.01}]},
+                'orientation': 'PAGE_UP',
+            },
+        })
+    return {
+        'pageNumber': page_number,
+        'dimension': {'width': 1700, 'height': 2200, 'unit': 'pixels'},
+        'layout': {'textAnchor': {'textSegments': [{'startIndex': str(text_offset), 'endIndex': str(text_offset + tokens * 8)}]}},
+        'tokens': page_tokens,
+    }
+
+
+def synthetic_document(index, line_items=10, pages=1, tokens_per_page=TOKENS_PER_PAGE, with_properties=True, seed=0):
+    rng = random.Random(f'{seed}-{index}-pages')
+    page_text = 'lorem01 ' * tokens_per_page
+    return {
+        'mimeType': 'application/pdf',
+        'text': page_text * pages,
+        'pages': [synthetic_page(rng, n + 1, n * len(page_text), tokens_per_page) for n in range(pages)],
+        'entities': synthetic_entities(index, line_items, with_properties, seed),
+    }
+
+
+def synthetic_shards(index, shards=1, line_items=10, pages=1, tokens_per_page=TOKENS_PER_PAGE, with_properties=True, seed=0):
+    # The processor splits large outputs into shards of consecutive pages; header entities go with the first shard and
+    # line items are spread across shards. Returns a list of JSON bytes, one per shard.
+    document = synthetic_document(index, line_items, pages, tokens_per_page, with_properties, seed)
+    shards = max(1, min(shards, pages))
+    pages_per_shard = -(-pages // shards)
+    header = [entity for entity in document['entities'] if entity['type'] != 'line_item']
+    items = [entity for entity in document['entities'] if entity['type'] == 'line_item']
+    items_per_shard = -(-len(items) // shards) if items else 0
+    output = []
+    for s in range(shards):
+        shard = dict(document, pages=document['pages'][s * pages_per_shard:(s + 1) * pages_per_shard])
+        shard['text'] = document['text'][:len(shard['pages']) * tokens_per_page * 8]
+        shard['shardInfo'] = {'shardIndex': str(s), 'shardCount': str(shards)}
+        shard['entities'] = (header if s == 0 else []) + items[s * items_per_shard:(s + 1) * items_per_shard]
+        output.append(json.dumps(shard).encode('utf-8'))
+    return output
+
+
+def synthetic_pdf(pages):
+    # A PDF with `pages` blank pages, for inputs whose page count matters (routing, splitting)
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(612, 792)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
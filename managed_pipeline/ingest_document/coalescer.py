@@ -0,0 +1,86 @@
+import threading
+import time
+from concurrent.futures import Future
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Ingest coalescer #########
+# Uploads that reach the same instance within `window` seconds, or until `max_batch` of them are waiting, are handed
+# to `submit` together so they share one batch_process_documents request (and one long-running operation) instead of
+# one each. `submit(items)` returns one result per item, in order; an item result that is an Exception fails only that
+# item's future. add() returns a Future the caller can wait on, so each invocation still sees its own outcome.
+# Coalescing only happens when the instance serves concurrent requests (e.g. a Cloud Functions 2nd gen concurrency
+# setting above 1); with one request per instance every batch holds a single upload.
+
+
+class IngestCoalescer:
+    def __init__(self, submit, window=5.0, max_batch=50):
+        self.submit = submit
+        self.window = window
+        self.max_batch = max_batch
+
+        self._lock = threading.Lock()
+        self._batch = []                                                # [(item, future, added_at)]
+        self._timer = None
+        self.stats = {'batches': 0, 'documents': 0, 'failed_documents': 0, 'max_latency': 0.0, 'total_latency': 0.0}
+
+    def add(self, item):
+        future = Future()
+        with self._lock:
+            self._batch.append((item, future, time.monotonic()))
+            if len(self._batch) >= self.max_batch:
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self._flush_from_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            self._run(batch)
+        return future
+
+    def _take(self):
+        # Caller holds the lock
+        batch, self._batch = self._batch, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush_from_timer(self):
+        with self._lock:
+            self._timer = None
+            batch, self._batch = self._batch, []
+        if batch:
+            self._run(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._run(batch)
+
+    def _run(self, batch):
+        items = [item for item, _, _ in batch]
+        try:
+            results = list(self.submit(items))
+            if len(results) != len(items):
+                raise RuntimeError(f"submit returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            results = [e] * len(batch)
+
+        now = time.monotonic()
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['documents'] += len(batch)
+            for (_, _, added_at), result in zip(batch, results):
+                latency = now - added_at
+                self.stats['total_latency'] += latency
+                self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+                if isinstance(result, Exception):
+                    self.stats['failed_documents'] += 1
+        for (_, future, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -1,13 +1,18 @@
-import sys
-import os
-import google.auth
 import re
 import base64
+import contextvars
 import json
 import time
-from google.cloud import storage
-from google.cloud import documentai_v1beta3 as documentai
-from google.cloud import pubsub_v1
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from coalescer import IngestCoalescer
+from result_cache import ResultCache, DiskTier, GcsTier, cache_key, sha256_hex
+from routing import page_count, route, shard_ranges, split_pdf
+import telemetry
+from telemetry import span
 
 #---------------------------------------------------------------------------------------------------------------------
 ######### Initialize variables #########
@@ -27,83 +32,259 @@ document_archive_bucket = 'dk_docai_document_archive'
 ###------ Script Variables ------###
 pubsub_topic = 'docai-topic'
 subscription_id = 'docai-topic-sub'
+###------ Publish Variables ------###
+PUBLISH_MAX_MESSAGES = 100                                              # Messages per publish batch ...
+PUBLISH_MAX_BYTES = 1024 * 1024                                         # ... bytes per batch ...
+PUBLISH_MAX_LATENCY = 0.05                                              # ... or seconds before a batch is sent
+PUBLISH_MAX_OUTSTANDING = 1000                                          # Unacknowledged publishes before publish() blocks
+PUBLISH_ORDERING_KEYS = False                                           # Order messages per source document
+PUBLISH_TIMEOUT = 60
 ###------ Script Variables ------###
-TIMEOUT = 120
+TIMEOUT = 120                                                           # Seconds to wait for a one-document batch operation ...
+TIMEOUT_PER_DOCUMENT = 30                                               # ... plus this for every further document in the batch
+###------ Coalescing Variables ------###
+COALESCE_WINDOW = 0                                                     # Seconds to gather uploads into one batch request (0: off)
+COALESCE_MAX_BATCH = 50                                                 # Max documents per batch request
+###------ Operation Tracking Variables ------###
+LRO_MODE = 'wait'                                                       # 'wait' blocks on the operation, 'async' submits and returns
+operations_state_bucket = document_archive_bucket                       # Pending operation records live here ...
+operations_state_prefix = 'docai_operations/'                           # ... under this prefix
+OPERATION_TIMEOUT = 3600                                                # Seconds before an operation is cancelled and retried
+OPERATION_MAX_RETRIES = 3
+###------ Result Cache Variables ------###
+RESULT_CACHE_ENABLED = True                                             # Skip Document AI for documents seen before
+processor_version = 'pretrained'                                        # Part of the cache key, change it when the processor version changes
+result_cache_bucket = document_archive_bucket                           # Cached entities live here ...
+result_cache_prefix = 'docai_result_cache/'                             # ... under this prefix
+result_cache_dir = '/tmp/docai_result_cache'                            # Per-instance disk tier in front of GCS
+RESULT_CACHE_TTL = 30 * 24 * 3600                                       # Seconds a cached result stays valid
+RESULT_CACHE_DISK_BYTES = 64 * 1024 * 1024
+###------ Routing Variables ------###
+ROUTING_ENABLED = True                                                  # Send documents within reach of online processing there
+ONLINE_MAX_PAGES = 10                                                   # Online (process_document) limits of the processor ...
+ONLINE_MAX_BYTES = 20 * 1024 * 1024                                     # ... pages and bytes per request
+SPLIT_MAX_PAGES = 200                                                   # Longer documents are split into page ranges up to here, batch above
+FUNCTION_MEMORY_BYTES = 256 * 1024 * 1024                               # Memory the function is deployed with (the default)
+# Larger uploads go to batch without being downloaded. A routed upload is held in memory whole, and a split one again
+# as its shards, so route only what a SPLIT_MAX_PAGES document at the online bytes per page and a quarter of the
+# function memory both allow; raise FUNCTION_MEMORY_BYTES together with the deployed --memory
+ROUTE_MAX_BYTES = min(ONLINE_MAX_BYTES * SPLIT_MAX_PAGES // ONLINE_MAX_PAGES, FUNCTION_MEMORY_BYTES // 4)
+ONLINE_CONCURRENCY = 8                                                  # Page-range shards processed at once per document
+###------ Telemetry Variables ------###
+TELEMETRY_EXPORT = 'log'                                                # 'log' (JSON lines), 'otel' or 'off'
 #index = 0
 
+telemetry.configure(TELEMETRY_EXPORT)
+
 #---------------------------------------------------------------------------------------------------------------------
+######### Client registry #########
+# Clients are created lazily, once per function instance, and reused by every invocation the instance serves so
+# that auth, channel setup and TLS handshakes are only paid on cold start. The lock makes first use safe when the
+# instance handles concurrent requests; client_stats counts how often each client was created vs. reused, and is
+# logged with every invocation's stage summary.
+# The Google Cloud libraries are imported inside the functions that use them rather than at module load, so a cold
+# start only pays for the libraries its path needs: a cache hit never loads Document AI, a document routed online
+# never loads the operation tracker, and only split documents load pypdf.
 
-def publish_messages(project_id, pubsub_topic, pub_data):
-    # Publishes multiple messages to a Pub/Sub topic
-    
-    print(f"6. Initiating PubSub client ...")
-    publisher = pubsub_v1.PublisherClient()
-    
-    topic_path = publisher.topic_path(project_id, pubsub_topic)
+_clients = {}
+_clients_lock = threading.RLock()                                      # factories may fetch other clients
+client_stats = {'created': Counter(), 'reused': Counter()}
+
+def get_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+                client_stats['created'][name] += 1
+                return client
+    with _clients_lock:
+        client_stats['reused'][name] += 1
+    return client
+
+def client_counts():
+    # {client name: {'created': n, 'reused': n}} since the instance started, for the per-invocation report
+    with _clients_lock:
+        return {name: {'created': client_stats['created'][name], 'reused': client_stats['reused'][name]}
+                for name in client_stats['created']}
+
+def get_storage_client():
+    from google.cloud import storage
+    return get_client('storage', storage.Client)
+
+def get_documentai_client():
+    from google.cloud import documentai_v1beta3 as documentai
+    client_options = {"api_endpoint": "{}-documentai.googleapis.com".format(location)}
+    return get_client('documentai', lambda: documentai.DocumentProcessorServiceClient(client_options=client_options))
+
+def get_publisher_client():
+    # Messages are batched client side; flow control blocks publish() instead of buffering without bound
+    def make_publisher():
+        from google.cloud import pubsub_v1
+        return pubsub_v1.PublisherClient(
+            batch_settings=pubsub_v1.types.BatchSettings(
+                max_messages=PUBLISH_MAX_MESSAGES, max_bytes=PUBLISH_MAX_BYTES, max_latency=PUBLISH_MAX_LATENCY),
+            publisher_options=pubsub_v1.types.PublisherOptions(
+                enable_message_ordering=PUBLISH_ORDERING_KEYS,
+                flow_control=pubsub_v1.types.PublishFlowControl(
+                    message_limit=PUBLISH_MAX_OUTSTANDING,
+                    limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK)),
+        )
+    return get_client('pubsub_publisher', make_publisher)
+
+#---------------------------------------------------------------------------------------------------------------------
+
+def publish_messages(project_id, pubsub_topic, messages):
+    # Publishes multiple messages to a Pub/Sub topic. messages are (data, attributes) pairs; every message is queued
+    # on the shared, batching publisher first and the futures are gathered once at the end. Returns the message id,
+    # or the Exception, for each message in order.
     if not pubsub_topic:
-        return ('Missing "topic" and/or "message" parameter.', 400)
-    print(f"7. Topic found ... publishing blob name *{pub_data}* to {pubsub_topic} ...")
-    
-    #Data must be a bytestring
-    pub_data = pub_data.encode("utf-8")
-    #When you publish a message, the client returns a future.
-    future = publisher.publish(topic_path, pub_data)
-    print(f"8. Message published as future. Confirmation -->> {future.result()} \n   ...Published")
+        return [ValueError('Missing "topic" parameter.')] * len(messages)
+    publisher = get_publisher_client()
+    topic_path = publisher.topic_path(project_id, pubsub_topic)
+
+    with span('publish', topic=pubsub_topic, messages=len(messages)) as stage:
+        futures = []
+        for data, attributes in messages:
+            ordering_key = attributes.get('source', '') if PUBLISH_ORDERING_KEYS else ''
+            #Data must be a bytestring. When you publish a message, the client returns a future.
+            futures.append((ordering_key, publisher.publish(topic_path, data.encode("utf-8"), ordering_key=ordering_key, **attributes)))
+
+        results = []
+        for ordering_key, future in futures:
+            try:
+                results.append(future.result(timeout=PUBLISH_TIMEOUT))
+            except Exception as e:
+                results.append(e)
+                if ordering_key:
+                    # A failed ordered publish pauses its key until it is resumed
+                    publisher.resume_publish(topic_path, ordering_key)
+        failures = [result for result in results if isinstance(result, Exception)]
+        stage.set(failed=len(failures))
+    for failure in failures:
+        telemetry.event(f"Publish to {pubsub_topic} failed: {failure}", severity='ERROR')
+    return results
 
 def ingest_document(event, context):
-    print('Event ID: {}'.format(context.event_id))
-    print('Event type: {}'.format(context.event_type))
-    print('Bucket: {}'.format(event['bucket']))
-    print('File: {}'.format(event['name']))
-    print('Metageneration: {}'.format(event['metageneration']))
-    print('Created: {}'.format(event['timeCreated']))
-    print('Updated: {}'.format(event['updated']))
+    # The upload's event id is the document's correlation id in both functions
+    with telemetry.correlation(context.event_id):
+        with span('ingest', source=f"gs://{event['bucket']}/{event['name']}", bytes=int(event.get('size', 0))):
+            ingest_object(event, context)
+    telemetry.report(clients=client_counts())
+
+def ingest_object(event, context):
+    telemetry.event(f"Object {event['name']} finalized in {event['bucket']}", event_type=context.event_type,
+                    metageneration=event['metageneration'], created=event['timeCreated'], updated=event['updated'])
     ### More sample invoices are stored in gs://cloud-samples-data/documentai/async_invoices/
     ### Moving blob to archive folder
-    storage_client = storage.Client()
-    blobs = storage_client.list_blobs(gcs_input_bucket, prefix=gcs_input_prefix)
-    input_configs = []
-    index = 0
-    for index, blob in enumerate(blobs):
-        source = f"gs://{gcs_input_bucket}/{blob.name}"
-        if event['name'] in source:
-            print(f"1. Input Files: {source} found in bucket \n   ...Moving  {blob.name} to temp bucket for processing")
-            source_bucket = storage_client.bucket(gcs_input_bucket)
-            destination_bucket = storage_client.bucket(document_archive_bucket)
+    ### The event names the uploaded object exactly, so resolve it directly instead of listing the input bucket
+    if event['bucket'] != gcs_input_bucket or not event['name'].startswith(gcs_input_prefix):
+        telemetry.event(f"Skipping {event['name']}: not under gs://{gcs_input_bucket}/{gcs_input_prefix}")
+        return
+    from google.api_core.exceptions import NotFound
+    storage_client = get_storage_client()
+    source_bucket = storage_client.bucket(gcs_input_bucket)
+    destination_bucket = storage_client.bucket(document_archive_bucket)
+    blob = source_bucket.blob(event['name'])
+    source = f"gs://{gcs_input_bucket}/{blob.name}"
+    with span('archive', source=source, destination=document_archive_bucket):
+        try:
             moved_blob = source_bucket.copy_blob(blob, destination_bucket, f'{blob.name}_{time.strftime("%m%d%Y_%H%M%S")}')
-            ### delete in old destination
-            blob.delete()
-            process_sample_document(moved_blob.name, blob.name)
-        else:
-            index = index + 1
-
-def process_sample_document(blob_name, filename):
-    ### Processing blob from archive folder
-    storage_client = storage.Client()
-    blobs = storage_client.list_blobs(document_archive_bucket)
-    input_configs = []
-    for blob in blobs:
-        if str(blob.name) == str(blob_name):
-            source = f'gs://{document_archive_bucket}/{blob.name}'
-            print(f"2. Accessing file from new source: {source}")
-            
-            input_config = documentai.types.document_processor_service.BatchProcessRequest.BatchInputConfig(
-                gcs_source=source, mime_type="application/pdf")
-            input_configs.append(input_config)
-
-    filename = filename.partition('.')
-    gcs_output_uri_prefix = 'docai_ingest_temp_output_' + filename[0] + '_' + time.strftime("%m%d%Y-%H%M%S")
+        except NotFound:
+            telemetry.event(f"Skipping {source}: object no longer exists")
+            return
+        ### delete in old destination
+        blob.delete()
+
+    key = None
+    if RESULT_CACHE_ENABLED:
+        with span('cache_lookup') as stage:
+            key = cache_key(content_hash(event, moved_blob), processorid, processor_version)
+            entities = get_result_cache().get(key, int(event.get('size', 0)))
+            stage.set(hit=entities is not None)
+        if entities is not None:
+            # Cache hit: replay the cached entities instead of invoking the processor
+            with span('replay_cached', entities=len(entities)):
+                return replay_cached_result(moved_blob.name, blob.name, entities)
+
+    if ROUTING_ENABLED:
+        mime_type = event.get('contentType') or 'application/pdf'
+        with span('route') as stage:
+            decision, content, pages = route_document(event, moved_blob, mime_type)
+            stage.set(route=decision, pages=pages)
+        if decision != 'batch':
+            output_prefix = online_output_prefix(blob.name)
+            try:
+                with span('process_online', route=decision, pages=pages):
+                    return process_online(moved_blob.name, blob.name, content, mime_type, pages, output_prefix, key, decision)
+            except Exception as e:
+                # The batch path takes anything online processing rejects (limits, quota, transient errors)
+                telemetry.event(f"Online processing of {source} failed, falling back to batch: {e}", severity='WARNING')
+                delete_online_output(output_prefix)
+            content = None
+    process_sample_document(moved_blob.name, blob.name, key)
+
+def process_sample_document(blob_name, filename, key=None):
+    ### Queues the archived blob; uploads arriving together share one batch request
+    return get_ingest_coalescer().add((blob_name, filename, key, telemetry.correlation_id())).result()
+
+def get_ingest_coalescer():
+    return get_client('ingest_coalescer', lambda: IngestCoalescer(process_documents, COALESCE_WINDOW, COALESCE_MAX_BATCH))
+
+def process_documents(items):
+    ### Processing blobs from archive folder with one batch request
+    ### items are (archived blob name, original filename, result cache key or None, correlation id); blob names
+    ### come from copy_blob, so no lookup is needed. This runs on the coalescer's thread, so batch-level spans carry
+    ### the correlation ids of every document in the batch.
+    sources = []
+    cache_keys = []
+    correlation_ids = []
+    for blob_name, filename, key, correlation_id in items:
+        sources.append(f'gs://{document_archive_bucket}/{blob_name}')
+        cache_keys.append(key)
+        correlation_ids.append(correlation_id)
+
+    if len(items) == 1:
+        # The label becomes the first path segment of the output objects, which output_notification reads back as
+        # the operation key, so the directories of a nested filename are flattened into it
+        batch_label = re.sub(r'[^\w-]', '_', items[0][1].rpartition('.')[0] or items[0][1])
+    else:
+        batch_label = f'batch{len(items)}_{uuid.uuid4().hex[:8]}'
+    gcs_output_uri_prefix = 'docai_ingest_temp_output_' + batch_label + '_' + time.strftime("%m%d%Y-%H%M%S")
     destination_uri = f"{gcs_output_uri}/{gcs_output_uri_prefix}/"
+
+    with span('submit_batch', documents=len(sources), correlation_ids=correlation_ids, destination=destination_uri) as stage:
+        operation = submit_batch(sources, destination_uri)
+        stage.set(operation=operation.operation.name)
+
+    if LRO_MODE == 'async':
+        get_operation_tracker().track(gcs_output_uri_prefix, operation.operation.name, destination_uri=destination_uri,
+                                      sources=sources, cache_keys=cache_keys, correlation_ids=correlation_ids)
+        telemetry.event(f"Operation {operation.operation.name} submitted; outputs are published once it completes",
+                        correlation_ids=correlation_ids)
+        return [operation.operation.name] * len(sources)
+
+    # Wait for the operation to finish; a coalesced batch gets more time than a single document
+    timeout = TIMEOUT + TIMEOUT_PER_DOCUMENT * (len(sources) - 1)
+    with span('lro_wait', operation=operation.operation.name, documents=len(sources), timeout=timeout,
+              correlation_ids=correlation_ids):
+        operation.result(timeout=timeout)
+    return publish_outputs(operation.metadata, destination_uri, sources, cache_keys, correlation_ids)
+
+def submit_batch(sources, destination_uri):
+    from google.cloud import documentai_v1beta3 as documentai
+    input_configs = [documentai.types.document_processor_service.BatchProcessRequest.BatchInputConfig(
+        gcs_source=source, mime_type="application/pdf") for source in sources]
     ### Location to write results
     output_config = documentai.types.document_processor_service.BatchProcessRequest.BatchOutputConfig(
         gcs_destination=destination_uri
     )
-    
+
     ### Instantiates a client
-    print(f"3. Initiating DocumentAI client for Invoice Processor *{processorid}* ...")
-    client_options = {"api_endpoint": "{}-documentai.googleapis.com".format(location)}
-    client = documentai.DocumentProcessorServiceClient(client_options=client_options)
-    
+    client = get_documentai_client()
+
     # The full resource name of the processor, e.g.:projects/project_id/locations/location/processor/processor-id
     # You must create new processors in the Cloud Console first.
     name = f"projects/{project_id}/locations/{location}/processors/{processorid}"
@@ -113,21 +294,237 @@ def process_sample_document(blob_name, filename):
         output_config=output_config,
     )
 
-    print(f"4. Invoking Invoice Processor *{processorid}* and sending {source} for processing ...")
-    operation = client.batch_process_documents(request)
-    # Wait for the operation to finish
-    print("5. Creating JSON output...")
-    operation.result(timeout=TIMEOUT)
+    return client.batch_process_documents(request)
+
+def publish_outputs(metadata, destination_uri, sources, cache_keys=None, correlation_ids=None):
+    return publish_documents(document_outputs(metadata, destination_uri, sources), sources, cache_keys, correlation_ids)
 
-    # Results are written to GCS. Use a regex to find output files
+def publish_documents(outputs, sources, cache_keys=None, correlation_ids=None):
+    # outputs maps each source to its output prefix, or to the Exception the processor reported for it
+    results = [outputs.get(source) or RuntimeError(f"No output found for {source}") for source in sources]
+    cache_keys = cache_keys or [None] * len(sources)
+    correlation_ids = correlation_ids or [None] * len(sources)
+    # One message per document: the output prefix holding that document's shards, attributed to its source. The
+    # cache key lets process_document store the extracted entities for later duplicates; the correlation id ties
+    # its telemetry to this upload.
+    published = [i for i, result in enumerate(results) if not isinstance(result, Exception)]
+    messages = []
+    for i in published:
+        attributes = {'source': sources[i]}
+        if cache_keys[i]:
+            attributes['cache_key'] = cache_keys[i]
+        if correlation_ids[i]:
+            attributes['correlation_id'] = correlation_ids[i]
+        messages.append((results[i], attributes))
+    message_ids = publish_messages(project_id, pubsub_topic, messages)
+    for i, message_id in zip(published, message_ids):
+        if isinstance(message_id, Exception):
+            results[i] = message_id
+    return results
+
+def document_outputs(metadata, destination_uri, sources):
+    # Maps each input gcs source to the output prefix (relative to the output bucket) holding its JSON shards
+    prefix_len = len(f'gs://{gcs_output_bucket}/')
+    statuses = list(getattr(metadata, 'individual_process_statuses', None) or [])
+    if statuses:
+        outputs = {}
+        for status in statuses:
+            if status.status.code:
+                outputs[status.input_gcs_source] = RuntimeError(f"{status.input_gcs_source}: {status.status.message}")
+            else:
+                outputs[status.input_gcs_source] = status.output_gcs_destination[prefix_len:].rstrip('/') + '/'
+        return outputs
+
+    # Older responses carry no per-document status: shards sit in one directory per input, named by input index
     match = re.match(r"gs://([^/]+)/(.+)", destination_uri)
-    gcs_output_bucket = match.group(1)
-    prefix = match.group(2)
+    bucket = get_storage_client().bucket(match.group(1))
+    directories = {blob.name.rpartition('/')[0] + '/' for blob in bucket.list_blobs(prefix=match.group(2)) if ".json" in blob.name}
+    if len(directories) != len(sources):
+        error = RuntimeError(f"Cannot attribute {len(directories)} output directories to {len(sources)} inputs")
+        return {source: error for source in sources}
+    return dict(zip(sources, sorted(directories, key=_input_index)))
+
+def _input_index(directory):
+    last = directory.rstrip('/').rpartition('/')[2]
+    return (0, int(last), '') if last.isdigit() else (1, 0, directory)
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Online routing #########
+# Batch processing pays for a long-running operation even for a one-page invoice. Uploads up to ROUTE_MAX_BYTES are
+# downloaded and routed by size and page count (see routing.py): documents within the online limits get one
+# process_document call, longer ones up to SPLIT_MAX_PAGES are split into page-range shards processed online in
+# parallel, everything else goes through the coalesced batch path. Online results are written as Document JSON
+# shards under one output prefix and published like a batch output, so process_document merges the shards into one
+# entity set and loads them the same way. When an online call fails the shards already written are deleted and the
+# document takes the batch path.
+
+def route_document(event, blob, mime_type):
+    # Returns (route, content, pages); content is only downloaded when the document may go online
+    size = int(event.get('size', 0))
+    if size > ROUTE_MAX_BYTES:
+        return 'batch', None, None
+    content = blob.download_as_bytes()
+    pages = page_count(content, mime_type)
+    return route(len(content), pages, ONLINE_MAX_PAGES, ONLINE_MAX_BYTES, SPLIT_MAX_PAGES), content, pages
+
+def online_output_prefix(filename):
+    label = filename.partition('.')[0]
+    return 'docai_ingest_online_output_' + label + '_' + time.strftime("%m%d%Y-%H%M%S") + f'_{uuid.uuid4().hex[:8]}/0/'
+
+def delete_online_output(output_prefix):
+    # Shards written before an online failure; the batch fallback writes its own output, so they are never published
+    try:
+        for blob in get_storage_client().bucket(gcs_output_bucket).list_blobs(prefix=output_prefix):
+            blob.delete()
+    except Exception as e:
+        telemetry.event(f"Could not delete online output gs://{gcs_output_bucket}/{output_prefix}: {e}", severity='WARNING')
+
+def process_online(blob_name, filename, content, mime_type, pages, output_prefix, key=None, decision='online'):
+    from google.cloud import documentai_v1beta3 as documentai
+    ranges = shard_ranges(pages, len(content), ONLINE_MAX_PAGES, ONLINE_MAX_BYTES) if pages else [(0, 1)]
+    shards = [content]
+    if len(ranges) > 1:
+        with span('split', pages=pages, shards=len(ranges), bytes=len(content)):
+            shards = split_pdf(content, ranges)
+    label = filename.partition('.')[0]
+    bucket = get_storage_client().bucket(gcs_output_bucket)
+
+    def process_shard(i):
+        start, end = ranges[i]
+        with span('online_shard', shard=i, first_page=start + 1, pages=end - start, bytes=len(shards[i])):
+            document = online_process(shards[i], mime_type)
+            # Zero-padded names keep the listing, and so the merged entities, in page order
+            bucket.blob(f'{output_prefix}{label}-{i:04d}.json').upload_from_string(
+                documentai.types.Document.to_json(document), content_type='application/json')
+
+    if len(shards) == 1:
+        process_shard(0)
+    else:
+        with ThreadPoolExecutor(max_workers=ONLINE_CONCURRENCY, thread_name_prefix='online-shard') as pool:
+            # Each shard runs in its own copy of this context so its spans keep the correlation id
+            futures = [pool.submit(contextvars.copy_context().run, process_shard, i) for i in range(len(shards))]
+            for future in futures:
+                future.result()
+    return publish_document(output_prefix, blob_name, key, route=decision)
+
+def online_process(content, mime_type):
+    name = f"projects/{project_id}/locations/{location}/processors/{processorid}"
+    request = {'name': name, 'raw_document': {'content': content, 'mime_type': mime_type}}
+    return get_documentai_client().process_document(request=request).document
+
+def publish_document(output_prefix, blob_name, key=None, **attributes):
+    # Publishes an output prefix written by this function (online or cached results) like a processor output
+    attributes['source'] = f'gs://{document_archive_bucket}/{blob_name}'
+    if key:
+        attributes['cache_key'] = key
+    if telemetry.correlation_id():
+        attributes['correlation_id'] = telemetry.correlation_id()
+    result = publish_messages(project_id, pubsub_topic, [(output_prefix, attributes)])[0]
+    if isinstance(result, Exception):
+        raise result
+    return output_prefix
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Operation tracking (LRO_MODE = 'async') #########
+
+def get_operation_tracker():
+    def make_tracker():
+        from operations import OperationTracker
+        bucket = get_storage_client().bucket(operations_state_bucket)
+        return OperationTracker(bucket, operations_state_prefix, get_batch_operation, cancel_batch_operation,
+                                resubmit_batch, publish_completed_batch, report_failed_batch,
+                                timeout=OPERATION_TIMEOUT, max_retries=OPERATION_MAX_RETRIES, log=telemetry.event)
+    return get_client('operation_tracker', make_tracker)
+
+def get_batch_operation(name):
+    from google.cloud import documentai_v1beta3 as documentai
+    operation = get_documentai_client().transport.operations_client.get_operation(name)
+    metadata = None
+    if operation.HasField('metadata'):
+        metadata = documentai.types.document_processor_service.BatchProcessMetadata.deserialize(operation.metadata.value)
+    return SimpleNamespace(done=operation.done, error=operation.error if operation.HasField('error') else None, metadata=metadata)
+
+def cancel_batch_operation(name):
+    get_documentai_client().transport.operations_client.cancel_operation(name)
+
+def resubmit_batch(record):
+    # Each attempt writes to its own directory under the operation's prefix so partial outputs never mix
+    destination_uri = f"{gcs_output_uri}/{record['key']}/attempt{record['attempts'] + 1}/"
+    operation = submit_batch(record['sources'], destination_uri)
+    return {'operation': operation.operation.name, 'destination_uri': destination_uri}
+
+def publish_completed_batch(record, operation):
+    # A document the processor failed is reported and settled: its error will not change on a retry. A failed publish
+    # raises, which leaves the record claimed; the sources settled so far are saved with it (see OperationTracker.check),
+    # so the re-claim after claim_ttl publishes only the documents that are still missing.
+    settled = record.setdefault('settled', [])
+    pending = [i for i, source in enumerate(record['sources']) if source not in settled]
+    sources = [record['sources'][i] for i in pending]
+    cache_keys = [(record.get('cache_keys') or [None] * len(record['sources']))[i] for i in pending]
+    correlation_ids = [(record.get('correlation_ids') or [None] * len(record['sources']))[i] for i in pending]
+    outputs = document_outputs(operation.metadata, record['destination_uri'], sources)
+    results = publish_documents(outputs, sources, cache_keys, correlation_ids)
+
+    unpublished = []
+    for source, result, correlation_id in zip(sources, results, correlation_ids):
+        if isinstance(result, Exception) and isinstance(outputs.get(source), str):
+            unpublished.append(source)
+            continue
+        if isinstance(result, Exception):
+            with telemetry.correlation(correlation_id or telemetry.correlation_id()):
+                telemetry.event(f"{source} was not processed: {result}", severity='ERROR')
+        settled.append(source)
+    if unpublished:
+        raise RuntimeError(f"{len(unpublished)} of {len(record['sources'])} document(s) of {record['operation']} were not published: {unpublished}")
+
+def report_failed_batch(record, reason):
+    telemetry.event(f"Operation {record['operation']} for {len(record['sources'])} document(s) failed permanently: {reason}",
+                    severity='ERROR', sources=record['sources'], correlation_ids=record.get('correlation_ids'))
+
+def poll_operations(event, context):
+    ### Scheduled entry point (e.g. Cloud Scheduler -> Pub/Sub): sweeps every pending operation
+    tracker = get_operation_tracker()
+    with span('poll_operations') as stage:
+        stage.set(**tracker.poll())
+    telemetry.event("Operation metrics", **tracker.metrics())
+    telemetry.report(clients=client_counts())
+
+def output_notification(event, context):
+    ### Entry point for object finalize events on the output bucket: the first path segment is the operation key
+    key = event['name'].partition('/')[0]
+    if event['bucket'] != gcs_output_bucket or not key.startswith('docai_ingest_temp_output_'):
+        return
+    with span('operation_check', operation_key=key) as stage:
+        stage.set(state=get_operation_tracker().check(key))
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Result cache #########
+
+def get_result_cache():
+    def make_cache():
+        tiers = [DiskTier(result_cache_dir, RESULT_CACHE_DISK_BYTES),
+                 GcsTier(get_storage_client().bucket(result_cache_bucket), result_cache_prefix)]
+        return ResultCache(tiers, ttl=RESULT_CACHE_TTL, log=telemetry.event)
+    return get_client('result_cache', make_cache)
+
+def content_hash(event, blob):
+    # GCS already reports the MD5 of the uploaded bytes; composite objects have none, so hash the content instead
+    if event.get('md5Hash'):
+        return 'md5-' + base64.b64decode(event['md5Hash']).hex()
+    return 'sha256-' + sha256_hex(blob.download_as_bytes())
 
-    bucket = storage_client.get_bucket(gcs_output_bucket)
-    blob_list = list(bucket.list_blobs(prefix=prefix))
+def replay_cached_result(blob_name, filename, entities):
+    # Writes the cached entities as a one-shard Document JSON and publishes it like a processor output, so
+    # process_document transforms and loads it exactly as it would a fresh result
+    label = filename.partition('.')[0]
+    output_prefix = 'docai_ingest_cached_output_' + label + '_' + time.strftime("%m%d%Y-%H%M%S") + f'_{uuid.uuid4().hex[:8]}/0/'
+    document = {'entities': [document_entity(entity) for entity in entities]}
+    get_storage_client().bucket(gcs_output_bucket).blob(f'{output_prefix}{label}-0.json').upload_from_string(
+        json.dumps(document), content_type='application/json')
+    telemetry.event("Result cache", **get_result_cache().stats)
+    return publish_document(output_prefix, blob_name, cache='hit')
 
-    for i, blob in enumerate(blob_list):
-    # If JSON file, download the contents of this blob as a bytes object.
-        if ".json" in blob.name:
-            publish_messages(project_id, pubsub_topic, blob.name)
+def document_entity(entity):
+    # Entity record -> Document JSON entity (the field names batch output uses)
+    return {'type': entity['type'], 'mentionText': entity['value'], 'confidence': entity['confidence'],
+            'properties': [document_entity(prop) for prop in entity.get('properties', ())]}
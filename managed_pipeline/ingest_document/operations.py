@@ -0,0 +1,156 @@
+import json
+import time
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Long-running operation tracker #########
+# In submit-and-return mode the batch operation is not awaited inside the invocation. Its name, output location and
+# sources are persisted as one small JSON record per operation under a GCS prefix, keyed by the operation's output
+# prefix. Completion is detected later, either by poll() (e.g. from a scheduled function) or by check(key) when an
+# output object notification arrives for that prefix:
+#   - done without error -> on_done(record, operation) fans the outputs out, then the record is deleted. When on_done
+#     raises, the record (including changes on_done made to it) stays claimed and is retried after claim_ttl
+#   - failed or older than `timeout` seconds -> the operation is cancelled and resubmitted up to max_retries times,
+#     after which on_failed(record, reason) is called and the record is deleted
+# A record is claimed by rewriting it with a generation precondition before any side effect, so concurrent pollers
+# and notifications never complete the same operation twice. A claim that is not finished within claim_ttl seconds
+# (crashed worker) is picked up again.
+
+
+class OperationTracker:
+    def __init__(self, bucket, prefix, get_operation, cancel_operation, resubmit, on_done, on_failed,
+                 timeout=3600, max_retries=3, claim_ttl=600, clock=time.time, log=None):
+        # bucket:            storage Bucket (or a fake with blob()/list_blobs())
+        # get_operation:     callable(name) -> object with .done, .error (None or with .message) and .metadata
+        # cancel_operation:  callable(name)
+        # resubmit:          callable(record) -> dict of record updates, at least the new 'operation' name
+        # log:               callable(message, severity), e.g. telemetry.event; prints when not given
+        self.bucket = bucket
+        self.prefix = prefix
+        self.get_operation = get_operation
+        self.cancel_operation = cancel_operation
+        self.resubmit = resubmit
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.claim_ttl = claim_ttl
+        self.clock = clock
+        self.log = log or _print_log
+        self.stats = {'tracked': 0, 'completed': 0, 'retried': 0, 'failed': 0, 'timed_out': 0}
+
+    def _blob(self, key):
+        return self.bucket.blob(f'{self.prefix}{key}.json')
+
+    def track(self, key, operation_name, **record):
+        now = self.clock()
+        record.update(key=key, operation=operation_name, submitted_at=now, attempt_started_at=now, attempts=1, state='running')
+        self._blob(key).upload_from_string(json.dumps(record), content_type='application/json', if_generation_match=0)
+        self.stats['tracked'] += 1
+        return record
+
+    def _load(self, blob):
+        try:
+            data = blob.download_as_bytes()
+        except NotFound:
+            return None
+        return json.loads(data)
+
+    def _save(self, blob, record):
+        # Rewrites the record only if nobody else changed it since it was read; False when another worker won
+        try:
+            blob.upload_from_string(json.dumps(record), content_type='application/json', if_generation_match=blob.generation)
+            return True
+        except PreconditionFailed:
+            return False
+
+    def _delete(self, key):
+        try:
+            self._blob(key).delete()
+        except NotFound:
+            pass
+
+    def check(self, key):
+        # Returns the record's state after this check: 'missing', 'running', 'claimed', 'completed', 'retried' or 'failed'
+        blob = self.bucket.get_blob(f'{self.prefix}{key}.json')       # fetches the generation used to claim it
+        record = self._load(blob) if blob is not None else None
+        if record is None:
+            return 'missing'
+        now = self.clock()
+        if record['state'] == 'claimed' and now - record['claimed_at'] < self.claim_ttl:
+            return 'claimed'
+
+        operation = self.get_operation(record['operation'])
+        timed_out = not operation.done and now - record['attempt_started_at'] > self.timeout
+        if not operation.done and not timed_out:
+            return 'running'
+
+        record.update(state='claimed', claimed_at=now)
+        if not self._save(blob, record):
+            return 'claimed'
+
+        if operation.done and not operation.error:
+            try:
+                self.on_done(record, operation)
+            except Exception:
+                # Keeps the claim, with whatever progress on_done recorded in the record (e.g. the outputs it already
+                # published), for the re-claim after claim_ttl
+                self._save(blob, record)
+                raise
+            self._delete(key)
+            self.stats['completed'] += 1
+            return 'completed'
+
+        if timed_out:
+            self.stats['timed_out'] += 1
+            reason = f"timed out after {now - record['attempt_started_at']:.0f}s"
+            try:
+                self.cancel_operation(record['operation'])
+            except Exception as e:
+                self.log(f"Could not cancel {record['operation']}: {e}", 'WARNING')
+        else:
+            reason = operation.error.message
+
+        if record['attempts'] <= self.max_retries:
+            self.log(f"Operation {record['operation']} {reason}, resubmitting (attempt {record['attempts'] + 1})", 'WARNING')
+            record.update(self.resubmit(record))
+            record.update(attempts=record['attempts'] + 1, attempt_started_at=self.clock(), state='running')
+            record.pop('claimed_at', None)
+            blob.upload_from_string(json.dumps(record), content_type='application/json')
+            self.stats['retried'] += 1
+            return 'retried'
+
+        self.on_failed(record, reason)
+        self._delete(key)
+        self.stats['failed'] += 1
+        return 'failed'
+
+    def pending(self):
+        for blob in self.bucket.list_blobs(prefix=self.prefix):
+            record = self._load(blob)
+            if record is not None:
+                yield record
+
+    def poll(self):
+        states = {}
+        for record in list(self.pending()):
+            try:
+                state = self.check(record['key'])
+            except Exception as e:
+                self.log(f"Checking operation {record['operation']} failed, will retry on the next poll: {e}", 'ERROR')
+                state = 'error'
+            states[state] = states.get(state, 0) + 1
+        return states
+
+    def metrics(self):
+        now = self.clock()
+        ages = sorted(now - record['submitted_at'] for record in self.pending())
+        return dict(self.stats, queue_depth=len(ages),
+                    oldest_age=ages[-1] if ages else 0.0,
+                    median_age=ages[len(ages) // 2] if ages else 0.0)
+
+
+def _print_log(message, severity='INFO'):
+    # Default log callable when none is passed in: plain stdout lines, problems marked with "**"
+    print(message if severity == 'INFO' else f"** {message}")
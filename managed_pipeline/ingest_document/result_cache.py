@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Content-addressed result cache #########
+# Extracted entities are cached under a key made of the processor id, the processor version and a hash of the input
+# bytes, so a document that is sent again is not reprocessed. Tiers are consulted in order (e.g. local disk, then
+# GCS); a hit in a lower tier is copied into the tiers above it. Entries older than `ttl` seconds are ignored and
+# removed on read; DiskTier also evicts least recently used entries beyond max_bytes. For GCS, pair the TTL with an
+# object lifecycle (Age) rule on the cache prefix so unread entries are removed too.
+
+
+def cache_key(content_hash, processor_id, processor_version):
+    return f'{processor_id}/{processor_version or "default"}/{content_hash}'
+
+
+def sha256_hex(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class DiskTier:
+    def __init__(self, root, max_bytes=256 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)                                                  # mtime doubles as last access for LRU
+        return data
+
+    def put(self, key, data):
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.root):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class GcsTier:
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        from google.api_core.exceptions import NotFound                 # loaded with the storage client that uses it
+        try:
+            return self.bucket.blob(f'{self.prefix}{key}.json').download_as_bytes()
+        except NotFound:
+            return None
+
+    def put(self, key, data):
+        self.bucket.blob(f'{self.prefix}{key}.json').upload_from_string(data, content_type='application/json')
+
+    def delete(self, key):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.bucket.blob(f'{self.prefix}{key}.json').delete()
+        except NotFound:
+            pass
+
+
+class ResultCache:
+    def __init__(self, tiers, ttl=30 * 24 * 3600, clock=time.time, log=None):
+        # log: callable(message, severity) for tier failures, e.g. telemetry.event; prints when not given
+        self.tiers = tiers
+        self.ttl = ttl
+        self.clock = clock
+        self.log = log or _print_log
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'expired': 0, 'errors': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def get(self, key, input_bytes=0):
+        # Returns the cached entity records, or None. input_bytes is credited to bytes_saved on a hit.
+        for level, tier in enumerate(self.tiers):
+            # A tier that fails (unreachable, corrupt entry, delete of an object a lifecycle rule already removed)
+            # counts as an error and the lookup moves on to the next tier
+            try:
+                data = tier.get(key)
+                if data is None:
+                    continue
+                entry = json.loads(data)
+                if self.clock() - entry['created_at'] > self.ttl:
+                    self._count('expired')
+                    tier.delete(key)
+                    continue
+            except Exception as e:
+                self.log(f"Result cache read from {type(tier).__name__} failed: {e}", 'WARNING')
+                self._count('errors')
+                continue
+            for upper in self.tiers[:level]:
+                try:
+                    upper.put(key, data)
+                except Exception as e:
+                    self.log(f"Result cache write to {type(upper).__name__} failed: {e}", 'WARNING')
+                    self._count('errors')
+            self._count('hits')
+            self._count('bytes_saved', input_bytes)
+            return entry['entities']
+        self._count('misses')
+        return None
+
+    def put(self, key, entities):
+        data = json.dumps({'created_at': self.clock(), 'entities': entities}).encode('utf-8')
+        for tier in self.tiers:
+            try:
+                tier.put(key, data)
+            except Exception as e:
+                self.log(f"Result cache write to {type(tier).__name__} failed: {e}", 'WARNING')
+                self._count('errors')
+
+
+def _print_log(message, severity='INFO'):
+    # Default log callable when none is passed in: plain stdout lines, problems marked with "**"
+    print(message if severity == 'INFO' else f"** {message}")
@@ -0,0 +1,259 @@
+import atexit
+import contextlib
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Buffered BigQuery sink #########
+# Rows for every destination table are buffered across documents and written with one staged file and one load job
+# per table per flush, instead of an upload + load job + get_table round trip per invoice. Rows are added per document
+# (document(key)), as DataFrames or as lists of dicts (records.py); pandas is only imported to concatenate frames.
+# Each document gets a `loaded` Future that completes when the flush holding its rows succeeds, so callers only
+# acknowledge the document or delete its inputs once its rows are in BigQuery. Its callbacks run on the thread that
+# flushed (after the flush itself has finished), so slow work there should be handed to an executor.
+#
+# A background flusher writes the buffer when:
+#   - it reaches max_rows or max_bytes
+#   - no document is open, i.e. nobody is about to add rows (documents opened while a flush runs join the next one)
+#   - the oldest buffered document is older than max_latency seconds, for a steady stream that never goes idle
+# and close() / interpreter shutdown flushes what is left. With one document at a time (e.g. a 1st gen function
+# instance) every document is therefore flushed on its own; documents handled concurrently on an instance share
+# load jobs. A failed flush fails the `loaded` Future of every document in it and drops their rows instead of keeping
+# them for a later flush, since the owner retries the document (a nacked or redelivered message). When only some
+# tables of a flush failed, the tables each document did load are remembered by key (up to max_partial documents), and
+# a retry of that key adds only the rest, so a redelivered invoice is not loaded twice by the same instance.
+
+
+class SinkDocument:
+    def __init__(self, sink, key):
+        self.sink = sink
+        self.key = key
+        self.tables = {}                                                # table_name -> [rows, ...]
+        self.loaded = Future()
+
+    def add(self, table_name, rows):
+        if table_name not in self.sink.tables:
+            raise KeyError(f"No destination configured for table {table_name}")
+        if len(rows):
+            self.tables.setdefault(table_name, []).append(rows)
+
+    def rows(self):
+        return sum(len(rows) for batches in self.tables.values() for rows in batches)
+
+
+class BigQuerySink:
+    def __init__(self, bq_client, stage, tables, max_rows=50000, max_bytes=64 * 1024 * 1024, max_latency=5.0,
+                 max_partial=10000, log=None):
+        # bq_client: anything with load_table_from_uri(uri, table_id, job_config=...) returning a job with result()
+        # stage:     callable(table_name, rows) -> gs:// uri of the staged file, rows being a frame or a list of dicts
+        # tables:    {table_name: (table_id, job_config)}
+        # log:       callable(message, severity), e.g. telemetry.event; prints when not given
+        self.bq_client = bq_client
+        self.stage = stage
+        self.tables = tables
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.max_partial = max_partial
+        self.log = log or _print_log
+
+        self._changed = threading.Condition()                           # guards the buffer, wakes the flusher
+        self._flush_lock = threading.Lock()                             # one flush at a time
+        self._documents = {}                                            # key -> (SinkDocument, added_at), in order
+        self._open = 0                                                  # documents between document() and commit
+        self._rows = 0
+        self._bytes = 0
+        self._closed = False
+        self._flusher = None
+        self._partial = OrderedDict()                                   # key -> tables loaded by a failed flush
+
+        self.flush_latencies = deque(maxlen=1000)                       # seconds per flush, most recent last
+        self.stats = {'flushes': 0, 'load_jobs': 0, 'rows_loaded': 0, 'documents_loaded': 0, 'failed_flushes': 0,
+                      'failed_documents': 0}
+        atexit.register(self.close)
+
+    @contextlib.contextmanager
+    def document(self, key=None):
+        # Rows added inside the block are buffered together when it exits without an error, and dropped otherwise.
+        # Adding a key that is still buffered replaces its rows; both documents' Futures follow the one flush.
+        document = SinkDocument(self, key or uuid.uuid4().hex)
+        with self._changed:
+            self._open += 1
+        try:
+            yield document
+        except BaseException:
+            with self._changed:
+                self._open -= 1
+                self._changed.notify_all()
+            raise
+        self._commit(document)
+
+    def _commit(self, document):
+        with self._changed:
+            self._open -= 1
+            for table_name in self._partial.get(document.key, ()):
+                document.tables.pop(table_name, None)
+            if document.tables:
+                previous = self._documents.pop(document.key, None)
+                if previous is not None:
+                    self._remove(previous[0])
+                    _chain(document.loaded, previous[0].loaded)
+                self._documents[document.key] = (document, time.monotonic())
+                self._rows += document.rows()
+                self._bytes += sum(_size(rows) for batches in document.tables.values() for rows in batches)
+            self._start_flusher()
+            self._changed.notify_all()
+        if not document.tables:
+            document.loaded.set_result(None)
+
+    def _remove(self, document):
+        # Caller holds the lock
+        self._rows -= document.rows()
+        self._bytes -= sum(_size(rows) for batches in document.tables.values() for rows in batches)
+
+    def _due(self):
+        # Caller holds the lock
+        if not self._documents:
+            return False
+        oldest = next(iter(self._documents.values()))[1]
+        return (self._rows >= self.max_rows or self._bytes >= self.max_bytes or not self._open
+                or time.monotonic() - oldest >= self.max_latency)
+
+    def _start_flusher(self):
+        # Caller holds the lock
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run_flusher, name='bigquery-sink-flusher', daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            with self._changed:
+                while not self._closed and not self._due():
+                    self._changed.wait(min(self.max_latency, 1.0) if self._documents else None)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                self.log(f"Background flush failed, its documents will be retried by their owners: {e}", 'ERROR')
+
+    def flush(self):
+        with self._flush_lock:
+            outcomes, error = self._write()
+        # Only after the flush lock is released: completing a document runs its callbacks (acks, cleanup), which must
+        # not hold up the next flush
+        for document, document_error in outcomes:
+            if document_error is not None:
+                document.loaded.set_exception(document_error)
+            else:
+                document.loaded.set_result(None)
+        if error is not None:
+            raise error
+
+    def _write(self):
+        # Caller holds the flush lock. Stages and loads every buffered document; returns [(document, error or None)]
+        # and the flush error, if any table failed
+        with self._changed:
+            documents = [document for document, _ in self._documents.values()]
+            self._documents, self._rows, self._bytes = {}, 0, 0
+        if not documents:
+            return [], None
+
+        start = time.perf_counter()
+        jobs = {}
+        failed = {}
+        for table_name in self.tables:
+            batches = [rows for document in documents for rows in document.tables.get(table_name, ())]
+            if not batches:
+                continue
+            table_id, job_config = self.tables[table_name]
+            rows = _concat(batches)
+            try:
+                uri = self.stage(table_name, rows)
+                jobs[table_name] = (self.bq_client.load_table_from_uri(uri, table_id, job_config=job_config), len(rows))
+            except Exception as e:
+                failed[table_name] = e
+        # Load jobs for all tables run concurrently; wait for them together
+        for table_name, (job, rows) in jobs.items():
+            try:
+                job.result()
+                self.stats['load_jobs'] += 1
+                self.stats['rows_loaded'] += rows
+                self.log(f"Loaded {rows} rows into {self.tables[table_name][0]}", 'INFO')
+            except Exception as e:
+                failed[table_name] = e
+        self.flush_latencies.append(time.perf_counter() - start)
+        self.stats['flushes'] += 1
+
+        error = RuntimeError(f"BigQuery flush failed for {sorted(failed)}: {failed}") if failed else None
+        outcomes = []
+        with self._changed:
+            for document in documents:
+                if error is not None and any(table_name in failed for table_name in document.tables):
+                    loaded = {table_name for table_name in document.tables if table_name not in failed}
+                    loaded |= self._partial.pop(document.key, set())
+                    if loaded:
+                        self._partial[document.key] = loaded
+                        while len(self._partial) > self.max_partial:
+                            self._partial.popitem(last=False)
+                    self.stats['failed_documents'] += 1
+                    outcomes.append((document, error))
+                else:
+                    self._partial.pop(document.key, None)
+                    self.stats['documents_loaded'] += 1
+                    outcomes.append((document, None))
+            if error is not None:
+                self.stats['failed_flushes'] += 1
+        return outcomes, error
+
+    def pending_rows(self):
+        with self._changed:
+            return self._rows
+
+    def metrics(self):
+        latencies = sorted(self.flush_latencies)
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+        return dict(self.stats, pending_rows=self.pending_rows(),
+                    flush_latency_p50=pct(0.50), flush_latency_p99=pct(0.99), flush_latency_max=pct(1.0))
+
+    def close(self):
+        with self._changed:
+            if self._closed:
+                return
+            self._closed = True
+            self._changed.notify_all()
+        self.flush()
+
+
+def _chain(source, target):
+    # Completes `target` with the outcome of `source`
+    def copy(future):
+        if future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(None)
+    source.add_done_callback(copy)
+
+
+def _size(rows):
+    # Approximate in-memory size, for the max_bytes threshold
+    if isinstance(rows, list):
+        return sum(sys.getsizeof(value) for record in rows for value in record.values())
+    return int(rows.memory_usage(index=False, deep=True).sum())
+
+
+def _concat(batches):
+    if all(isinstance(rows, list) for rows in batches):
+        return [record for rows in batches for record in rows]
+    import pandas as pd
+    return pd.concat([pd.DataFrame(rows) if isinstance(rows, list) else rows for rows in batches], ignore_index=True)
+
+
+def _print_log(message, severity='INFO'):
+    # Default log callable when none is passed in: plain stdout lines, problems marked with "**"
+    print(message if severity == 'INFO' else f"** {message}")
@@ -0,0 +1,102 @@
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import ijson                                                        # Optional: incremental JSON parser
+except ImportError:
+    ijson = None
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Entity readers #########
+# The processor output shards carry the full Document (text, pages, tokens, layout) but the pipeline only needs the
+# entities. iter_entities streams the shard and yields one small dict per entity, so memory stays bounded by the
+# largest entity instead of the page count. When ijson is not installed, or STREAM_ENTITIES is off, it falls back to
+# building the full Document proto; the Document AI library is only imported for that fallback.
+
+STREAM_ENTITIES = True
+READ_CHUNK_SIZE = 1024 * 1024                                           # Bytes fetched per ranged GCS read
+
+
+def _entity_record(type_, mention_text, confidence, properties=()):
+    return {
+        'type': type_,
+        'value': mention_text,
+        'confidence': round(confidence or 0.0, 4),
+        'properties': list(properties),
+    }
+
+
+def _record_from_json(entity):
+    # Batch output uses camelCase field names; accept snake_case too
+    mention_text = entity.get('mentionText', entity.get('mention_text', ''))
+    properties = [_record_from_json(prop) for prop in entity.get('properties', ())]
+    return _entity_record(entity.get('type', ''), mention_text, float(entity.get('confidence', 0.0)), properties)
+
+
+def _record_from_proto(entity):
+    properties = [_record_from_proto(prop) for prop in entity.properties]
+    return _entity_record(entity.type_, entity.mention_text, entity.confidence, properties)
+
+
+def iter_entities_from_stream(stream):
+    # Yields entity records from a file-like object holding Document JSON, without materializing the Document
+    for entity in ijson.items(stream, 'entities.item', use_float=True):
+        yield _record_from_json(entity)
+
+
+def iter_entities_from_bytes(blob_as_bytes):
+    # Full-proto path: parses the whole Document, kept as the fallback
+    from google.cloud import documentai_v1beta3 as documentai
+    document = documentai.types.Document.from_json(blob_as_bytes)
+    # For a full list of Document object attributes, please reference this page:
+    # https://cloud.google.com/document-ai/docs/reference/rpc/google.cloud.documentai.v1beta3#document
+    for entity in document.entities:
+        yield _record_from_proto(entity)
+
+
+def iter_entities(blob):
+    if STREAM_ENTITIES and ijson is not None:
+        with blob.open('rb', chunk_size=READ_CHUNK_SIZE) as stream:
+            yield from iter_entities_from_stream(stream)
+    else:
+        yield from iter_entities_from_bytes(blob.download_as_bytes())
+
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Shard prefetch #########
+# Large batch outputs are split into many shards under one prefix. prefetch_entities downloads and parses up to
+# `workers` shards in parallel on a thread pool (GCS reads dominate, so threads hide the latency) while yielding
+# results strictly in input order, so downstream transform/load order stays deterministic. Shards are only submitted
+# while the total size of shards in flight stays under max_bytes; one shard is always allowed so an oversized shard
+# cannot stall the pipeline. Each read runs in a copy of the caller's context, so context variables such as the
+# telemetry correlation id carry over to the worker threads.
+
+def read_shard(blob):
+    return list(iter_entities(blob))
+
+
+def prefetch_entities(blobs, workers=4, max_bytes=256 * 1024 * 1024, read=read_shard):
+    if workers <= 1:
+        for blob in blobs:
+            yield blob, read(blob)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard-prefetch') as pool:
+        pending = deque()
+        in_flight = 0
+        try:
+            for blob in blobs:
+                size = blob.size or 0
+                while pending and (len(pending) >= 2 * workers or in_flight + size > max_bytes):
+                    done_blob, future, done_size = pending.popleft()
+                    in_flight -= done_size
+                    yield done_blob, future.result()
+                pending.append((blob, pool.submit(contextvars.copy_context().run, read, blob), size))
+                in_flight += size
+            while pending:
+                done_blob, future, _ = pending.popleft()
+                yield done_blob, future.result()
+        finally:
+            for _, future, _ in pending:
+                future.cancel()
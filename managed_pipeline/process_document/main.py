@@ -1,16 +1,19 @@
-import sys
-import os
-import google.auth
-import pandas as pd
-import re
 import base64
-import json
-import argparse
+import contextvars
+import signal
 import time
-from google.cloud import storage
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from google.cloud import bigquery
-from google.cloud import pubsub_v1
-from google.cloud import documentai_v1beta3 as documentai
+from docparse import prefetch_entities, read_shard
+from bq_sink import BigQuerySink
+from staging import resolve_format, file_extension, load_job_config, serialize_frame, serialize_records
+from result_cache import ResultCache, GcsTier
+from worker import PullWorker
+import telemetry
+from telemetry import span
 
 #---------------------------------------------------------------------------------------------------------------------
 ######### Initialize variables #########
@@ -24,165 +27,328 @@ gcs_output_csv_bucket = 'dk_docai_invoice_csv_archives'
 bq_dataset = 'document_ai'
 invoice_table = 'invoice_data'
 inventory_table = 'inventory_sold'
+###------ BQ Sink Variables ------###
+BQ_FLUSH_MAX_ROWS = 50000                                                # Flush buffered rows at this many rows ...
+BQ_FLUSH_MAX_BYTES = 64 * 1024 * 1024                                    # ... or this many bytes ...
+BQ_FLUSH_MAX_LATENCY = 5                                                 # ... or once the oldest row is this old (s)
+FINISH_WORKERS = 8                                                       # Threads caching / cleaning up loaded documents
+STAGING_FORMAT = resolve_format('parquet')                               # 'parquet' or 'csv'
+###------ Transform Variables ------###
+TRANSFORM_ENGINE = 'records'                                             # 'records' (plain typed dicts) or 'pandas'
+###------ Shard Variables ------###
+SHARD_WORKERS = 4                                                        # Shards downloaded / parsed in parallel
+SHARD_PREFETCH_MAX_BYTES = 256 * 1024 * 1024                             # Cap on the size of shards in flight
+###------ Result Cache Variables ------###
+RESULT_CACHE_ENABLED = True                                              # Store entities for the ingest-side cache
+result_cache_bucket = 'dk_docai_document_archive'                        # Must match ingest_document's cache location
+result_cache_prefix = 'docai_result_cache/'
+###------ Telemetry Variables ------###
+TELEMETRY_EXPORT = 'log'                                                 # 'log' (JSON lines), 'otel' or 'off'
 ###------ Script Variables ------###
 pubsub_topic = 'docai-topic'
 subscription_id = 'docai-topic-sub'
+###------ Pull Worker Variables ------###
+WORKER_CONCURRENCY = 8                                                   # Messages processed at once by run_worker
+WORKER_MAX_MESSAGES = 100                                                # Leased but unacked messages ...
+WORKER_MAX_BYTES = 10 * 1024 * 1024                                      # ... and bytes (Pub/Sub FlowControl)
+WORKER_MAX_LEASE_DURATION = 3600                                         # Stop extending a message's lease after (s)
+
+telemetry.configure(TELEMETRY_EXPORT)
 
 #---------------------------------------------------------------------------------------------------------------------
-def triggered(event, context):
-    print("This Function was triggered by messageId {} published at {} to {}".format(context.event_id, context.timestamp, context.resource["name"]))
-    from concurrent.futures import TimeoutError
-    
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(project_id, subscription_id)
-    def callback(message):
-        message.ack()
+######### Client registry #########
+# Clients are created lazily, once per function instance, and reused by every invocation the instance serves so
+# that auth, channel setup and TLS handshakes are only paid on cold start. The lock makes first use safe when the
+# instance handles concurrent requests; client_stats counts how often each client was created vs. reused, and is
+# logged with every invocation's stage summary.
+# Libraries only some invocations need (Cloud Storage, Pub/Sub, pandas for TRANSFORM_ENGINE = 'pandas') are imported
+# inside the functions that use them, so they are not loaded on cold start before the first request needs them.
+
+_clients = {}
+_clients_lock = threading.RLock()                                      # factories may fetch other clients
+client_stats = {'created': Counter(), 'reused': Counter()}
+
+def get_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+                client_stats['created'][name] += 1
+                return client
+    with _clients_lock:
+        client_stats['reused'][name] += 1
+    return client
+
+def client_counts():
+    # {client name: {'created': n, 'reused': n}} since the instance started, for the per-invocation report
+    with _clients_lock:
+        return {name: {'created': client_stats['created'][name], 'reused': client_stats['reused'][name]}
+                for name in client_stats['created']}
+
+def get_storage_client():
+    from google.cloud import storage
+    return get_client('storage', storage.Client)
 
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
+def get_bigquery_client():
+    return get_client('bigquery', bigquery.Client)
 
+def get_subscriber_client():
+    from google.cloud import pubsub_v1
+    return get_client('pubsub_subscriber', pubsub_v1.SubscriberClient)
+
+#---------------------------------------------------------------------------------------------------------------------
+def triggered(event, context):
+    telemetry.event("This Function was triggered by messageId {} published at {} to {}".format(context.event_id, context.timestamp, context.resource["name"]))
     if 'data' in event:
-        blob_name = base64.b64decode(event['data']).decode('utf-8')
-        print(f"1. Received message on topic *{pubsub_topic}* and subscription *{subscription_id}* ... message data -->> {blob_name}. ACK sent!")
-        process_blob(blob_name)
+        handle_message(base64.b64decode(event['data']), event.get('attributes') or {}, context.event_id)
+        report()
+    else:
+        telemetry.event(f"No data found in {context.event_id}", severity='WARNING')
+
+def handle_message(data, attributes, message_id, wait=True, **span_attributes):
+    # One Pub/Sub message: data is the output prefix (or a shard) of one document. Returns once its rows are loaded,
+    # or with wait=False as soon as they are buffered, with a Future that completes once they are loaded
+    blob_name = data.decode('utf-8')
+    # ingest_document passes the upload's correlation id along; older messages fall back to this message's id
+    with telemetry.correlation(attributes.get('correlation_id') or message_id):
+        with span('process', prefix=blob_name, source=attributes.get('source'), cache=attributes.get('cache'),
+                  route=attributes.get('route'), **span_attributes):
+            return process_blob(blob_name, attributes.get('cache_key'), wait=wait)
+
+def upload_pd_to_gcs(bucket_name, pdframe, out_file_name, schema):
+    storage_client = get_storage_client()
+    bucket = storage_client.bucket(bucket_name)
+    # pdframe is a DataFrame, or a list of dicts from the records transform
+    serialize = serialize_records if isinstance(pdframe, list) else serialize_frame
+    with span('stage', file=f'gs://{bucket_name}/{out_file_name}', rows=len(pdframe), format=STAGING_FORMAT) as stage:
+        buffer, content_type = serialize(pdframe, schema, STAGING_FORMAT)
+        stage.set(bytes=buffer.getbuffer().nbytes)
+        bucket.blob(out_file_name).upload_from_file(buffer, content_type=content_type)
+
+def stage_frame(table_name, pdframe):
+    # Stages one flush worth of rows in GCS for ingest and archival; returns the uri for the load job
+    out_file_name = table_name + '_' + time.strftime("%m%d%Y_%H%M%S") + '_' + uuid.uuid4().hex[:8] + file_extension(STAGING_FORMAT)
+    upload_pd_to_gcs(gcs_output_csv_bucket, pdframe, out_file_name, table_schemas[table_name])
+    return f'gs://{gcs_output_csv_bucket}/{out_file_name}'
+
+### Define Schema for invoice and inventory tables
+invoice_schema = [
+    bigquery.SchemaField('invoice_id', 'STRING'),
+    bigquery.SchemaField('invoice_date', 'DATE'),
+    bigquery.SchemaField('due_date', 'DATE'),
+    bigquery.SchemaField('purchase_order', 'STRING'),
+    bigquery.SchemaField('supplier_name', 'STRING'),
+    bigquery.SchemaField('receiver_tax_id', 'STRING'),
+    bigquery.SchemaField('receiver_name', 'STRING'),
+    bigquery.SchemaField('receiver_address', 'STRING'),
+    bigquery.SchemaField('total_tax_amount', 'FLOAT'),
+    bigquery.SchemaField('freight_amount', 'FLOAT'),
+    bigquery.SchemaField('net_amount', 'FLOAT'),
+    bigquery.SchemaField('total_amount', 'FLOAT'),
+]
+
+inventory_schema = [
+    bigquery.SchemaField('invoice_id', 'STRING'),
+    bigquery.SchemaField('item_description', 'STRING'),
+    bigquery.SchemaField('item_quantity', 'FLOAT'),
+    bigquery.SchemaField('item_unit_price', 'FLOAT'),
+    bigquery.SchemaField('item_total', 'FLOAT'),
+]
+
+table_schemas = {invoice_table: invoice_schema, inventory_table: inventory_schema}
+
+def get_result_cache():
+    # Write-only here: ingest_document reads the same GCS prefix before invoking the processor
+    return get_client('result_cache', lambda: ResultCache([GcsTier(get_storage_client().bucket(result_cache_bucket), result_cache_prefix)],
+                                                           log=telemetry.event))
+
+def get_bq_sink():
+    # One buffering sink per instance: rows from many documents share a staged file and a load job per table
+    def make_sink():
+        return BigQuerySink(
+            get_bigquery_client(), stage_frame,
+            tables={
+                invoice_table: (f'{project_id}.{bq_dataset}.{invoice_table}', load_job_config(invoice_schema, STAGING_FORMAT)),
+                inventory_table: (f'{project_id}.{bq_dataset}.{inventory_table}', load_job_config(inventory_schema, STAGING_FORMAT)),
+            },
+            max_rows=BQ_FLUSH_MAX_ROWS, max_bytes=BQ_FLUSH_MAX_BYTES, max_latency=BQ_FLUSH_MAX_LATENCY,
+            log=telemetry.event)
+    return get_client('bigquery_sink', make_sink)
+
+def report():
+    # Per-invocation (or, for the pull worker, per-run) metrics: the sink's flush counts and latencies, then the
+    # stage histograms with the client created / reused counts
+    if 'bigquery_sink' in _clients:
+        telemetry.event("BigQuery sink", **_clients['bigquery_sink'].metrics())
+    telemetry.report(clients=client_counts())
+
+
+def process_blob(blob_name, cache_key=None, wait=True):
+    # Results are written to GCS. blob_name is a document's output prefix (or one of its shards); only the shards
+    # in that directory belong to the document, so process exactly those. When the ingest side sent a cache_key,
+    # the document's entities are stored in the result cache once they are loaded. With wait=False, returns once the
+    # rows are buffered, with a Future that completes after they are loaded and the document is cleaned up.
+    prefix = blob_name.rpartition('/')[0] + '/'
+
+    sink = get_bq_sink()
+    with sink.document(prefix) as document:
+        storage_client = get_storage_client()
+        with span('list_outputs', prefix=prefix) as stage:
+            bucket = storage_client.get_bucket(gcs_output_bucket)
+            blob_list = list(bucket.list_blobs(prefix=prefix))
+            stage.set(objects=len(blob_list))
+
+        processed = []
+        document_entities = []
+        json_blobs = []
+        for blob in blob_list:
+            if ".json" in blob.name:
+                json_blobs.append(blob)
+            else:
+                telemetry.event(f"Skipping non-supported file type {blob.name}", severity='WARNING')
+
+        # Shards are downloaded and parsed in parallel but come back in listing order. All shards under the prefix are
+        # one document (batch output splits long documents, online page-range shards are written the same way), so
+        # their entities are merged into one entity set: header fields found on any shard land on the same invoice row.
+        for blob, entities in prefetch_entities(json_blobs, SHARD_WORKERS, SHARD_PREFETCH_MAX_BYTES, read=traced_read_shard):
+            document_entities.extend(entities)
+            processed.append(blob)
+
+        if processed and TRANSFORM_ENGINE == 'records':
+            transform_records(document, document_entities)
+        elif processed:
+            from transform import entities_to_frame
+            # Read the entities output from the processor into the long entity frame
+            with span('frame', shards=len(processed), entities=len(document_entities)) as stage:
+                df = entities_to_frame([(prefix, document_entities)])
+                stage.set(rows=len(df))
+            transform_data(document, df)
+
+    # Temp blobs are only deleted once their rows are in BigQuery. Documents handled concurrently on this instance
+    # share the flush that loads them (see bq_sink.py)
+    if not wait:
+        done = Future()
+        context = contextvars.copy_context()                            # correlation id for the spans below
+        document.loaded.add_done_callback(lambda loaded: get_finish_executor().submit(
+            context.run, finish_document, loaded, done, processed, document_entities, cache_key))
+        return done
+    with span('load', rows=document.rows()):
+        document.loaded.result()
+    store_and_cleanup(processed, document_entities, cache_key)
+
+
+def get_finish_executor():
+    # Caching and cleanup of loaded documents run here, not on the thread that flushed them, so their GCS round trips
+    # do not hold up the next flush
+    return get_client('finish_executor', lambda: ThreadPoolExecutor(max_workers=FINISH_WORKERS, thread_name_prefix='finish'))
+
+
+def finish_document(loaded, done, processed, entities, cache_key):
+    # Runs on the finish executor once the flush holding the document completed
+    try:
+        loaded.result()
+        store_and_cleanup(processed, entities, cache_key)
+    except Exception as e:
+        done.set_exception(e)
     else:
-        print(f"1. No data found in found in {context.event_id}")
-
-def upload_pd_as_csv_to_gcs(bucket_name, pdframe, out_file_name):
-    print(f"** Uploading data as CSV to output bucket >> {gcs_output_csv_bucket}")
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    bucket.blob(out_file_name).upload_from_string(pdframe.to_csv(index=False), 'text/csv')
-    print(f"->> Upload completed. Creating schema Bigquery ingest for *{out_file_name}* ...")
-
-def load_csv_to_bq(table_name, schema, csv):
-    bq_client = bigquery.Client()      #Construct a BigQuery client object.
-    table_id = f'{project_id}.{bq_dataset}.{table_name}'
-    print(f"** Checking if *{table_id}* exists in Bigquery. If yes, will append rows. If not, will create table and add rows")
-    output_uri = f'gs://{gcs_output_csv_bucket}/{csv}'
-
-    load_job = bq_client.load_table_from_uri(output_uri, table_id, job_config=schema)  # Make an API request.
-    load_job.result()  # Waits for the job to complete.
-    destination_table = bq_client.get_table(table_id)  # Make an API request.
-    print(f'->> Insert row complete. {destination_table.num_rows} rows now available in table {table_name}')
-
-
-def process_blob(blob_name):
-    # Results are written to GCS. Use a regex to find output files
-    match = re.match(r"([^/]+)/(.+)", blob_name)
-    prefix = match.group(1) + '/'
-
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(gcs_output_bucket)
-    blob_list = list(bucket.list_blobs(prefix=prefix))
-
-    for i, blob in enumerate(blob_list):
-    # If JSON file, download the contents of this blob as a bytes object.
-        if ".json" in blob_name:
-            blob_as_bytes = blob.download_as_string()
-            print(f'3. Fetched file {i} >> {blob_name}')
-            print("4. Downloading blob as bytes for tranformation...")
-            document = documentai.types.Document.from_json(blob_as_bytes)
-            # For a full list of Document object attributes, please reference this page:
-            # https://cloud.google.com/document-ai/docs/reference/rpc/google.cloud.documentai.v1beta3#document
-            # Read the entities output from the processor
-            types = []
-            values = []
-            confidence = []
-                
-            for entity in document.entities:
-                types.append(entity.type_)
-                values.append(entity.mention_text)
-                confidence.append(round(entity.confidence,4))
-
-            # Create a Pandas Dataframe to print the values in tabular format. 
-            df = pd.DataFrame({'type': types, 'value': values, 'confidence': confidence})
-            transform_data(df)
-            i=i+1
-            print(f"Load completed, deleting temp. blob >> {blob} and shutting down...")
-            blob.delete()     
-        else:
-            print(f"Skipping non-supported file type {blob.name}")
-            i=i+1
-    
-
-
-def transform_data(df: dict):
+        done.set_result(None)
+
+
+def store_and_cleanup(processed, entities, cache_key):
+    if cache_key and RESULT_CACHE_ENABLED:
+        with span('cache_store', entities=len(entities)):
+            get_result_cache().put(cache_key, entities)
+    with span('cleanup', blobs=len(processed)):
+        for blob in processed:
+            blob.delete()
+
+
+def traced_read_shard(blob):
+    # Runs on the prefetch threads, which inherit the caller's correlation id
+    with span('parse_shard', shard=blob.name, bytes=blob.size) as stage:
+        entities = read_shard(blob)
+        stage.set(entities=len(entities))
+    return entities
+
+
+def transform_records(document, entities):
+    # One document's entities -> typed invoice and line item records, without pandas (see records.py), added to the
+    # document's rows in the sink
+    from records import transform_document
+    with span('transform', entities=len(entities)) as stage:
+        invoice, invoice_rejects, line_items, rejects = transform_document(entities)
+        stage.set(rows=int(invoice is not None), line_items=len(line_items), rejects=len(invoice_rejects) + len(rejects))
+    if invoice_rejects:
+        listing = '\n'.join(f"{reject['field']:>16}  {reject['value']!r}" for reject in invoice_rejects)
+        telemetry.event(f"{len(invoice_rejects)} invoice fields could not be parsed and were left empty:\n{listing}",
+                        severity='WARNING')
+    if invoice is not None:
+        document.add(invoice_table, [invoice])
+    if rejects:
+        listing = '\n'.join(f"{reject['line_item']:>5}  {reject['value']!r}" for reject in rejects)
+        telemetry.event(f"{len(rejects)} line items could not be parsed and were skipped:\n{listing}", severity='WARNING')
+    document.add(inventory_table, line_items)
+
+
+def transform_data(document, df):
+    # df is the long entity frame (document_id, type, value, confidence) for one or many documents
+    from transform import transform_invoices, extract_line_items
     #Normalize Data
-    print("5. Beginning data normalization and transformation...")
-    df_t = df.rename(columns={'type':'index'}).drop(columns=['confidence']).T
-    df_t.columns = df_t.iloc[0]
-    df_t = df_t.drop(df_t.index[0])
-    df_t = df_t.reset_index(drop=True)
-    # transform amount columns and create 
-    for num_col in [col for col in df_t.columns if '_amount' in col]:
-        df_t[num_col] = pd.to_numeric(df_t[num_col].replace({'\$':'', ',':''}, regex = True))
-
-    # transform data
-    df_t['due_date'] = pd.to_datetime(df_t['due_date'])
-    df_t['invoice_date'] = pd.to_datetime(df_t['invoice_date'])
-    df_t['receiver_name'] = df_t['receiver_name'].str.replace(",",'')
-    df_t['receiver_address'] = df_t['receiver_address'].replace('\\n',' ', regex=True)
-
-    print("6. Data tranformation completed.")
-    ### Define Schema for invoice table and export csv for ingest and archival in GCS
-    keeper_cols = ['invoice_id','invoice_date','due_date','purchase_order','supplier_name','receiver_tax_id','receiver_name',"receiver_address",'total_amount','total_tax_amount','net_amount','freight_amount']
-    df_t = df_t[keeper_cols]
-    out_file_name = invoice_table + '_' + time.strftime("%m%d%Y_%H%M%S") + '.csv'
-    upload_pd_as_csv_to_gcs(gcs_output_csv_bucket, df_t, out_file_name)
-    
-    job_config_invoice = bigquery.LoadJobConfig(
-        schema=[
-            bigquery.SchemaField('invoice_id', 'STRING'),
-            bigquery.SchemaField('invoice_date', 'DATE'),
-            bigquery.SchemaField('due_date', 'DATE'),
-            bigquery.SchemaField('purchase_order', 'STRING'),
-            bigquery.SchemaField('supplier_name', 'STRING'),
-            bigquery.SchemaField('receiver_tax_id', 'STRING'),
-            bigquery.SchemaField('receiver_name', 'STRING'),
-            bigquery.SchemaField('receiver_address', 'STRING'),
-            bigquery.SchemaField('total_tax_amount', 'FLOAT'),
-            bigquery.SchemaField('freight_amount', 'FLOAT'),
-            bigquery.SchemaField('net_amount', 'FLOAT'),
-            bigquery.SchemaField('total_amount', 'FLOAT'),
-        ],
-        skip_leading_rows=1,
-        # The source format defaults to CSV, so the line below is optional.
-        source_format=bigquery.SourceFormat.CSV,
-    )
-    load_csv_to_bq(invoice_table ,job_config_invoice, out_file_name)
+    with span('transform', entity_rows=len(df)) as stage:
+        df_t, invoice_rejects = transform_invoices(df)
+        stage.set(rows=len(df_t), rejects=len(invoice_rejects))
+    if len(invoice_rejects):
+        telemetry.event(f"{len(invoice_rejects)} invoice fields could not be parsed and were left empty:\n"
+                        f"{invoice_rejects.to_string(index=False)}", severity='WARNING')
+    document.add(invoice_table, df_t)
 
     #---------------------------------------------------------------------------------------------------------------------
     ### Inventory Data / line item --- add processor results to a Pandas Dataframe and transform for BQ ingestion
-    add_row = []
-
-    line_item_values = df.loc[df["type"] == 'line_item', "value"]
-    line_items= line_item_values.to_numpy()
-
-    var = df_t['invoice_id'].iloc[0]
-    
-    for value in line_items:
-        new_val = value.replace("$","")
-        x = re.match(r"([\W\w\s]*)\s(\d+)\s([\W\w]*)\s([\W\w]*)", new_val)
-        if len(add_row) == 0:
-            add_row = [(var, x.group(1), x.group(2), x.group(3), x.group(4))]
-        else:
-            add_row.extend([(var, x.group(1), x.group(2), x.group(3), x.group(4))])
-
-    ### Define Schema for inventory table and export csv for ingest and archival in GCS
-    df2 = pd.DataFrame(add_row, columns=['invoice_id', 'item_description', 'item_quantity', 'item_unit_price', 'item_total'])
-    out_file_name = inventory_table + '_' + time.strftime("%m%d%Y_%H%M%S") + '.csv'
-    upload_pd_as_csv_to_gcs(gcs_output_csv_bucket, df2, out_file_name)
-
-    job_config_inventory = bigquery.LoadJobConfig(
-        schema=[
-            bigquery.SchemaField('invoice_id', 'STRING'),
-            bigquery.SchemaField('item_description', 'STRING'),
-            bigquery.SchemaField('item_quantity', 'FLOAT'),
-            bigquery.SchemaField('item_unit_price', 'FLOAT'),
-            bigquery.SchemaField('item_total', 'FLOAT'),
-        ],
-        skip_leading_rows=1,
-        # The source format defaults to CSV, so the line below is optional.
-        source_format=bigquery.SourceFormat.CSV,
-    )
-    load_csv_to_bq(inventory_table, job_config_inventory, out_file_name)
+    with span('line_items') as stage:
+        df2, rejects = extract_line_items(df, df_t['invoice_id'])
+        stage.set(rows=len(df2), rejects=len(rejects))
+    if len(rejects):
+        telemetry.event(f"{len(rejects)} line items could not be parsed and were skipped:\n{rejects.to_string(index=False)}",
+                        severity='WARNING')
+    document.add(inventory_table, df2)
+
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Pull worker entry point #########
+# For a VM or container instead of one function invocation per message: `python main.py` pulls from subscription_id
+# with PullWorker (see worker.py) until SIGTERM or SIGINT. A handler returns as soon as the message's rows are buffered;
+# the message is acked once the flush holding them has loaded them and its shards are deleted, and nacked when any of
+# that fails, to be redelivered after the subscription's retry backoff. Handled messages wait for a shared flush, so
+# WORKER_MAX_MESSAGES also bounds how many documents one load job can carry. Run it instead of deploying the
+# triggered function for the same topic: the function's trigger has its own subscription, so both would load every
+# document.
+
+def get_pull_worker():
+    def make_worker():
+        subscriber = get_subscriber_client()
+        return PullWorker(subscriber, subscriber.subscription_path(project_id, subscription_id), handle_pulled_message,
+                          concurrency=WORKER_CONCURRENCY, max_messages=WORKER_MAX_MESSAGES, max_bytes=WORKER_MAX_BYTES,
+                          max_lease_duration=WORKER_MAX_LEASE_DURATION)
+    return get_client('pull_worker', make_worker)
+
+def handle_pulled_message(message):
+    return handle_message(message.data, dict(message.attributes), message.message_id, wait=False,
+                          delivery_attempt=message.delivery_attempt)
+
+def run_worker():
+    worker = get_pull_worker()
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: worker.stop())
+    try:
+        worker.run()
+    finally:
+        report()
+        get_subscriber_client().close()
+
+
+if __name__ == '__main__':
+    run_worker()
@@ -0,0 +1,132 @@
+import math
+import re
+from datetime import date, datetime
+
+import invoice_fields
+from invoice_fields import (DUPLICATE_POLICIES, amount_cols, date_cols, keeper_cols, line_item_numeric_cols,
+                            line_item_properties, split_line_item)
+
+try:
+    from dateutil import parser as date_parser                          # Optional: free-form invoice dates
+except ImportError:
+    date_parser = None
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Pandas-free invoice transform #########
+# process_document handles one document per message, where building and pivoting DataFrames costs more than the
+# transform itself, and pandas is the largest import of the function. These functions apply the same rules as
+# transform.py (invoice_fields.py, amount / date / text normalization, line items from properties or text) to one
+# document's entity list and return plain dicts holding typed values (str, float, datetime.date, None), ready to be
+# staged by staging.serialize_records.
+
+_AMOUNT_CHARS = re.compile(r'[$,]')
+
+
+def to_number(value):
+    # '$1,234.50' -> 1234.5; anything that is not a number -> None
+    if value is None:
+        return None
+    try:
+        number = float(_AMOUNT_CHARS.sub('', value))
+    except ValueError:
+        return None
+    return None if math.isnan(number) else number
+
+
+def to_date(value):
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value.strip())
+    except ValueError:
+        pass
+    if date_parser is not None:
+        try:
+            return date_parser.parse(value).date()
+        except (ValueError, OverflowError):
+            return None
+    for fmt in ('%m/%d/%Y', '%B %d, %Y', '%b %d, %Y', '%d %B %Y'):
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            pass
+    return None
+
+
+def header_values(entities, policy=None):
+    # type -> value of every header (non line item) entity and property, duplicates resolved by the policy
+    policy = policy or invoice_fields.duplicate_policy
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate policy {policy!r}, expected one of {DUPLICATE_POLICIES}")
+    chosen = {}
+    for entity in entities:
+        for candidate in [entity, *entity.get('properties', ())]:
+            type_ = candidate['type']
+            if type_.startswith('line_item'):
+                continue
+            if type_ not in chosen or policy == 'last':
+                chosen[type_] = candidate
+            elif policy == 'max_confidence' and candidate['confidence'] > chosen[type_]['confidence']:
+                chosen[type_] = candidate
+            elif policy == 'join':
+                chosen[type_] = dict(chosen[type_], value=chosen[type_]['value'] + ' ' + candidate['value'])
+    return {type_: candidate['value'] for type_, candidate in chosen.items()}
+
+
+def invoice_record(entities, policy=None):
+    # Returns (record, rejects); a header value that cannot be typed is left empty and returned as a
+    # {'field', 'value'} reject, as transform.normalize_invoices does
+    values = header_values(entities, policy)
+    record = {col: values.get(col) for col in keeper_cols}
+    rejects = []
+    for cols, convert in ((amount_cols, to_number), (date_cols, to_date)):
+        for col in cols:
+            raw = record[col]
+            record[col] = convert(raw)
+            if record[col] is None and raw is not None and raw.strip():
+                rejects.append({'field': col, 'value': raw})
+    if record['receiver_name'] is not None:
+        record['receiver_name'] = record['receiver_name'].replace(',', '')
+    if record['receiver_address'] is not None:
+        record['receiver_address'] = record['receiver_address'].replace('\n', ' ')
+    return record, rejects
+
+
+def line_item_records(entities, invoice_id):
+    # Returns (line items, rejects); rejects are {'line_item', 'value'} for rows that could not be typed
+    items = []
+    rejects = []
+    for index, entity in enumerate(entity for entity in entities if entity['type'] == 'line_item'):
+        fields = {}
+        for prop in entity.get('properties', ()):
+            column = line_item_properties.get(prop['type'])
+            if column and column not in fields:
+                fields[column] = prop['value']
+        from_props = bool(fields)
+        if not from_props:
+            fields = split_line_item(entity['value'].replace('$', ''))
+            if fields is None:
+                rejects.append({'line_item': index, 'value': entity['value']})
+                continue
+
+        record = {'invoice_id': invoice_id, 'item_description': fields.get('item_description')}
+        rejected = False
+        for num_col in line_item_numeric_cols:
+            raw = fields.get(num_col)
+            record[num_col] = to_number(raw)
+            rejected |= raw is not None and record[num_col] is None
+        if rejected:
+            rejects.append({'line_item': index, 'value': entity['value']})
+        else:
+            items.append(record)
+    return items, rejects
+
+
+def transform_document(entities, policy=None):
+    # Returns (invoice record, invoice rejects, line item records, line item rejects) for one document. A document
+    # without entities has no rows at all (invoice None), as in transform.py, where it never reaches the pivot.
+    if not entities:
+        return None, [], [], []
+    invoice, invoice_rejects = invoice_record(entities, policy)
+    line_items, rejects = line_item_records(entities, invoice['invoice_id'])
+    return invoice, invoice_rejects, line_items, rejects
@@ -0,0 +1,88 @@
+import csv
+import io
+
+from google.cloud import bigquery
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:                                                     # CSV staging still works without pyarrow
+    pa = None
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Staging formats #########
+# Frames are staged in GCS before the BigQuery load job. Parquet (the default) is written straight from the pandas
+# buffers through Arrow with column types taken from the table schema, so the load job neither reparses text nor
+# coerces DATE/FLOAT from strings, and columns are matched by name rather than position. CSV is kept for
+# environments without pyarrow and for human-readable archives. serialize_records writes the same files from lists of
+# typed dicts (records.py), without pandas.
+
+STAGING_FORMATS = ('parquet', 'csv')
+
+_arrow_types = {
+    'STRING': lambda: pa.string(),
+    'DATE': lambda: pa.date32(),
+    'FLOAT': lambda: pa.float64(),
+    'FLOAT64': lambda: pa.float64(),
+    'INTEGER': lambda: pa.int64(),
+    'INT64': lambda: pa.int64(),
+    'TIMESTAMP': lambda: pa.timestamp('us', tz='UTC'),
+}
+
+
+def resolve_format(staging_format):
+    if staging_format not in STAGING_FORMATS:
+        raise ValueError(f"Unknown staging format {staging_format!r}, expected one of {STAGING_FORMATS}")
+    if staging_format == 'parquet' and pa is None:
+        print("** pyarrow is not installed, staging as CSV instead of Parquet")
+        return 'csv'
+    return staging_format
+
+
+def file_extension(staging_format):
+    return '.' + staging_format
+
+
+def load_job_config(schema, staging_format):
+    # The load job's source_format always matches the staged file
+    if staging_format == 'parquet':
+        return bigquery.LoadJobConfig(schema=schema, source_format=bigquery.SourceFormat.PARQUET)
+    return bigquery.LoadJobConfig(schema=schema, skip_leading_rows=1, source_format=bigquery.SourceFormat.CSV)
+
+
+def arrow_schema(schema):
+    return pa.schema([pa.field(field.name, _arrow_types[field.field_type.upper()]()) for field in schema])
+
+
+def serialize_frame(pdframe, schema, staging_format):
+    # Returns (file object positioned at 0, content type)
+    buffer = io.BytesIO()
+    columns = [field.name for field in schema]
+    if staging_format == 'parquet':
+        table = pa.Table.from_pandas(pdframe[columns], schema=arrow_schema(schema), preserve_index=False)
+        pq.write_table(table, buffer, compression='snappy')
+        content_type = 'application/octet-stream'
+    else:
+        pdframe[columns].to_csv(buffer, index=False, encoding='utf-8')       # CSV loads map columns by position
+        content_type = 'text/csv'
+    buffer.seek(0)
+    return buffer, content_type
+
+
+def serialize_records(records, schema, staging_format):
+    # Same output as serialize_frame, from a list of dicts holding typed values (None for missing)
+    buffer = io.BytesIO()
+    columns = [field.name for field in schema]
+    if staging_format == 'parquet':
+        data = {column: [record.get(column) for record in records] for column in columns}
+        pq.write_table(pa.Table.from_pydict(data, schema=arrow_schema(schema)), buffer, compression='snappy')
+        content_type = 'application/octet-stream'
+    else:
+        text = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+        writer = csv.writer(text, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(['' if record.get(column) is None else record[column] for column in columns] for record in records)
+        text.detach()
+        content_type = 'text/csv'
+    buffer.seek(0)
+    return buffer, content_type
@@ -0,0 +1,204 @@
+import contextlib
+import functools
+import json
+import sys
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextvars import ContextVar
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Stage telemetry #########
+# span(stage, **attributes) times one pipeline stage and records its duration in a per-stage histogram, together with
+# counts such as rows, bytes or documents set on the span. Every span carries the correlation id of the document being
+# handled (correlation(), propagated to process_document as a Pub/Sub attribute), so one upload can be followed
+# through both functions. Records are exported as:
+#   'log'   one JSON line per span on stdout, which Cloud Logging ingests as a structured entry
+#   'otel'  OpenTelemetry spans and a duration histogram through the globally configured providers (no exporter is
+#           set up here, so nothing leaves the process unless the deployment configures one)
+#   'off'   span() returns a shared no-op object, so instrumented code costs one call and a global check
+# or any callable(record), e.g. to collect records in memory. report() logs the histograms of every stage.
+
+EXPORTERS = ('log', 'otel', 'off')
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000, 300000, 900000)
+
+_correlation_id = ContextVar('correlation_id', default=None)
+_export = None                                                          # callable(record), None when disabled
+_otel = None                                                            # (tracer, histogram) in 'otel' mode
+otel_trace = None                                                       # Optional: OpenTelemetry API, imported by configure('otel')
+_histograms = {}
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value_ms):
+        self.counts[bisect_left(BUCKETS_MS, value_ms)] += 1
+        self.count += 1
+        self.total += value_ms
+        self.max = max(self.max, value_ms)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th value (the observed max for the overflow bucket)
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'mean_ms': round(self.total / self.count, 3) if self.count else 0.0,
+                'p50_ms': round(self.quantile(0.5), 3), 'p99_ms': round(self.quantile(0.99), 3), 'max_ms': round(self.max, 3)}
+
+
+class Span:
+    __slots__ = ('stage', 'attributes', '_start', '_otel_span')
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._otel_span = None
+        if _otel is not None:
+            self._otel_span = _otel[0].start_as_current_span(self.stage)
+            self._otel_span.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ms = (time.perf_counter() - self._start) * 1000
+        with _lock:
+            _histograms.setdefault(self.stage, Histogram()).record(duration_ms)
+        record = {'severity': 'ERROR' if exc_type else 'INFO', 'message': f'{self.stage} {duration_ms:.1f} ms',
+                  'stage': self.stage, 'duration_ms': round(duration_ms, 3), 'correlation_id': _correlation_id.get()}
+        record.update(self.attributes)
+        if exc_type:
+            record['error'] = f'{exc_type.__name__}: {exc}'
+        if self._otel_span is not None:
+            current = otel_trace.get_current_span()
+            for key, value in record.items():
+                if key not in ('message', 'severity') and value is not None:
+                    current.set_attribute(f'docai.{key}', value if isinstance(value, (str, bool, int, float)) else str(value))
+            _otel[1].record(duration_ms, {'stage': self.stage})
+            self._otel_span.__exit__(exc_type, exc, tb)
+        else:
+            _export(record)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(stage, **attributes):
+    if _export is None:
+        return _NOOP_SPAN
+    return Span(stage, attributes)
+
+
+def traced(stage=None):
+    # Decorator form of span(); the stage defaults to the function name
+    def decorate(function):
+        name = stage or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _export is None:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def correlation(correlation_id=None):
+    # Sets the correlation id for everything run inside the block (a new one if none is given) and yields it
+    token = _correlation_id.set(correlation_id or uuid.uuid4().hex)
+    try:
+        yield _correlation_id.get()
+    finally:
+        _correlation_id.reset(token)
+
+
+def correlation_id():
+    return _correlation_id.get()
+
+
+def log_record(record):
+    sys.stdout.write(json.dumps(record, default=str) + '\n')
+
+
+def configure(exporter='log'):
+    global _export, _otel, otel_trace
+    _otel = None
+    if callable(exporter):
+        _export = exporter
+    elif exporter == 'off':
+        _export = None
+    elif exporter == 'log':
+        _export = log_record
+    elif exporter == 'otel':
+        _export = log_record                                            # used by event() and report()
+        try:
+            from opentelemetry import metrics as otel_metrics
+            from opentelemetry import trace
+        except ImportError:
+            print("** opentelemetry is not installed, exporting telemetry as JSON logs instead")
+        else:
+            otel_trace = trace
+            histogram = otel_metrics.get_meter('docai.pipeline').create_histogram(
+                'docai.stage.duration', unit='ms', description='Duration of one pipeline stage')
+            _otel = (otel_trace.get_tracer('docai.pipeline'), histogram)
+    else:
+        raise ValueError(f"Unknown telemetry exporter {exporter!r}, expected one of {EXPORTERS} or a callable")
+
+
+def event(message, severity='INFO', **attributes):
+    # A one-off progress or error message, with the current correlation id; printed plainly when telemetry is off
+    if _export is None:
+        print(message)
+        return
+    record = {'severity': severity, 'message': message, 'correlation_id': _correlation_id.get()}
+    record.update(attributes)
+    _export(record)
+
+
+def summary():
+    with _lock:
+        return {stage: histogram.snapshot() for stage, histogram in _histograms.items()}
+
+
+def report(**attributes):
+    # Logs the duration histogram of every stage seen by this instance so far, plus any instance-level attributes
+    if _export is not None:
+        _export({'severity': 'INFO', 'message': 'stage summary', 'stages': summary(), **attributes})
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
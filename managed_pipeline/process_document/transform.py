@@ -0,0 +1,122 @@
+import pandas as pd
+
+import invoice_fields
+from invoice_fields import (DUPLICATE_POLICIES, amount_cols, date_cols, keeper_cols, line_item_cols, line_item_numeric_cols,
+                            line_item_properties, split_line_item)
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Invoice transform #########
+# Entities from any number of documents are held in one long frame (document_id, type, value, confidence), pivoted
+# into one wide row per document and normalized with a single vectorized pass per column over the whole batch.
+# Columns, duplicate policies and line item text parsing live in invoice_fields.py, shared with records.py.
+
+
+def entities_to_frame(documents):
+    # documents is an iterable of (document_id, entities); each entity is a dict with type, value and confidence
+    # and optionally nested properties. Properties become rows of their own; line_item numbers every line item
+    # within its document so its properties can be pivoted back onto it.
+    rows = []
+    for document_id, entities in documents:
+        item = 0
+        for entity in entities:
+            line_item = None
+            if entity['type'] == 'line_item':
+                line_item = item
+                item += 1
+            rows.append((document_id, entity['type'], entity['value'], entity['confidence'], line_item))
+            for prop in entity.get('properties', ()):
+                rows.append((document_id, prop['type'], prop['value'], prop['confidence'], line_item))
+    return pd.DataFrame(rows, columns=['document_id', 'type', 'value', 'confidence', 'line_item'])
+
+
+def pivot_entities(df, policy=None):
+    # Long-to-wide: one row per document_id, one column per invoice field. Line items repeat by design and are
+    # handled separately, so they are left out of the pivot.
+    policy = policy or invoice_fields.duplicate_policy
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate policy {policy!r}, expected one of {DUPLICATE_POLICIES}")
+    header = df.loc[~df['type'].str.startswith('line_item'), ['document_id', 'type', 'value', 'confidence']]
+
+    if policy == 'join':
+        wide = header.groupby(['document_id', 'type'], sort=False)['value'].agg(' '.join).unstack('type')
+    else:
+        keep = policy
+        if policy == 'max_confidence':
+            header = header.sort_values('confidence', ascending=False, kind='mergesort')
+            keep = 'first'
+        header = header.drop_duplicates(['document_id', 'type'], keep=keep)
+        wide = header.pivot(index='document_id', columns='type', values='value')
+
+    # Documents keep their input order; fields the processor did not return are left empty
+    wide = wide.reindex(index=pd.unique(df['document_id']), columns=keeper_cols).astype(object)
+    wide.columns.name = None
+    return wide
+
+
+def normalize_invoices(wide):
+    # transform amount columns, dates and free-text fields for the whole batch at once. Returns (invoices, rejects):
+    # a header value that cannot be typed is left empty on its invoice and returned as a reject row
+    # (document_id, field, value), so it is reported like an unparsable line item instead of silently becoming NULL.
+    wide = wide.copy()
+    raw = wide[amount_cols + date_cols]
+    for num_col in amount_cols:
+        wide[num_col] = pd.to_numeric(wide[num_col].str.replace(r'[$,]', '', regex=True), errors='coerce')
+    for date_col in date_cols:
+        wide[date_col] = to_dates(wide[date_col])
+    wide['receiver_name'] = wide['receiver_name'].str.replace(',', '', regex=False)
+    wide['receiver_address'] = wide['receiver_address'].str.replace('\n', ' ', regex=False)
+
+    # Blank values count as missing, not as failures
+    present = raw.notna() & raw.apply(lambda col: col.str.strip().ne(''))
+    failed = (present & wide[raw.columns].isna()).to_numpy()
+    rows, cols = failed.nonzero()
+    rejects = pd.DataFrame({'document_id': wide.index[rows], 'field': raw.columns[cols], 'value': raw.to_numpy()[rows, cols]})
+    return wide, rejects
+
+
+def to_dates(values):
+    # Invoices write dates in many formats. pandas >= 2 infers a single format from the first value of the column and
+    # turns every other format into NaT, so each distinct value is parsed on its own instead.
+    parsed = {value: pd.to_datetime(value, errors='coerce') for value in values.dropna().unique()}
+    return pd.to_datetime(values.map(parsed))
+
+
+def transform_invoices(df, policy=None):
+    # Returns (invoices, rejects), see normalize_invoices
+    return normalize_invoices(pivot_entities(df, policy))
+
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Line item extraction #########
+# A line item is read from its nested properties when the processor returned them. Otherwise its text is split with
+# invoice_fields.split_line_item, one rsplit per row. Rows that neither path can turn into typed values are returned
+# as rejects instead of failing the run.
+
+
+def extract_line_items(df, invoice_ids):
+    # df is the long entity frame, invoice_ids maps document_id -> invoice_id. Returns (line_items, rejects).
+    key = ['document_id', 'line_item']
+    items = df.loc[df['type'] == 'line_item', key + ['value']].set_index(key)['value']
+    fields = line_item_cols[1:]
+
+    props = df.loc[df['type'].isin(list(line_item_properties)) & df['line_item'].notna(), key + ['type', 'value']]
+    props = props.drop_duplicates(key + ['type']).pivot(index=key, columns='type', values='value')
+    parsed = props.rename(columns=line_item_properties).reindex(index=items.index, columns=fields).astype(object)
+    parsed.columns.name = None
+    from_props = parsed.notna().any(axis=1)
+
+    texts = items[~from_props].str.replace('$', '', regex=False)
+    fallback = pd.DataFrame([split_line_item(text) or {} for text in texts], index=texts.index, columns=fields)
+    parsed.loc[~from_props, fields] = fallback.astype(object)
+    # Text rows must match completely; property rows may leave fields the processor did not find empty
+    rejected = ~from_props & parsed[fields].isna().any(axis=1)
+
+    for num_col in line_item_numeric_cols:
+        raw = parsed[num_col]
+        parsed[num_col] = pd.to_numeric(raw.str.replace(r'[$,]', '', regex=True), errors='coerce')
+        rejected |= raw.notna() & parsed[num_col].isna()
+
+    line_items = parsed[~rejected].reset_index()
+    line_items.insert(0, 'invoice_id', line_items['document_id'].map(invoice_ids))
+    rejects = items[rejected].reset_index()
+    return line_items.set_index('document_id')[line_item_cols], rejects
@@ -0,0 +1,102 @@
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import telemetry
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Pull worker #########
+# Long-running alternative to the Pub/Sub-triggered function, for a VM or container: one streaming pull on the
+# subscription feeds a bounded pool of `concurrency` handler threads. FlowControl caps the messages and bytes that are
+# leased but not yet acked or nacked, so a backlog waits in the subscription instead of in memory, and the client keeps
+# extending the lease of every outstanding message (up to max_lease_duration seconds) until it is settled.
+#   handle(message) returns None        -> the message is acked
+#   handle(message) returns a Future    -> the message is acked or nacked when the Future completes; the handler
+#                                          thread is free for the next message meanwhile (e.g. while the document's
+#                                          rows wait for a shared BigQuery flush)
+#   handle(message) or the Future fails -> the message is nacked and redelivered following the subscription's retry
+#                                          policy (and dead-letter topic, if one is configured)
+# stop() ends run(): messages that arrive from then on are nacked so another worker gets them right away, messages
+# already handed to a handler are settled, and only then is the streaming pull closed.
+
+
+class PullWorker:
+    def __init__(self, subscriber, subscription_path, handle, concurrency=8, max_messages=16, max_bytes=10 * 1024 * 1024,
+                 max_lease_duration=3600):
+        # subscriber: pubsub_v1.SubscriberClient (or a fake with the same subscribe())
+        # handle:     callable(message) -> None or Future; message has .data, .attributes, .message_id, .delivery_attempt
+        self.subscriber = subscriber
+        self.subscription_path = subscription_path
+        self.handle = handle
+        self.concurrency = concurrency
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_lease_duration = max_lease_duration
+
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._draining = False
+        self.stats = {'received': 0, 'acked': 0, 'nacked': 0, 'running': 0, 'max_running': 0, 'waiting': 0}
+
+    def _callback(self, message):
+        with self._changed:
+            if self._draining:
+                message.nack()
+                return
+            self.stats['received'] += 1
+            self.stats['running'] += 1
+            self.stats['max_running'] = max(self.stats['max_running'], self.stats['running'])
+        try:
+            pending = self.handle(message)
+        except Exception as e:
+            pending = Future()
+            pending.set_exception(e)
+        if pending is None:
+            pending = Future()
+            pending.set_result(None)
+        with self._changed:
+            self.stats['running'] -= 1
+            self.stats['waiting'] += 1
+        pending.add_done_callback(lambda future: self._settle(message, future))
+
+    def _settle(self, message, future):
+        error = future.exception()
+        if error is None:
+            message.ack()
+        else:
+            message.nack()
+            with telemetry.correlation(message.attributes.get('correlation_id') or message.message_id):
+                telemetry.event(f"Message {message.message_id} failed and was nacked for redelivery: {error}", severity='ERROR',
+                                delivery_attempt=message.delivery_attempt,
+                                traceback=''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+        with self._changed:
+            self.stats['waiting'] -= 1
+            self.stats['nacked' if error is not None else 'acked'] += 1
+            self._changed.notify_all()
+
+    def run(self):
+        # Blocks until stop() is called or the stream fails; a stream failure is raised
+        from google.cloud import pubsub_v1
+        from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+        flow_control = pubsub_v1.types.FlowControl(
+            max_messages=self.max_messages, max_bytes=self.max_bytes, max_lease_duration=self.max_lease_duration)
+        scheduler = ThreadScheduler(ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='pull-worker'))
+        streaming_pull_future = self.subscriber.subscribe(
+            self.subscription_path, callback=self._callback, flow_control=flow_control, scheduler=scheduler,
+            await_callbacks_on_shutdown=True)
+        streaming_pull_future.add_done_callback(lambda _: self._stop.set())
+        telemetry.event(f"Pulling from {self.subscription_path} with {self.concurrency} handlers "
+                        f"(max {self.max_messages} messages / {self.max_bytes} bytes outstanding)")
+        self._stop.wait()
+        # Settle everything already handed to a handler while the stream can still carry the acks
+        with self._changed:
+            self._draining = True
+            while self.stats['running'] or self.stats['waiting']:
+                self._changed.wait()
+        streaming_pull_future.cancel()
+        streaming_pull_future.result()
+        telemetry.event(f"Stopped pulling from {self.subscription_path}", **self.stats)
+
+    def stop(self):
+        # Safe to call from a signal handler or another thread
+        self._stop.set()
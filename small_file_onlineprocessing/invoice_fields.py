@@ -0,0 +1,38 @@
+#---------------------------------------------------------------------------------------------------------------------
+######### Invoice fields #########
+# Table columns, duplicate policies and line item text parsing shared by both transform engines: transform.py (pandas,
+# many documents per frame) and records.py (plain dicts, one document at a time). Kept free of pandas so the records
+# engine never imports it.
+
+###------ Invoice table columns ------###
+keeper_cols = ['invoice_id','invoice_date','due_date','purchase_order','supplier_name','receiver_tax_id','receiver_name',"receiver_address",'total_amount','total_tax_amount','net_amount','freight_amount']
+amount_cols = [col for col in keeper_cols if '_amount' in col]
+date_cols = ['invoice_date', 'due_date']
+
+###------ Duplicate entity types within one document ------###
+# first / last:    keep the first / last occurrence in processor output order
+# max_confidence:  keep the occurrence the processor is most confident about (the first one on a tie)
+# join:            space-join every occurrence into one value, in processor output order with an entity's properties
+#                  right after it; both engines give 'A B' for two entities 'A' and 'B'
+DUPLICATE_POLICIES = ('first', 'last', 'max_confidence', 'join')
+duplicate_policy = 'max_confidence'                                     # default of both engines, read at call time
+
+###------ Inventory table columns ------###
+line_item_cols = ['invoice_id', 'item_description', 'item_quantity', 'item_unit_price', 'item_total']
+line_item_numeric_cols = ['item_quantity', 'item_unit_price', 'item_total']
+line_item_properties = {
+    'line_item/description': 'item_description',
+    'line_item/quantity': 'item_quantity',
+    'line_item/unit_price': 'item_unit_price',
+    'line_item/amount': 'item_total',
+}
+
+
+def split_line_item(text):
+    # "<description> <quantity> <unit price> <amount>" -> {column: str}, or None when the text does not have that
+    # shape: the last three whitespace separated tokens, the first of them an integer, after a description. One
+    # rsplit keeps this linear in the row length; an equivalent regex backtracks quadratically on long whitespace runs.
+    parts = text.rsplit(None, 3)
+    if len(parts) != 4 or not parts[1].isdecimal():
+        return None
+    return dict(zip(line_item_cols[1:], parts))
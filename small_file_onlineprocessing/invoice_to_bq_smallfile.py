@@ -1,134 +1,242 @@
 import sys
 import os
-import google.auth
-import pandas as pd
-import re
-import numpy as np
+import glob
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google.cloud import storage
 from google.cloud import documentai_v1beta3 as documentai
 from google.cloud import bigquery
+from transform import entities_to_frame, transform_invoices, extract_line_items
+from staging import resolve_format, file_extension, load_job_config, serialize_frame
+from result_cache import ResultCache, DiskTier, GcsTier, cache_key, sha256_hex
+from routing import page_count, route, shard_ranges, split_pdf
 
 ### Initialize variables#######
 projectid = "<your-project-name>"                                       			# Your project-id
 location = "us"                                                         			# Format is 'us' or 'eu'
 processorid = "<invoice-processor-id>"                                        			# Create processor in Cloud Console
-sample_invoice = "<location-of-file-on-localdisk>" 						# The local file in your current working directory
-output_bucket="<output-bucket-name>"								# GCS Bucket where output CSVs will be uploaded
+sample_invoice = "<location-of-file-on-localdisk>" 						# Default input when no files are given on the command line
+output_bucket="<output-bucket-name>"								# GCS Bucket where staged output files will be uploaded
+staging_format = resolve_format("parquet")							# 'parquet' or 'csv'
 bq_dataset = "<your-bq-dataset>"
 invoice_table = "invoice_data"
 inventory_table = "inventory_sold"
+concurrency = 8											# Concurrent process_document calls
+processor_qps = 5										# Requests/second allowed by the processor's online quota
+processor_version = "pretrained"								# Part of the result cache key, change it with the processor version
+result_cache_enabled = True									# Reuse results for files processed before
+result_cache_dir = ".docai_result_cache"							# Local disk tier
+result_cache_disk_bytes = 256 * 1024 * 1024
+result_cache_bucket = ""									# Optional GCS tier shared between machines
+result_cache_prefix = "docai_result_cache/"
+result_cache_ttl = 30 * 24 * 3600								# Seconds a cached result stays valid
+online_max_pages = 10										# Online request limits of the processor: pages ...
+online_max_bytes = 20 * 1024 * 1024								# ... and bytes; larger PDFs are split into page ranges
+shard_concurrency = 4										# Page-range shards of one file processed at once
+
+mime_types = {'.pdf': 'application/pdf', '.tif': 'image/tiff', '.tiff': 'image/tiff', '.gif': 'image/gif',
+              '.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg'}
 
 #---------------------------------------------------------------------------------------------------------------------
 
-def upload_pd_as_csv_to_gcs(bucket_name, pdframe, out_file_name):
+def upload_pd_to_gcs(bucket_name, pdframe, out_file_name, schema):
 	storage_client = storage.Client()
-	bucket = storage_client.get_bucket(bucket_name)
-	bucket.blob(out_file_name + '.csv').upload_from_string(pdframe.to_csv(index=False), 'text/csv')
+	bucket = storage_client.bucket(bucket_name)
+	buffer, content_type = serialize_frame(pdframe, schema, staging_format)
+	bucket.blob(out_file_name + file_extension(staging_format)).upload_from_file(buffer, content_type=content_type)
 
 
-def load_csv_to_bq(import_file, schema):
+def load_file_to_bq(import_file, schema):
 	bq_client = bigquery.Client()      #Construct a BigQuery client object.
 	table_id = f'{projectid}.{bq_dataset}.{import_file}'
-	output_uri = f'gs://{output_bucket}/{import_file}.csv'
+	output_uri = f'gs://{output_bucket}/{import_file}{file_extension(staging_format)}'
 
-	load_job = bq_client.load_table_from_uri(output_uri, table_id, job_config=schema)  # Make an API request.
+	load_job = bq_client.load_table_from_uri(output_uri, table_id, job_config=load_job_config(schema, staging_format))  # Make an API request.
 	load_job.result()  # Waits for the job to complete.
 	destination_table = bq_client.get_table(table_id)  # Make an API request.
 	print("Loaded {} rows".format(destination_table.num_rows) + " to " + table_id)
 
-#---------------------------------------------------------------------------------------------------------------------
-
-### Instantiate processor 
-processor_name = f'projects/{projectid}/locations/{location}/processors/{processorid}'
 
-with open(sample_invoice, 'rb') as image:
-    document = {'content': image.read(), 'mime_type': 'application/pdf'}
-    request = {'name': processor_name, 'document': document}    
-### Capture processor results 
-results = documentai.DocumentProcessorServiceClient().process_document(request=request)
+def entity_record(entity):
+	# Processor entity -> plain record, nested properties (line_item/quantity etc.) included
+	return {'type': entity.type_, 'value': entity.mention_text, 'confidence': round(entity.confidence, 4),
+	        'properties': [entity_record(prop) for prop in entity.properties]}
+
+
+### Define Schema for invoice and inventory tables
+invoice_schema = [
+    bigquery.SchemaField('invoice_id', 'STRING'),
+    bigquery.SchemaField('invoice_date', 'DATE'),
+    bigquery.SchemaField('due_date', 'DATE'),
+    bigquery.SchemaField('purchase_order', 'STRING'),
+    bigquery.SchemaField('supplier_name', 'STRING'),
+    bigquery.SchemaField('receiver_tax_id', 'STRING'),
+    bigquery.SchemaField('receiver_name', 'STRING'),
+    bigquery.SchemaField('receiver_address', 'STRING'),
+    bigquery.SchemaField('total_tax_amount', 'FLOAT'),
+    bigquery.SchemaField('freight_amount', 'FLOAT'),
+    bigquery.SchemaField('net_amount', 'FLOAT'),
+    bigquery.SchemaField('total_amount', 'FLOAT'),
+]
+
+inventory_schema = [
+    bigquery.SchemaField('invoice_id', 'STRING'),
+    bigquery.SchemaField('item_description', 'STRING'),
+    bigquery.SchemaField('item_quantity', 'FLOAT'),
+    bigquery.SchemaField('item_unit_price', 'FLOAT'),
+    bigquery.SchemaField('item_total', 'FLOAT'),
+]
 
 #---------------------------------------------------------------------------------------------------------------------
-### We will be using the parse data / entities for two tables viz., invoice and inventory
-### Invoice Data --- add processor results to a Pandas Dataframe and transform for BQ ingestion
-results_frame = [[entity.type_, entity.mention_text, round(entity.confidence, 4)] for entity in results.document.entities]
-df = pd.DataFrame(results_frame, columns=['type', 'value','confidence'])
-df_t = df.rename(columns={'type':'index'}).drop(columns=['confidence']).T
-df_t.columns = df_t.iloc[0]
-df_t = df_t.drop(df_t.index[0])
-df_t = df_t.reset_index(drop=True)
-# transform amount columns and create 
-for num_col in [col for col in df_t.columns if '_amount' in col]:
-    df_t[num_col] = pd.to_numeric(df_t[num_col].replace({'\$':'', ',':''}, regex = True))
-
-# transform data
-df_t['due_date'] = pd.to_datetime(df_t['due_date'])
-df_t['invoice_date'] = pd.to_datetime(df_t['invoice_date'])
-df_t['receiver_name'] = df_t['receiver_name'].str.replace(",",'')
-df_t['receiver_address'] = df_t['receiver_address'].replace('\\n',' ', regex=True)
-
-### Define Schema for invoice table and export csv for ingest and archival in GCS
-keeper_cols = ['invoice_id','invoice_date','due_date','purchase_order','supplier_name','receiver_tax_id','receiver_name',"receiver_address",'total_amount','total_tax_amount','net_amount','freight_amount']
-df_t = df_t[keeper_cols]
-upload_pd_as_csv_to_gcs(output_bucket, df_t, invoice_table)
-
-job_config_invoice = bigquery.LoadJobConfig(
-	schema=[
-        bigquery.SchemaField('invoice_id', 'STRING'),
-        bigquery.SchemaField('invoice_date', 'DATE'),
-        bigquery.SchemaField('due_date', 'DATE'),
-        bigquery.SchemaField('purchase_order', 'STRING'),
-        bigquery.SchemaField('supplier_name', 'STRING'),
-        bigquery.SchemaField('receiver_tax_id', 'STRING'),
-        bigquery.SchemaField('receiver_name', 'STRING'),
-        bigquery.SchemaField('receiver_address', 'STRING'),
-        bigquery.SchemaField('total_tax_amount', 'FLOAT'),            
-        bigquery.SchemaField('freight_amount', 'FLOAT'),
-        bigquery.SchemaField('net_amount', 'FLOAT'),
-        bigquery.SchemaField('total_amount', 'FLOAT'),
-    ],
-    skip_leading_rows=1,
-    # The source format defaults to CSV, so the line below is optional.
-    source_format=bigquery.SourceFormat.CSV,
-)
-load_csv_to_bq(invoice_table ,job_config_invoice)
-
-#---------------------------------------------------------------------------------------------------------------------
-### Inventory Data / line item --- add processor results to a Pandas Dataframe and transform for BQ ingestion
-add_row = []
-
-line_item_values = df.loc[df["type"] == 'line_item', "value"]
-line_items= line_item_values.to_numpy()
-var = df_t['invoice_id'].iloc[0]
-
-for value in line_items:
-    new_val = value.replace("$","")
-    x = re.match(r"([\W\w\s]*)\s(\d+)\s([\W\w]*)\s([\W\w]*)", new_val)
-    if len(add_row) == 0:
-        add_row = [(var, x.group(1), x.group(2), x.group(3), x.group(4))]
-        #print(add_row)
-    else:
-        add_row.extend([(var, x.group(1), x.group(2), x.group(3), x.group(4))])
-
-### Define Schema for inventory table and export csv for ingest and archival in GCS
-df2 = pd.DataFrame(add_row, columns=['invoice_id', 'item_description', 'item_quantity', 'item_unit_price', 'item_total'])
-upload_pd_as_csv_to_gcs(output_bucket, df2, inventory_table)
-job_config_inventory = bigquery.LoadJobConfig(
-    schema=[
-        bigquery.SchemaField('invoice_id', 'STRING'),
-        bigquery.SchemaField('item_description', 'STRING'),
-        bigquery.SchemaField('item_quantity', 'FLOAT'),
-        bigquery.SchemaField('item_unit_price', 'FLOAT'),
-        bigquery.SchemaField('item_total', 'FLOAT'),
-    ],
-    skip_leading_rows=1,
-    # The source format defaults to CSV, so the line below is optional.
-    source_format=bigquery.SourceFormat.CSV,
-)
-load_csv_to_bq(inventory_table , job_config_inventory)
-#---------------------------------------------------------------------------------------------------------------------
-
-
-
-
-
 
+class TokenBucket:
+	# Token-bucket rate limiter shared by the worker threads: `rate` calls per second on average, bursts up to
+	# `capacity`. Callers reserve a token and sleep outside the lock until it is due.
+	def __init__(self, rate, capacity=None):
+		self.rate = float(rate)
+		self.capacity = float(capacity or max(1.0, rate))
+		self._tokens = self.capacity
+		self._last = time.monotonic()
+		self._lock = threading.Lock()
+
+	def acquire(self):
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+			self._last = now
+			self._tokens -= 1
+			wait = -self._tokens / self.rate if self._tokens < 0 else 0
+		if wait:
+			time.sleep(wait)
+
+
+def expand_inputs(inputs):
+	# Directories contribute every supported file they contain; anything else is treated as a glob pattern
+	paths = []
+	for pattern in inputs:
+		if os.path.isdir(pattern):
+			candidates = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+		else:
+			candidates = sorted(glob.glob(pattern))
+		paths.extend(path for path in candidates if os.path.splitext(path)[1].lower() in mime_types and os.path.isfile(path))
+	# The same file reached through different patterns is processed once
+	unique = {}
+	for path in paths:
+		unique.setdefault(os.path.realpath(path), path)
+	return list(unique.values())
+
+
+def process_file(client, limiter, path, cache=None):
+	### Capture processor results for one local file; duplicates of an already processed file come from the cache
+	processor_name = f'projects/{projectid}/locations/{location}/processors/{processorid}'
+	with open(path, 'rb') as image:
+		content = image.read()
+	key = cache_key(sha256_hex(content), processorid, processor_version)
+	if cache is not None:
+		entities = cache.get(key, len(content))
+		if entities is not None:
+			return entities
+	mime_type = mime_types[os.path.splitext(path)[1].lower()]
+	### Files over the online limits are split into page-range shards (read from the PDF without decoding it),
+	### processed in parallel under the same rate limit and merged back into one entity list in page order
+	pages = page_count(content, mime_type)
+	decision = route(len(content), pages, online_max_pages, online_max_bytes)
+	if decision == 'batch':
+		raise ValueError(f"{len(content)} bytes / {pages} pages is over the online limits and cannot be split "
+		                 "(install pypdf, or use the managed pipeline)")
+	shards = [content]
+	if decision == 'split':
+		shards = split_pdf(content, shard_ranges(pages, len(content), online_max_pages, online_max_bytes))
+
+	def process_shard(shard):
+		request = {'name': processor_name, 'document': {'content': shard, 'mime_type': mime_type}}
+		limiter.acquire()
+		results = client.process_document(request=request)
+		return [entity_record(entity) for entity in results.document.entities]
+
+	if len(shards) == 1:
+		entities = process_shard(content)
+	else:
+		with ThreadPoolExecutor(max_workers=shard_concurrency) as pool:
+			entities = [entity for shard_entities in pool.map(process_shard, shards) for entity in shard_entities]
+	if cache is not None:
+		cache.put(key, entities)
+	return entities
+
+
+def get_result_cache():
+	tiers = [DiskTier(result_cache_dir, result_cache_disk_bytes)]
+	if result_cache_bucket:
+		tiers.append(GcsTier(storage.Client().bucket(result_cache_bucket), result_cache_prefix))
+	return ResultCache(tiers, ttl=result_cache_ttl)
+
+
+_DEFAULT_CACHE = object()
+
+def process_invoices(paths, concurrency=concurrency, qps=processor_qps, client=None, cache=_DEFAULT_CACHE):
+	### Runs process_document for every file concurrently (rate limited to the processor quota), then transforms
+	### all results together and loads them with a single load job per table. cache=None turns the result cache off;
+	### left out, the cache configured above is used when result_cache_enabled
+	client = client or documentai.DocumentProcessorServiceClient(
+		client_options={"api_endpoint": "{}-documentai.googleapis.com".format(location)})
+	limiter = TokenBucket(qps)
+	if cache is _DEFAULT_CACHE:
+		cache = get_result_cache() if result_cache_enabled else None
+	documents = {}
+	failed = {}
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as pool:
+		futures = {pool.submit(process_file, client, limiter, path, cache): path for path in paths}
+		for future in as_completed(futures):
+			path = futures[future]
+			try:
+				documents[path] = future.result()
+			except Exception as e:
+				failed[path] = e
+				print(f"Failed to process {path}: {e}")
+	elapsed = time.perf_counter() - start
+	print(f"Processed {len(documents)} of {len(paths)} documents in {elapsed:.1f}s ({len(documents) / elapsed if elapsed else 0:.2f} docs/s)")
+	if cache is not None:
+		print(f"Result cache: {cache.stats}")
+	if not documents:
+		return documents, failed
+
+	#---------------------------------------------------------------------------------------------------------------------
+	### We will be using the parse data / entities for two tables viz., invoice and inventory
+	### Invoice Data --- add processor results to a Pandas Dataframe and transform for BQ ingestion
+	df = entities_to_frame((path, documents[path]) for path in paths if path in documents)
+	df_t, invoice_rejects = transform_invoices(df)
+	if len(invoice_rejects):
+		print(f"{len(invoice_rejects)} invoice fields could not be parsed and were left empty:\n{invoice_rejects.to_string(index=False)}")
+	upload_pd_to_gcs(output_bucket, df_t, invoice_table, invoice_schema)
+	load_file_to_bq(invoice_table, invoice_schema)
+
+	### Inventory Data / line item --- add processor results to a Pandas Dataframe and transform for BQ ingestion
+	df2, rejects = extract_line_items(df, df_t['invoice_id'])
+	if len(rejects):
+		print(f"{len(rejects)} line items could not be parsed and were skipped:\n{rejects.to_string(index=False)}")
+	upload_pd_to_gcs(output_bucket, df2, inventory_table, inventory_schema)
+	load_file_to_bq(inventory_table, inventory_schema)
+	return documents, failed
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Process local invoices with Document AI and load them into BigQuery')
+	parser.add_argument('inputs', nargs='*', default=[sample_invoice], help='Files, directories or glob patterns')
+	parser.add_argument('--concurrency', type=int, default=concurrency, help='Concurrent process_document calls')
+	parser.add_argument('--qps', type=float, default=processor_qps, help="Processor requests per second (online quota)")
+	parser.add_argument('--no-cache', action='store_true', help='Always call the processor, ignoring cached results')
+	args = parser.parse_args(argv)
+
+	paths = expand_inputs(args.inputs)
+	if not paths:
+		parser.error(f"No supported files found in {args.inputs}")
+	cache = None if args.no_cache or not result_cache_enabled else get_result_cache()
+	documents, failed = process_invoices(paths, args.concurrency, args.qps, cache=cache)
+	return 1 if failed else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,79 @@
+import importlib.util
+import io
+import re
+
+PYPDF_AVAILABLE = importlib.util.find_spec('pypdf') is not None        # Optional: page-range splitting, imported on use
+
+#---------------------------------------------------------------------------------------------------------------------
+######### Size-aware routing #########
+# Online process_document answers in about a second but only takes documents within the processor's online page and
+# request size limits; batch processing takes anything but pays for a long-running operation. route() picks:
+#   'online'  the document fits one online request
+#   'split'   it does not, but can be cut into consecutive page ranges that each fit (shard_ranges/split_pdf); the
+#             ranges are processed online in parallel and their entities merged in page order
+#   'batch'   everything else, including splits above split_max_pages or without pypdf installed
+# Page counts come from a byte scan of the PDF's page objects and page tree, without decoding content streams. PDFs
+# whose page tree sits in compressed object streams are opened with pypdf (cross-reference table only) when it is
+# installed. TIFFs count as unknown, so only their size is checked.
+
+_PAGE_OBJECT = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+_PAGE_TREE_COUNT = re.compile(rb'/Type\s*/Pages(?![A-Za-z])[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages(?![A-Za-z])')
+
+
+def pdf_page_count(content):
+    # Returns the number of pages, or None when it cannot be determined cheaply
+    if not content.startswith(b'%PDF'):
+        return None
+    counts = [int(a or b) for a, b in _PAGE_TREE_COUNT.findall(content)]
+    if counts:
+        return max(counts)                                              # the root of the page tree counts every page
+    pages = len(_PAGE_OBJECT.findall(content))
+    if pages:
+        return pages
+    if PYPDF_AVAILABLE:
+        from pypdf import PdfReader
+        try:
+            return len(PdfReader(io.BytesIO(content)).pages)
+        except Exception:
+            return None
+    return None
+
+
+def page_count(content, mime_type):
+    if mime_type == 'application/pdf':
+        return pdf_page_count(content)
+    if mime_type == 'image/tiff':
+        return None
+    return 1
+
+
+def route(size, pages, max_pages, max_bytes, split_max_pages=None):
+    if pages is None:
+        return 'online' if size <= max_bytes else 'batch'
+    if pages <= max_pages and size <= max_bytes:
+        return 'online'
+    if PYPDF_AVAILABLE and pages > 1 and (split_max_pages is None or pages <= split_max_pages):
+        return 'split'
+    return 'batch'
+
+
+def shard_ranges(pages, size, max_pages, max_bytes):
+    # Consecutive [start, end) page ranges that each fit the online limits, assuming bytes spread evenly over pages
+    per_page = size / pages
+    step = max(1, min(max_pages, int(max_bytes // per_page) if per_page else max_pages))
+    return [(start, min(start + step, pages)) for start in range(0, pages, step)]
+
+
+def split_pdf(content, ranges):
+    # Returns one standalone PDF (bytes) per page range
+    from pypdf import PdfReader, PdfWriter
+    reader = PdfReader(io.BytesIO(content))
+    shards = []
+    for start, end in ranges:
+        writer = PdfWriter()
+        for page in reader.pages[start:end]:
+            writer.add_page(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        shards.append(buffer.getvalue())
+    return shards